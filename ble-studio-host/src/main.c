@@ -2,8 +2,10 @@
  * Shared, module-agnostic BLE host (simulated computer) that exercises the
  * ZMK Studio RPC service over BLE, for BabbleSim BLE tests driven by
  * `west zmk-ble-test`. Consumers do NOT copy or edit this app: the request
- * payloads are injected per test case from a `studio_requests.hex` data
- * file (see README.md and CMakeLists.txt) -- never hand-encoded here.
+ * payloads are loaded at runtime from the per-case file given with
+ * `-requests_file=<path>` (or, for standalone builds, embedded from a
+ * `studio_requests.hex`; see README.md and CMakeLists.txt) -- never
+ * hand-encoded here.
  *
  * Internally the app plays the BLE *central* role (the DUT keyboard is the
  * advertiser), mirroring what a computer running ZMK Studio does.
@@ -49,6 +51,7 @@ static const struct bt_uuid_128 studio_chrc_uuid = BT_UUID_INIT_128(ZMK_BT_STUDI
 #define FRAMING_ESC 0xAC
 #define FRAMING_EOF 0xAD
 
+#if defined(STUDIO_REQUESTS_EMBEDDED)
 /*
  * Framed, pre-encoded zmk.studio.Request payloads to send, in order.
  * GENERATED at build time by hex2inc.py from the studio_requests.hex file
@@ -59,6 +62,103 @@ static const struct bt_uuid_128 studio_chrc_uuid = BT_UUID_INIT_128(ZMK_BT_STUDI
  */
 #include "requests.inc"
 
+static int load_requests(void) { return 0; }
+#else
+/*
+ * Framed, pre-encoded zmk.studio.Request payloads to send, in order, read at
+ * boot from the host file passed as `-requests_file=<path>`: each request is
+ * a little-endian u16 length followed by that many framed bytes (written by
+ * scripts/lib/ble/studio_requests.py's render_requests_file()).
+ */
+#include <posix_native_task.h>
+#include <nsi_host_trampolines.h>
+#include "cmdline.h"
+
+#define STUDIO_REQUESTS_MAX 64
+#define STUDIO_REQUESTS_FILE_MAX 8192
+/* Host open(2) flag; the trampoline takes the host's value. */
+#define HOST_O_RDONLY 0
+
+static char *requests_file;
+static uint8_t requests_buf[STUDIO_REQUESTS_FILE_MAX];
+static struct {
+    const uint8_t *data;
+    size_t len;
+} studio_requests[STUDIO_REQUESTS_MAX];
+static size_t studio_requests_count;
+#define STUDIO_REQUESTS_COUNT studio_requests_count
+
+static void add_requests_file_option(void) {
+    static struct args_struct_t options[] = {
+        {
+            .option = "requests_file",
+            .name = "path",
+            .type = 's',
+            .dest = (void *)&requests_file,
+            .descript = "File of framed zmk.studio.Request payloads to send, each "
+                        "prefixed with its length as a little-endian u16",
+        },
+        ARG_TABLE_ENDMARKER,
+    };
+
+    native_add_command_line_opts(options);
+}
+
+NATIVE_TASK(add_requests_file_option, PRE_BOOT_1, 10);
+
+static int load_requests(void) {
+    if (!requests_file) {
+        LOG_ERR("No requests: pass -requests_file=<path>");
+        return -EINVAL;
+    }
+
+    int fd = nsi_host_open(requests_file, HOST_O_RDONLY);
+    if (fd < 0) {
+        LOG_ERR("Cannot open %s", requests_file);
+        return -ENOENT;
+    }
+
+    size_t size = 0;
+    long n;
+    while (size < sizeof(requests_buf) &&
+           (n = nsi_host_read(fd, requests_buf + size, sizeof(requests_buf) - size)) > 0) {
+        size += n;
+    }
+    /* A full buffer may mean the file did not fit; probe for more. */
+    uint8_t extra;
+    bool truncated = size == sizeof(requests_buf) && nsi_host_read(fd, &extra, 1) > 0;
+    nsi_host_close(fd);
+    if (truncated) {
+        LOG_ERR("%s exceeds %d bytes", requests_file, STUDIO_REQUESTS_FILE_MAX);
+        return -EFBIG;
+    }
+
+    for (size_t offset = 0; offset < size;) {
+        if (size - offset < 2 || studio_requests_count == STUDIO_REQUESTS_MAX) {
+            LOG_ERR("%s: malformed or more than %d requests", requests_file,
+                    STUDIO_REQUESTS_MAX);
+            return -EINVAL;
+        }
+        size_t len = sys_get_le16(&requests_buf[offset]);
+        offset += 2;
+        if (len > size - offset) {
+            LOG_ERR("%s: request %zu is truncated", requests_file, studio_requests_count);
+            return -EINVAL;
+        }
+        studio_requests[studio_requests_count].data = &requests_buf[offset];
+        studio_requests[studio_requests_count].len = len;
+        studio_requests_count++;
+        offset += len;
+    }
+
+    if (studio_requests_count == 0) {
+        LOG_ERR("%s holds no requests", requests_file);
+        return -EINVAL;
+    }
+    return 0;
+}
+#endif
+
 static int start_scan(void);
 
 static struct bt_conn *default_conn;
@@ -405,6 +505,11 @@ struct bt_conn_auth_info_cb auth_info_cb = {
 int main(void) {
     int err;
 
+    err = load_requests();
+    if (err) {
+        return err;
+    }
+
     err = bt_conn_auth_info_cb_register(&auth_info_cb);
 
     err = bt_enable(NULL);
@@ -6,11 +6,16 @@ case discovery, firmware/host-app builds, phy + handbrake launch, output
 tee'ing -- lives here; the west command (`scripts/zmk_ble_test.py`) resolves
 the workspace paths and drives it.
 
-The **pass/fail pipeline is kept byte-compatible** with the bash script by
-shelling out to the exact upstream pipeline
-(`sort -s -t: -k1,1 | sed -E -n -f events.patterns` then `diff -auZ`), so
-existing `events.patterns` / `events.snapshot` files produce identical
-results and stay diffable against upstream ZMK conventions.
+The **pass/fail pipeline is kept byte-compatible** with the bash script's
+(`sort -s -t: -k1,1 | sed -E -n -f events.patterns` then `diff -auZ`); it
+is evaluated in-process by the sibling `snapshot_eval` lib, so existing
+`events.patterns` / `events.snapshot` files produce identical results and
+stay diffable against upstream ZMK conventions.
+
+Cases run as a two-stage pipeline: a build pool compiles and stages each
+case's firmware, and a simulation pool runs the phy + devices of every case
+whose binaries are staged, so long simulations hide behind other cases'
+compiles.
 
 Per-case file conventions (a directory is a case iff it has
 `nrf52_bsim.keymap`):
@@ -24,10 +29,14 @@ Per-case file conventions (a directory is a case iff it has
 | `peripheral*.overlay` | one split-peripheral build each; presence => split   |
 | `siblings.txt`        | one command line per extra simulated device          |
 | `studio_requests.json`| declarative zmk.studio.Request list (JSON DSL);      |
-|                       | converted at test time and embedded into the shared  |
+|                       | converted at test time and loaded by the shared      |
 |                       | ble-studio-host app ({studio_host} in siblings.txt)  |
 | `studio_requests.hex` | byte-exact escape hatch for the same (one framed     |
 |                       | request per hex line); mutually exclusive with .json |
+| `sim_length`          | simulated length in us (default 50e6, the phy's      |
+|                       | `-sim_length`)                                       |
+| `sim_done`            | regexes (one per line); once every one has matched a |
+|                       | device output line, the simulation is stopped early  |
 | `events.patterns`     | sed -E -n filter for the combined output log         |
 | `events.snapshot`     | expected filtered output                             |
 | `pending`             | mismatch reported as PENDING instead of FAILED       |
@@ -35,6 +44,9 @@ Per-case file conventions (a directory is a case iff it has
 
 from __future__ import annotations
 
+import hashlib
+import json
+import math
 import os
 import re
 import shlex
@@ -42,21 +54,53 @@ import shutil
 import subprocess
 import sys
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 
+from lib.build_cache import hash_tree
+from lib.snapshot_eval import sed_filter, sort_first_field, unified_diff
+from lib.test_impact import build_inputs
+
 
 class BleTestError(Exception):
     """Fatal, actionable error (missing bsim, build failure, ...)."""
 
 
 # The shared Studio-over-BLE host app this repo owns (ble-studio-host/ at the
-# repo root; see its README.md). Built automatically -- with the case's
-# payload data embedded -- for any case that contains `studio_requests.json`
-# (or the low-level `studio_requests.hex`).
+# repo root; see its README.md). Built once per run when any case contains
+# `studio_requests.json` (or the low-level `studio_requests.hex`); each case
+# passes its payloads at runtime with `-requests_file=`.
 BLE_STUDIO_HOST_DIR = Path(__file__).resolve().parents[3] / "ble-studio-host"
 
+# Per build dir record of the last successful `west build`: its arguments,
+# the executables it produced and the files they were built from.
+BUILD_RECORD = "zmk-ble-build.json"
+
+# Case files that only drive the simulation / evaluation. They are left out
+# of the firmware fingerprint, so cases differing only in these share builds.
+RUNTIME_FILES = {
+    "siblings.txt",
+    "sim_length",
+    "sim_done",
+    "studio_requests.json",
+    "studio_requests.hex",
+    "events.patterns",
+    "events.snapshot",
+    "pending",
+}
+
+# A relative include leaving the case dir makes the build depend on where
+# the case lives, not just on its contents.
+_PARENT_INCLUDE = re.compile(rb"#\s*include\s*[<\"]\.\./")
+
+# Simulated length (us) of a case without a `sim_length` file.
+DEFAULT_SIM_LENGTH = "50e6"
+
+# Simulated time prefix of a device output line, e.g. `d_00: @00:00:03.250000`.
+_SIM_TIME = re.compile(r"^d_\d+: @(\d+):(\d+):(\d+(?:\.\d+)?)")
+
 # Status constants for a single case.
 PASS = "PASS"
 FAILED = "FAILED"
@@ -81,6 +125,20 @@ def discover_cases(tests_path: Path) -> list[Path]:
 class CaseResult:
     rel: str
     status: str
+    # Simulated seconds the case ran (the latest device timestamp seen).
+    sim_time: float = 0.0
+
+
+@dataclass
+class StagedCase:
+    """A case whose binaries are built and staged into `$BSIM_OUT_PATH/bin`,
+    ready to simulate."""
+
+    case_dir: Path
+    rel: str
+    sim_id: str
+    case_build: Path
+    siblings: list[str]
 
 
 class BleRunner:
@@ -96,6 +154,7 @@ class BleRunner:
         auto_accept: bool,
         verbose: bool,
         log,
+        sim_timeout: float = 120.0,
     ):
         self.zmk_app = Path(zmk_app)
         self.module_dir = Path(module_dir)
@@ -107,6 +166,8 @@ class BleRunner:
         self.verbose = verbose
         self.quiet = not verbose
         self.log = log
+        # Wall-clock limit for one case's simulation.
+        self.sim_timeout = sim_timeout
 
         self.build_root = self.topdir / "build" / "ble"
         # Base directory case-relative paths (and hence sim ids) are computed
@@ -119,8 +180,16 @@ class BleRunner:
         self.env["BSIM_OUT_PATH"] = str(self.bsim_out_path)
         if bsim_components_path is not None:
             self.env["BSIM_COMPONENTS_PATH"] = str(bsim_components_path)
-        # Serialize concurrent appends to a case's output.log (one lock per
-        # case is created in _run_simulation; this is only a default).
+        # Ninja -j for each `west build`; set by run() from the build budget.
+        self.ninja_jobs: int | None = None
+
+        # Firmware fingerprint -> (zmk.exe, case that built it), so cases with
+        # identical firmware inputs build it once per run.
+        self._firmware: dict[str, Future] = {}
+        self._firmware_lock = threading.Lock()
+        self._fingerprint_base: dict | None = None
+        self._studio_host: Path | None = None
+        self._studio_host_lock = threading.Lock()
 
     # ------------------------------------------------------------------
     # Build helpers
@@ -130,8 +199,21 @@ class BleRunner:
         self, build_dir: Path, board: str, source: Path, extra_args: list[str], log_path: Path
     ) -> None:
         """Run `west build`, capturing output to `log_path`. Raises
-        BleTestError on failure (message points at the log)."""
-        cmd = ["west", "build", "-d", str(build_dir), "-b", board, str(source), "--", *extra_args]
+        BleTestError on failure (message points at the log).
+
+        Skipped when the build dir's record shows the same arguments and its
+        executables are newer than every input file of that build."""
+        command = ["west", "build", "-d", str(build_dir), "-b", board, str(source)]
+        if self._up_to_date(build_dir, command + extra_args):
+            self.log.inf(f"[*]   {build_dir} is up to date")
+            return
+        (build_dir / BUILD_RECORD).unlink(missing_ok=True)
+
+        # `-p auto`: start over only if the source dir or board changed.
+        cmd = [*command, "-p", "auto"]
+        if self.ninja_jobs:
+            cmd.append(f"-o=-j{self.ninja_jobs}")
+        cmd += ["--", *extra_args]
         log_path.parent.mkdir(parents=True, exist_ok=True)
         with open(log_path, "w") as lf:
             proc = subprocess.run(
@@ -143,6 +225,27 @@ class BleRunner:
             )
         if proc.returncode != 0:
             raise BleTestError(f"build failed: {source} (see {log_path})")
+        self._record_build(build_dir, command + extra_args)
+
+    def _record_build(self, build_dir: Path, command: list[str]) -> None:
+        outputs = sorted(str(p) for p in (build_dir / "zephyr").glob("*.exe"))
+        # Generated files under the build dir follow their own inputs.
+        generated = f"{build_dir.resolve()}/"
+        inputs = sorted(p for p in build_inputs(build_dir) if not p.startswith(generated))
+        with open(build_dir / BUILD_RECORD, "w") as f:
+            json.dump({"command": command, "outputs": outputs, "inputs": inputs}, f)
+
+    def _up_to_date(self, build_dir: Path, command: list[str]) -> bool:
+        try:
+            with open(build_dir / BUILD_RECORD, "r") as f:
+                record = json.load(f)
+            if record["command"] != command or not record["inputs"]:
+                return False
+            built = min(Path(p).stat().st_mtime_ns for p in record["outputs"])
+            return all(Path(p).stat().st_mtime_ns < built for p in record["inputs"])
+        except (OSError, ValueError, KeyError, TypeError):
+            # No record, a missing output or a deleted input: build.
+            return False
 
     def _stage(self, built_exe: Path, name: str) -> None:
         self.bin_dir.mkdir(parents=True, exist_ok=True)
@@ -159,8 +262,10 @@ class BleRunner:
           `tests/ble/*_central/CMakeLists.txt` naming (plain board
           `nrf52_bsim`) -> `<prefix>_<appname>.exe`, plus a plain
           `<appname>.exe` alias so existing literal `siblings.txt` names keep
-          working. (The shared ble-studio-host app is built per case instead
-          -- see run_case.)
+          working. (The shared ble-studio-host app is built separately, once
+          per run and only when a case has studio requests -- see
+          _build_studio_host; each case passes its payloads at runtime with
+          `-requests_file=`.)
         """
         self.log.inf("[*] Building host apps")
         central_src = self.zmk_app / "tests" / "ble" / "central"
@@ -209,12 +314,17 @@ class BleRunner:
             return case_dir.name
 
     def run_case(self, case_dir: Path) -> CaseResult:
+        return self.simulate_case(self.build_case(case_dir))
+
+    def build_case(self, case_dir: Path) -> StagedCase:
+        """Build stage: the case's peripherals, DUT and studio host, staged
+        under the case's sim id."""
         case_dir = Path(case_dir).resolve()
         rel = self._case_rel(case_dir)
         sim_id = f"{self.prefix}_{rel.replace('/', '_')}"
         case_build = self.build_root / rel
         case_build.mkdir(parents=True, exist_ok=True)
-        self.log.inf(f"Running {rel}:")
+        self.log.inf(f"Building {rel}:")
 
         peripheral_overlays = sorted(case_dir.glob("peripheral*.overlay"))
 
@@ -224,20 +334,20 @@ class BleRunner:
         if peripheral_conf.is_file():
             extra_peripheral_args.append(f"-DEXTRA_CONF_FILE={peripheral_conf}")
 
+        peripheral_exes = {}
         for overlay in peripheral_overlays:
             pn = overlay.name[: -len(".overlay")]
-            build_dir = case_build / pn
-            self._west_build(
-                build_dir,
-                "nrf52_bsim//zmk_test_mock",
-                self.zmk_app,
+            peripheral_exes[pn] = self._firmware_build(
+                case_dir,
+                rel,
+                case_build,
+                pn,
                 [
                     f"-DZMK_CONFIG={case_dir}",
                     f"-DZMK_EXTRA_MODULES={self.module_dir}",
                     f"-DEXTRA_DTC_OVERLAY_FILE={overlay}",
                     *extra_peripheral_args,
                 ],
-                case_build / f"{pn}.build.log",
             )
 
         # --- Build the DUT (central) ---
@@ -249,55 +359,148 @@ class BleRunner:
             self.log.inf("Found peripheral overlays, building the test as a split central")
             extra_central_args.append("-DCONFIG_ZMK_SPLIT_ROLE_CENTRAL=y")
 
-        dut_build = case_build / "dut"
-        self._west_build(
-            dut_build,
-            "nrf52_bsim//zmk_test_mock",
-            self.zmk_app,
+        dut_exe = self._firmware_build(
+            case_dir,
+            rel,
+            case_build,
+            "dut",
             [
                 f"-DZMK_CONFIG={case_dir}",
                 f"-DZMK_EXTRA_MODULES={self.module_dir}",
                 *extra_central_args,
             ],
-            case_build / "dut.build.log",
         )
 
         # --- Stage DUT + peripheral executables ---
-        self._stage(dut_build / "zephyr" / "zmk.exe", sim_id)
-        for overlay in peripheral_overlays:
-            pn = overlay.name[: -len(".overlay")]
-            self._stage(case_build / pn / "zephyr" / "zmk.exe", f"{sim_id}_{pn}.exe")
+        self._stage(dut_exe, sim_id)
+        for pn, exe in peripheral_exes.items():
+            self._stage(exe, f"{sim_id}_{pn}.exe")
 
-        # --- Shared Studio-over-BLE host app (per-case payload data) ---
+        # --- Shared Studio-over-BLE host app (per-case payload file) ---
         studio_host_exe = f"{sim_id}_studio_host.exe"
-        requests_hex = self._resolve_studio_requests(case_dir, case_build, rel)
-        if requests_hex is not None:
+        requests_file = self._resolve_studio_requests(case_dir, case_build, rel)
+        if requests_file is not None:
             if not BLE_STUDIO_HOST_DIR.is_dir():
                 raise BleTestError(
                     f"case {rel} has studio_requests data but the shared host app "
                     f"was not found at {BLE_STUDIO_HOST_DIR}"
                 )
-            self.log.inf("Building the shared ble-studio-host app for this case")
-            host_build = case_build / "studio_host"
-            self._west_build(
-                host_build,
-                "nrf52_bsim",
-                BLE_STUDIO_HOST_DIR,
-                [f"-DSTUDIO_REQUESTS_HEX_FILE={requests_hex}"],
-                case_build / "studio_host.build.log",
+            self._stage(self._build_studio_host(), studio_host_exe)
+
+        siblings = []
+        for line in self._read_siblings(case_dir / "siblings.txt"):
+            if "{studio_host}" in line and requests_file is not None:
+                line += f" -requests_file={shlex.quote(str(requests_file))}"
+            siblings.append(
+                line.replace("{prefix}", self.prefix).replace("{studio_host}", studio_host_exe)
             )
-            self._stage(host_build / "zephyr" / "zephyr.exe", studio_host_exe)
-
-        # --- Run the simulation ---
-        siblings = [
-            line.replace("{prefix}", self.prefix).replace("{studio_host}", studio_host_exe)
-            for line in self._read_siblings(case_dir / "siblings.txt")
-        ]
-        output_log = case_build / "output.log"
-        self._run_simulation(sim_id, siblings, output_log)
-
-        # --- Evaluate the snapshot ---
-        return CaseResult(rel, self._evaluate(case_dir, case_build, output_log, rel))
+        return StagedCase(case_dir, rel, sim_id, case_build, siblings)
+
+    def simulate_case(self, staged: StagedCase) -> CaseResult:
+        """Simulation stage: run the phy and devices, then evaluate."""
+        self.log.inf(f"Running {staged.rel}:")
+        output_log = staged.case_build / "output.log"
+        sim_length, done = self._read_sim_settings(staged.case_dir, staged.rel)
+        sim_time = self._run_simulation(
+            staged.sim_id, staged.siblings, output_log, sim_length, done
+        )
+        status = self._evaluate(staged.case_dir, staged.case_build, output_log, staged.rel)
+        return CaseResult(staged.rel, status, sim_time)
+
+    def _read_sim_settings(self, case_dir: Path, rel: str) -> tuple[str, list[re.Pattern]]:
+        """The case's simulated length (`sim_length`) and the regexes that end
+        the simulation early once all of them matched (`sim_done`)."""
+        sim_length = DEFAULT_SIM_LENGTH
+        length_file = case_dir / "sim_length"
+        if length_file.is_file():
+            sim_length = length_file.read_text().strip()
+            try:
+                float(sim_length)
+            except ValueError:
+                raise BleTestError(f"case {rel}: sim_length is not a number: {sim_length!r}")
+
+        done = []
+        for line in self._read_siblings(case_dir / "sim_done"):
+            if line.startswith("#"):
+                continue
+            try:
+                done.append(re.compile(line))
+            except re.error as err:
+                raise BleTestError(f"case {rel}: sim_done: bad regex {line!r}: {err}")
+        return sim_length, done
+
+    def _firmware_build(
+        self, case_dir: Path, rel: str, case_build: Path, name: str, args: list[str]
+    ) -> Path:
+        """Build a `nrf52_bsim//zmk_test_mock` firmware of the case into
+        `case_build/<name>` and return its zmk.exe -- unless a case with the
+        same fingerprint already built (or is building) it this run, in which
+        case that case's zmk.exe is returned."""
+        key = self._firmware_fingerprint(case_dir, args)
+        with self._firmware_lock:
+            future = self._firmware.get(key)
+            owner = future is None
+            if owner:
+                future = self._firmware[key] = Future()
+        log_path = case_build / f"{name}.build.log"
+        if not owner:
+            exe, built_by = future.result()
+            self.log.inf(f"[*]   {rel}: {name} is identical to {built_by}'s, reusing it")
+            log_path.write_text(f"Identical inputs: reused {exe}\n")
+            return exe
+
+        build_dir = case_build / name
+        try:
+            self._west_build(build_dir, "nrf52_bsim//zmk_test_mock", self.zmk_app, args, log_path)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        exe = build_dir / "zephyr" / "zmk.exe"
+        future.set_result((exe, f"{rel}/{name}"))
+        return exe
+
+    def _firmware_fingerprint(self, case_dir: Path, args: list[str]) -> str:
+        """sha256 over what decides a case firmware: the west build arguments
+        (with the case dir abstracted away), the contents of the case's build
+        files (ZMK_CONFIG, overlays, extra confs), the module tree and the
+        ZMK revision."""
+        with self._firmware_lock:
+            if self._fingerprint_base is None:
+                self._fingerprint_base = {
+                    "module": hash_tree(self.module_dir),
+                    "zmk": self._zmk_revision(),
+                }
+            base = self._fingerprint_base
+
+        config = hashlib.sha256()
+        location = None
+        for dirpath, dirnames, filenames in os.walk(case_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = Path(dirpath) / filename
+                if Path(dirpath) == case_dir and filename in RUNTIME_FILES:
+                    continue
+                data = path.read_bytes()
+                if _PARENT_INCLUDE.search(data):
+                    location = str(case_dir.parent)
+                config.update(path.relative_to(case_dir).as_posix().encode() + b"\0")
+                config.update(hashlib.sha256(data).digest())
+
+        inputs = {
+            **base,
+            "args": [arg.replace(str(case_dir), "{case}") for arg in args],
+            "config": config.hexdigest(),
+            "location": location,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _zmk_revision(self) -> str | None:
+        proc = subprocess.run(
+            ["git", "-C", str(self.zmk_app), "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+        )
+        return proc.stdout.strip() if proc.returncode == 0 else None
 
     def _read_siblings(self, path: Path) -> list[str]:
         if not path.is_file():
@@ -309,15 +512,35 @@ class BleRunner:
                 lines.append(line)
         return lines
 
+    def _build_studio_host(self) -> Path:
+        """Build the shared ble-studio-host app once per run (no payloads
+        embedded) and return its zephyr.exe."""
+        with self._studio_host_lock:
+            if self._studio_host is None:
+                self.log.inf("Building the shared ble-studio-host app")
+                host_build = self.build_root / "studio_host"
+                self._west_build(
+                    host_build,
+                    "nrf52_bsim",
+                    BLE_STUDIO_HOST_DIR,
+                    # Clear a payload file cached by an older, embedding build.
+                    ["-DSTUDIO_REQUESTS_HEX_FILE="],
+                    self.build_root / "studio_host.build.log",
+                )
+                self._studio_host = host_build / "zephyr" / "zephyr.exe"
+            return self._studio_host
+
     def _resolve_studio_requests(self, case_dir: Path, case_build: Path, rel: str) -> Path | None:
-        """Return the studio_requests.hex path to embed into the shared host
-        app, or None when the case does not use it.
+        """Return the path of the case's runtime requests file
+        (`studio_requests.bin`, see studio_requests.render_requests_file)
+        for the shared host app, or None when the case does not use it.
 
         The primary form is `studio_requests.json` (declarative request DSL,
         see scripts/lib/ble/studio_requests.py), converted here at test time
-        into a derived hex under the case build dir -- no checked-in
-        artifact. A `studio_requests.hex` in the case dir is the byte-exact
-        escape hatch. Having both in one case is an error.
+        under the case build dir -- no checked-in artifact; the derived hex
+        is kept next to it for reading. A `studio_requests.hex` in the case
+        dir is the byte-exact escape hatch. Having both in one case is an
+        error.
         """
         json_file = case_dir / "studio_requests.json"
         hex_file = case_dir / "studio_requests.hex"
@@ -327,17 +550,28 @@ class BleRunner:
                 "keep exactly one (JSON is the primary form; .hex is the byte-exact "
                 "escape hatch)"
             )
-        if hex_file.is_file():
-            return hex_file
-        if not json_file.is_file():
+        if not json_file.is_file() and not hex_file.is_file():
             return None
 
         sys.path.insert(0, str(Path(__file__).resolve().parent))
+        case_build.mkdir(parents=True, exist_ok=True)
+        derived = case_build / "studio_requests.bin"
+        if hex_file.is_file():
+            import studio_requests
+
+            try:
+                payloads = studio_requests.parse_hex_file(hex_file)
+                derived.write_bytes(studio_requests.render_requests_file(payloads))
+            except ValueError as err:
+                raise BleTestError(f"case {rel}: studio_requests.hex: {err}")
+            return derived
+
         try:
             import studio_requests
 
             named = studio_requests.load_requests_json(json_file, module_dir=self.module_dir)
             hex_content = studio_requests.render_hex(named)
+            blob = studio_requests.render_requests_file(studio_requests.framed_payloads(named))
         except ImportError as err:
             raise BleTestError(
                 f"case {rel}: converting studio_requests.json requires the python "
@@ -347,13 +581,22 @@ class BleRunner:
         except (RuntimeError, ValueError, OSError) as err:
             raise BleTestError(f"case {rel}: studio_requests.json conversion failed: {err}")
 
-        case_build.mkdir(parents=True, exist_ok=True)
-        derived = case_build / "studio_requests.hex"
-        derived.write_text(hex_content)
+        (case_build / "studio_requests.hex").write_text(hex_content)
+        derived.write_bytes(blob)
         self.log.inf(f"Converted studio_requests.json ({len(named)} request(s)) -> {derived}")
         return derived
 
-    def _run_simulation(self, sim_id: str, siblings: list[str], output_log: Path) -> None:
+    def _run_simulation(
+        self,
+        sim_id: str,
+        siblings: list[str],
+        output_log: Path,
+        sim_length: str = DEFAULT_SIM_LENGTH,
+        done_patterns: list[re.Pattern] = (),
+    ) -> float:
+        """Run the phy and devices until `sim_length` simulated us, the
+        wall-clock `sim_timeout`, or -- with `done_patterns` -- until every
+        pattern matched a tee'd output line. Returns the simulated seconds."""
         output_log.parent.mkdir(parents=True, exist_ok=True)
         if output_log.exists():
             output_log.unlink()
@@ -361,6 +604,9 @@ class BleRunner:
         procs: list[subprocess.Popen] = []
         threads: list[threading.Thread] = []
         lock = threading.Lock()
+        pending = list(done_patterns)
+        done = threading.Event()
+        sim_time = 0.0
 
         with open(output_log, "a") as log_handle:
 
@@ -377,12 +623,23 @@ class BleRunner:
                 procs.append(proc)
 
                 def reader(p=proc):
+                    nonlocal sim_time
                     assert p.stdout is not None
                     for line in p.stdout:
                         if tee:
                             with lock:
                                 log_handle.write(line)
                                 log_handle.flush()
+                                m = _SIM_TIME.match(line)
+                                if m:
+                                    h, mi, sec = m.groups()
+                                    sim_time = max(
+                                        sim_time, int(h) * 3600 + int(mi) * 60 + float(sec)
+                                    )
+                                if pending:
+                                    pending[:] = [rx for rx in pending if not rx.search(line)]
+                                    if not pending:
+                                        done.set()
                         if not self.quiet:
                             sys.stdout.write(line)
                     p.stdout.close()
@@ -405,29 +662,45 @@ class BleRunner:
                 "./bs_2G4_phy_v1",
                 f"-s={sim_id}",
                 f"-D={2 + len(siblings)}",
-                "-sim_length=50e6",
+                f"-sim_length={sim_length}",
             ]
-            try:
-                subprocess.run(
-                    phy,
-                    cwd=str(self.bin_dir),
-                    stdout=subprocess.DEVNULL if self.quiet else None,
-                    stderr=subprocess.DEVNULL if self.quiet else subprocess.STDOUT,
-                    env=self.env,
-                    timeout=120,
-                )
-            except subprocess.TimeoutExpired:
-                self.log.wrn(f"[*] phy timed out for {sim_id}; killing devices")
+            phy_proc = subprocess.Popen(
+                phy,
+                cwd=str(self.bin_dir),
+                stdout=subprocess.DEVNULL if self.quiet else None,
+                stderr=subprocess.DEVNULL if self.quiet else subprocess.STDOUT,
+                env=self.env,
+            )
+            deadline = time.monotonic() + self.sim_timeout
+            while phy_proc.poll() is None:
+                if done.wait(timeout=0.1):
+                    self.log.inf(f"[*] {sim_id}: sim_done matched, stopping the simulation")
+                    break
+                if time.monotonic() > deadline:
+                    self.log.wrn(f"[*] phy timed out for {sim_id}; killing devices")
+                    break
+            if phy_proc.poll() is None:
+                # SIGTERM: the phy disconnects the devices (which then exit)
+                # and ends the simulation.
+                phy_proc.terminate()
+                try:
+                    phy_proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    phy_proc.kill()
+                    phy_proc.wait()
 
             # Devices exit once the phy disconnects; give them a moment, then
             # reap so their tee threads flush before we read output.log.
+            reap_deadline = time.monotonic() + 10
             for proc in procs:
                 try:
-                    proc.wait(timeout=10)
+                    proc.wait(timeout=max(0.0, reap_deadline - time.monotonic()))
                 except subprocess.TimeoutExpired:
                     proc.kill()
+            join_deadline = time.monotonic() + 5
             for t in threads:
-                t.join(timeout=5)
+                t.join(timeout=max(0.0, join_deadline - time.monotonic()))
+        return sim_time
 
     def _evaluate(self, case_dir: Path, case_build: Path, output_log: Path, rel: str) -> str:
         patterns = case_dir / "events.patterns"
@@ -436,28 +709,15 @@ class BleRunner:
 
         # Byte-compatible with run-ble-test.sh:
         #   sort -s -t ':' -k 1,1 output.log | sed -E -n -f events.patterns
-        with open(filtered, "w") as out:
-            sort = subprocess.Popen(
-                ["sort", "-s", "-t", ":", "-k", "1,1", str(output_log)],
-                stdout=subprocess.PIPE,
-            )
-            sed = subprocess.run(
-                ["sed", "-E", "-n", "-f", str(patterns)],
-                stdin=sort.stdout,
-                stdout=out,
-            )
-            assert sort.stdout is not None
-            sort.stdout.close()
-            sort.wait()
-        if sed.returncode != 0:
-            self.log.wrn(f"[*] sed filter returned {sed.returncode} for {rel}")
-
-        diff = subprocess.run(
-            ["diff", "-auZ", str(snapshot), str(filtered)],
-            capture_output=True,
-            text=True,
-        )
-        if diff.returncode == 0:
+        #   diff -auZ events.snapshot filtered_output.log
+        events = sort_first_field(output_log.read_bytes())
+        try:
+            filtered.write_bytes(sed_filter(patterns, events, extended=True))
+        except OSError as err:
+            self.log.err(f"FAILED: {rel}: cannot read {patterns}: {err}")
+            return FAILED
+        diff = unified_diff(snapshot, filtered)
+        if not diff:
             self.log.inf(f"PASS: {rel}")
             return PASS
 
@@ -472,8 +732,8 @@ class BleRunner:
             return PASS
 
         self.log.err(f"FAILED: {rel}")
-        if diff.stdout:
-            for line in diff.stdout.rstrip().splitlines():
+        if diff:
+            for line in diff.rstrip().splitlines():
                 self.log.inf(line)
         return FAILED
 
@@ -481,14 +741,36 @@ class BleRunner:
     # Driver
     # ------------------------------------------------------------------
 
-    def run(self, cases: list[Path], parallel: int = 1) -> list[CaseResult]:
-        results: list[CaseResult] = []
-        if parallel <= 1:
-            for case in cases:
-                results.append(self.run_case(case))
-        else:
-            with ThreadPoolExecutor(max_workers=parallel) as pool:
-                results = list(pool.map(self.run_case, cases))
+    def run(
+        self, cases: list[Path], parallel: int = 1, build_parallel: int | None = None
+    ) -> list[CaseResult]:
+        """Run `cases` as a two-stage pipeline: `build_parallel` (default:
+        `parallel`) build slots sharing the CPUs through ninja -j, and
+        `parallel` simulation slots that pick up each case as soon as its
+        binaries are staged, so simulations overlap the remaining builds."""
+        parallel = max(1, parallel)
+        build_parallel = max(1, build_parallel or parallel)
+        self.ninja_jobs = math.ceil((os.cpu_count() or 1) / build_parallel)
+        self.log.inf(
+            f"[*] {build_parallel} build slot(s) (ninja -j{self.ninja_jobs}), "
+            f"{parallel} simulation slot(s)"
+        )
+
+        with (
+            ThreadPoolExecutor(build_parallel, thread_name_prefix="ble-build") as builds,
+            ThreadPoolExecutor(parallel, thread_name_prefix="ble-sim") as sims,
+        ):
+            try:
+                built = [builds.submit(self.build_case, case) for case in cases]
+                simulated = [
+                    sims.submit(self.simulate_case, f.result()) for f in as_completed(built)
+                ]
+                results = [f.result() for f in simulated]
+            except BaseException:
+                # A build error is fatal for the run: drop the queued work.
+                builds.shutdown(cancel_futures=True)
+                sims.shutdown(cancel_futures=True)
+                raise
 
         # Aggregate summary (parity with the bash pass-fail.log).
         tests_dir = self.build_root / "tests"
@@ -499,5 +781,8 @@ class BleRunner:
 
         self.log.inf("[*] Summary:")
         for r in sorted(results, key=lambda r: r.rel):
-            self.log.inf(f"    {r.status}: {r.rel}")
+            self.log.inf(f"    {r.status}: {r.rel} ({r.sim_time:.2f}s simulated)")
+        if results:
+            longest = max(results, key=lambda r: r.sim_time)
+            self.log.inf(f"[*] Longest simulation: {longest.rel} ({longest.sim_time:.2f}s)")
         return results
@@ -15,6 +15,9 @@ The lower-level pieces stay available for exotic cases:
 - `studio_requests.hex` (one hex-encoded framed Request per line, `#`
   comments allowed) is the escape-hatch case file for byte-exact payloads
   the JSON mapping cannot express;
+- `render_requests_file()` packs framed payloads into the binary file the
+  prebuilt host app loads at runtime (`-requests_file=<path>`): each request
+  is a little-endian u16 length followed by that many framed bytes;
 - the programmatic API (`generator_main()` / `render_hex()` /
   `load_workspace_studio_pb2()` / `compile_protos` / `frame`) lets a script
   build Request protos in Python and emit that hex file.
@@ -27,6 +30,7 @@ import base64
 import importlib
 import json
 import os
+import struct
 import sys
 from pathlib import Path
 
@@ -54,28 +58,24 @@ __all__ = [
     "compile_module_protos",
     "load_requests_json",
     "render_hex",
+    "framed_payloads",
+    "render_requests_file",
+    "parse_hex_file",
     "generator_main",
 ]
 
 
 def load_workspace_studio_pb2():
     """Compile + import zmk-studio-messages' studio_pb2 from the enclosing
-    west workspace (resolved via the west manifest, with a recursive-search
-    fallback)."""
-    from west.util import west_topdir
+    west workspace (resolved via the cached workspace index, with a
+    recursive-search fallback)."""
+    # scripts/ is importable under west; add it for a standalone generator.
+    scripts_dir = str(Path(__file__).resolve().parents[2])
+    if scripts_dir not in sys.path:
+        sys.path.append(scripts_dir)
+    from lib import workspace_index
 
-    topdir = Path(west_topdir())
-    try:
-        from west.manifest import Manifest
-
-        for project in Manifest.from_topdir().projects:
-            if project.name == "zmk-studio-messages":
-                candidate = Path(project.abspath) / "proto" / "zmk"
-                if candidate.is_dir():
-                    return load_studio_pb2(candidate)
-    except Exception:
-        pass
-    return load_studio_pb2(find_studio_proto_dir(topdir))
+    return load_studio_pb2(workspace_index.load().studio_proto_dir(find_studio_proto_dir))
 
 
 def compile_module_protos(module_dir: Path) -> None:
@@ -202,6 +202,22 @@ def render_hex(requests) -> str:
     return "\n".join(lines) + "\n"
 
 
+def framed_payloads(requests) -> list[bytes]:
+    """The framed (SOF/ESC/EOF) bytes of each request, in send order."""
+    return [frame(req.SerializeToString()) for _, req in _normalize(requests)]
+
+
+def render_requests_file(payloads: list[bytes]) -> bytes:
+    """Pack framed payloads into the runtime requests file ble-studio-host
+    reads via `-requests_file=`: `<u16 LE length><framed bytes>` per request."""
+    blob = bytearray()
+    for payload in payloads:
+        if len(payload) > 0xFFFF:
+            raise ValueError(f"framed request of {len(payload)} bytes exceeds 65535")
+        blob += struct.pack("<H", len(payload)) + payload
+    return bytes(blob)
+
+
 def parse_hex_file(path: Path) -> list[bytes]:
     """Parse a studio_requests.hex file into framed payload byte strings
     (used by ble-studio-host's hex2inc.py and available for tests)."""
@@ -0,0 +1,139 @@
+"""Content-addressed firmware artifact cache for `west zmk-build`.
+
+A cache entry is keyed on everything that decides what a matrix entry
+produces: the full `west build` invocation (board, shield, snippets,
+cmake-args -- minus the per-artifact build dir and pristine setting), the
+file contents of the zmk-config and every extra module tree, and the checked
+out ZMK / Zephyr revisions from the west manifest. A hit copies the cached
+firmware files straight into the artifact's `zephyr/` dir without invoking
+CMake at all.
+
+Local, uncommitted edits inside the zmk / zephyr projects themselves are not
+part of the key (only their HEAD revision is) -- drop the cache dir, or build
+without `--build-cache`, when hacking on ZMK itself.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# Files restored on a cache hit, relative to `<build dir>/zephyr`.
+CACHED_FILES = ["zmk.uf2", "zmk.hex", "zmk.bin", "zmk.elf", ".config"]
+
+# Directory names never descended into when hashing a module / config tree:
+# VCS metadata, west workspaces nested in the module, and build outputs
+# (which would otherwise make every build change its own key).
+SKIPPED_DIRS = {"build", "dependencies", "__pycache__", "node_modules"}
+
+# west projects whose checked-out revision is part of the key.
+REVISION_PROJECTS = ["zmk", "zephyr"]
+
+
+def hash_tree(root: Path) -> str:
+    """sha256 over the relative paths and contents of every file under
+    `root` (hidden and SKIPPED_DIRS directories excluded)."""
+    root = Path(root)
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            d for d in dirnames if not d.startswith(".") and d not in SKIPPED_DIRS
+        )
+        for filename in sorted(filenames):
+            path = Path(dirpath) / filename
+            if not path.is_file():
+                continue
+            h.update(path.relative_to(root).as_posix().encode())
+            h.update(b"\0")
+            file_hash = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    file_hash.update(chunk)
+            h.update(file_hash.digest())
+    return h.hexdigest()
+
+
+class BuildCache:
+    """Thread-safe artifact cache shared by all matrix entries of a run.
+
+    Tree hashes and project revisions are computed once per run and reused
+    by every entry, so a 20-target matrix over the same zmk-config hashes it
+    only once.
+    """
+
+    def __init__(self, cache_dir: Path, manifest):
+        self.cache_dir = Path(cache_dir)
+        self.manifest = manifest
+        self._lock = threading.Lock()
+        self._tree_hashes: dict[str, str] = {}
+        self._revisions: dict[str, str] | None = None
+
+    def _tree_hash(self, root: str) -> str:
+        with self._lock:
+            if root not in self._tree_hashes:
+                self._tree_hashes[root] = hash_tree(Path(root))
+            return self._tree_hashes[root]
+
+    def revisions(self) -> dict[str, str]:
+        with self._lock:
+            if self._revisions is None:
+                self._revisions = {}
+                for project in self.manifest.projects:
+                    if project.name not in REVISION_PROJECTS:
+                        continue
+                    try:
+                        self._revisions[project.name] = project.sha("HEAD")
+                    except Exception:
+                        # Not cloned / not a git checkout: fall back to the
+                        # manifest revision so the key is still deterministic.
+                        self._revisions[project.name] = project.revision
+            return self._revisions
+
+    def key(self, command: list[str], trees: list[str]) -> tuple[str, dict]:
+        """Return (key, inputs) for a build. `command` must already have the
+        per-artifact build dir and pristine flag stripped."""
+        inputs = {
+            "command": command,
+            "trees": {tree: self._tree_hash(tree) for tree in sorted(set(trees))},
+            "revisions": self.revisions(),
+        }
+        encoded = json.dumps(inputs, sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest(), inputs
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def restore(self, key: str, zephyr_dir: Path) -> bool:
+        """Copy a cached entry into `zephyr_dir`. Returns False on a miss."""
+        entry = self._entry_dir(key)
+        if not (entry / "inputs.json").is_file():
+            return False
+        os.makedirs(zephyr_dir, exist_ok=True)
+        for name in CACHED_FILES:
+            if (entry / name).is_file():
+                shutil.copy2(entry / name, Path(zephyr_dir) / name)
+        return True
+
+    def store(self, key: str, inputs: dict, zephyr_dir: Path) -> None:
+        """Save the firmware files of a successful build under `key`. The
+        entry is staged in a temp dir and renamed into place, so a concurrent
+        reader never sees a half-written entry."""
+        entry = self._entry_dir(key)
+        if entry.is_dir():
+            return
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=entry.parent, prefix=f".{key[:8]}-"))
+        try:
+            for name in CACHED_FILES:
+                if (Path(zephyr_dir) / name).is_file():
+                    shutil.copy2(Path(zephyr_dir) / name, staging / name)
+            with open(staging / "inputs.json", "w") as f:
+                json.dump(inputs, f, indent=2, sort_keys=True)
+            os.replace(staging, entry)
+        except OSError:
+            # Lost a race with another writer (entry now exists) or the cache
+            # dir is not writable -- caching is best effort either way.
+            shutil.rmtree(staging, ignore_errors=True)
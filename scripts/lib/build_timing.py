@@ -0,0 +1,178 @@
+"""Per-target timing telemetry for `west zmk-build`.
+
+Each matrix entry records how long it sat in the thread pool queue, its
+total wall time, and a split of that wall time into:
+
+- configure: everything outside Ninja (west itself, the CMake configure with
+  its devicetree / Kconfig steps),
+- compile: the Ninja run minus the link steps,
+- link: the Ninja steps producing `.elf` files,
+
+where the Ninja part is read from the entries `.ninja_log` gained during
+this build. The whole run is written as JSON and summarised as a table with
+the critical path: the targets that ran back to back on the worker thread
+that finished last, i.e. the chain that decided the total time.
+
+The wall times of real (non-cached, successful) builds also feed a small
+per-artifact duration history, used to start the longest builds first.
+"""
+
+import json
+from pathlib import Path
+
+NINJA_LOG = ".ninja_log"
+HISTORY_FILE = ".zmk-build-durations.json"
+# Weight of the newest measurement in the exponential moving average.
+HISTORY_WEIGHT = 0.5
+
+
+def ninja_log_offset(build_dir: Path) -> tuple[int, int]:
+    """(inode, size) of the build's .ninja_log; entries appended past it
+    belong to the next build."""
+    try:
+        stat = (Path(build_dir) / NINJA_LOG).stat()
+        return stat.st_ino, stat.st_size
+    except OSError:
+        return 0, 0
+
+
+def ninja_phases(build_dir: Path, offset: tuple[int, int]) -> tuple[float, float]:
+    """(ninja span, link time) in seconds from the .ninja_log entries
+    written after `offset` (the whole log if a pristine build recreated it)."""
+    path = Path(build_dir) / NINJA_LOG
+    try:
+        stat = path.stat()
+        same_log = stat.st_ino == offset[0] and stat.st_size >= offset[1]
+        with open(path, "r") as f:
+            f.seek(offset[1] if same_log else 0)
+            lines = f.read().splitlines()
+    except OSError:
+        return 0.0, 0.0
+
+    starts, ends, link_ms = [], [], 0
+    for line in lines:
+        if line.startswith("#"):
+            continue
+        fields = line.split("\t")
+        if len(fields) < 4:
+            continue
+        try:
+            start, end = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        starts.append(start)
+        ends.append(end)
+        if fields[3].endswith(".elf"):
+            link_ms += end - start
+    if not starts:
+        return 0.0, 0.0
+    return (max(ends) - min(starts)) / 1000, link_ms / 1000
+
+
+def split_phases(wall: float, ninja_span: float, link: float) -> dict[str, float]:
+    configure = max(0.0, wall - ninja_span)
+    return {
+        "configure": configure,
+        "compile": max(0.0, ninja_span - link),
+        "link": link,
+    }
+
+
+def critical_path(timings: list[dict]) -> list[dict]:
+    """Entries of the worker thread that finished last, in run order."""
+    if not timings:
+        return []
+    last = max(timings, key=lambda t: t["end"])
+    return sorted((t for t in timings if t["worker"] == last["worker"]), key=lambda t: t["start"])
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m{seconds % 60:04.1f}s"
+    return f"{seconds:.1f}s"
+
+
+def _format_rss(peak_rss: int | None) -> str:
+    return f"{peak_rss / (1 << 20):.0f}MiB" if peak_rss else "-"
+
+
+def summary_lines(timings: list[dict], makespan: float) -> list[str]:
+    header = ["id", "artifact", "queue", "configure", "compile", "link", "total", "peak RSS"]
+    rows = [
+        [
+            str(t["id"]),
+            t["artifact"],
+            _format_seconds(t["queue_wait"]),
+            _format_seconds(t["configure"]),
+            _format_seconds(t["compile"]),
+            _format_seconds(t["link"]),
+            _format_seconds(t["wall"]),
+            _format_rss(t["peak_rss"]),
+        ]
+        for t in sorted(timings, key=lambda t: t["wall"], reverse=True)
+    ]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = [
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in [header] + rows
+    ]
+
+    path = critical_path(timings)
+    if path:
+        lines.append(
+            f"Critical path ({_format_seconds(makespan)} total): "
+            + " -> ".join(
+                f"[{t['id']}] {t['artifact']} ({_format_seconds(t['wall'])})" for t in path
+            )
+        )
+    return lines
+
+
+def write_json(path: Path, timings: list[dict], makespan: float, parallelism: int) -> None:
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "makespan": makespan,
+                "parallelism": parallelism,
+                "critical_path": [t["id"] for t in critical_path(timings)],
+                "targets": sorted(timings, key=lambda t: t["id"]),
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_history(build_root: Path) -> dict[str, float]:
+    try:
+        with open(Path(build_root) / HISTORY_FILE, "r") as f:
+            history = json.load(f)
+        return {k: float(v) for k, v in history.items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def update_history(build_root: Path, timings: list[dict]) -> None:
+    history = load_history(build_root)
+    for t in timings:
+        if t["cached"] or not t["success"]:
+            continue
+        previous = history.get(t["artifact"])
+        history[t["artifact"]] = (
+            t["wall"]
+            if previous is None
+            else HISTORY_WEIGHT * t["wall"] + (1 - HISTORY_WEIGHT) * previous
+        )
+    Path(build_root).mkdir(parents=True, exist_ok=True)
+    with open(Path(build_root) / HISTORY_FILE, "w") as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+
+
+def longest_first(artifacts: list[str], history: dict[str, float]) -> list[int]:
+    """Indexes of `artifacts` ordered by expected duration, longest first
+    (LPT scheduling). Artifacts without history go first, in their original
+    order, since they may well be the longest."""
+    return sorted(
+        range(len(artifacts)),
+        key=lambda i: -history.get(artifacts[i], float("inf")),
+    )
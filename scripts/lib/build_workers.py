@@ -0,0 +1,243 @@
+"""Coordinator / worker protocol for `west zmk-build --serve` and `--worker`.
+
+The coordinator owns the build matrix and hands entries out one at a time to
+whichever worker connection asks next, so fast machines simply take more
+entries. Workers build in their own west workspace and stream back the build
+output while it runs, then the firmware files and the result.
+
+Transport is `multiprocessing.connection` (TCP `host:port` or a Unix socket
+path) with its HMAC challenge on connect, keyed by $ZMK_BUILD_AUTHKEY. The
+key is required for TCP: a coordinator accepts firmware files from its
+workers, and a worker builds with the coordinator's cmake args. A Unix socket
+is guarded by its file permissions and falls back to a fixed key. Every
+message is a JSON frame, optionally followed by one raw bytes frame (file
+contents); nothing is unpickled, so a peer can't make the other side run code.
+
+A worker connection that drops mid-build puts its entry back at the front of
+the queue for the next worker. The coordinator stops waiting once no worker
+has been connected for its idle timeout.
+"""
+
+import collections
+import json
+import os
+import socket
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+AUTHKEY_ENV = "ZMK_BUILD_AUTHKEY"
+DEFAULT_AUTHKEY = b"zmk-build"
+
+
+def parse_address(address: str):
+    """`host:port` -> ("host", port) for TCP, anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def authkey(address: str) -> bytes:
+    """The connection key for `address`. Raises ValueError for a TCP address
+    without $ZMK_BUILD_AUTHKEY, since anyone could use the default key."""
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode()
+    if isinstance(parse_address(address), tuple):
+        raise ValueError(f"{AUTHKEY_ENV} must be set to use the TCP address {address}")
+    return DEFAULT_AUTHKEY
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Channel:
+    """A connection whose sends may come from several threads (e.g. the
+    stdout and stderr readers of a build)."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, address: str) -> "Channel":
+        return cls(Client(parse_address(address), authkey=authkey(address)))
+
+    def send(self, message: dict, payload: bytes | None = None) -> None:
+        with self._lock:
+            self.conn.send_bytes(json.dumps({**message, "payload": payload is not None}).encode())
+            if payload is not None:
+                self.conn.send_bytes(payload)
+
+    def recv(self) -> tuple[dict, bytes | None]:
+        message = json.loads(self.conn.recv_bytes())
+        payload = self.conn.recv_bytes() if message.pop("payload", False) else None
+        return message, payload
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class LogStream:
+    """File-like target for TeePopen that forwards a build's output."""
+
+    def __init__(self, channel: Channel, id: int):
+        self.channel = channel
+        self.id = id
+
+    def write(self, text: str) -> None:
+        self.channel.send({"type": "log", "id": self.id, "text": text})
+
+    def flush(self) -> None:
+        pass
+
+
+class Coordinator:
+    """Serves `order` (matrix ids) to workers.
+
+    `jobs[id]` is sent to the worker as the build request; `options` once per
+    connection. `on_message(id, message, payload)` is called for every
+    "dispatched" (added by the coordinator, with the worker name), "log" and
+    "artifact" message of an entry.
+    """
+
+    def __init__(self, address: str, order: list[int], jobs: dict, options: dict, on_message):
+        self.listener = Listener(parse_address(address), authkey=authkey(address))
+        self.jobs = jobs
+        self.options = options
+        self.on_message = on_message
+        self._queue = collections.deque(order)
+        self._total = len(order)
+        self._results: dict[int, dict] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        # Worker connections past their handshake
+        self._workers = 0
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def run(self, idle_timeout: float | None = None) -> list[dict]:
+        """Block until every entry has a result, in completion order. With
+        `idle_timeout`, give up once no worker has been connected for that
+        many seconds (none came, or all dropped); entries without a result
+        are then missing from the list."""
+        threading.Thread(target=self._accept, daemon=True).start()
+        with self._cond:
+            idle_since = time.monotonic()
+            while len(self._results) < self._total:
+                if self._workers:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.monotonic()
+                timeout = None
+                if idle_timeout is not None and idle_since is not None:
+                    timeout = idle_since + idle_timeout - time.monotonic()
+                    if timeout <= 0:
+                        break
+                self._cond.wait(timeout)
+            self._closed = True
+        self.listener.close()
+        return list(self._results.values())
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                if self._closed:
+                    return
+                continue
+            threading.Thread(target=self._serve_worker, args=(Channel(conn),), daemon=True).start()
+
+    def _serve_worker(self, channel: Channel) -> None:
+        try:
+            hello, _ = channel.recv()
+            channel.send({"type": "options", "options": self.options})
+        except (EOFError, OSError, ValueError):
+            channel.close()
+            return
+        name = hello.get("name", "?")
+        with self._cond:
+            self._workers += 1
+            self._cond.notify_all()
+        try:
+            self._serve_entries(channel, name)
+        finally:
+            with self._cond:
+                self._workers -= 1
+                self._cond.notify_all()
+
+    def _serve_entries(self, channel: Channel, name: str) -> None:
+        while True:
+            with self._cond:
+                if not self._queue:
+                    break
+                id = self._queue.popleft()
+            try:
+                self.on_message(id, {"type": "dispatched", "worker": name}, None)
+                channel.send({"type": "build", "id": id, **self.jobs[id]})
+                while True:
+                    message, payload = channel.recv()
+                    if message["type"] == "result":
+                        break
+                    self.on_message(id, message, payload)
+            except (EOFError, OSError, ValueError):
+                # Worker died or went away: let another one build the entry.
+                with self._cond:
+                    self._queue.appendleft(id)
+                    self._cond.notify_all()
+                channel.close()
+                return
+            with self._cond:
+                self._results[id] = {**message["result"], "worker": name}
+                self._cond.notify_all()
+        try:
+            channel.send({"type": "done"})
+        except OSError:
+            pass
+        channel.close()
+
+
+def work(address: str, parallelism: int, build) -> int:
+    """Connect `parallelism` worker loops to the coordinator at `address`.
+
+    `build(channel, options, request) -> result` builds one entry and may
+    send "log" and "artifact" messages on the channel meanwhile. Returns the
+    number of entries built once the coordinator runs out of work (or goes
+    away).
+    """
+    channels = [Channel.connect(address) for _ in range(parallelism)]
+    options = {}
+    for channel in channels:
+        channel.send({"type": "hello", "name": worker_name()})
+        message, _ = channel.recv()
+        options = message["options"]
+
+    built = []
+
+    def loop(channel: Channel) -> None:
+        try:
+            while True:
+                request, _ = channel.recv()
+                if request["type"] != "build":
+                    return
+                result = build(channel, options, request)
+                channel.send({"type": "result", "result": result})
+                built.append(request["id"])
+        except (EOFError, OSError):
+            return
+        finally:
+            channel.close()
+
+    threads = [threading.Thread(target=loop, args=(channel,)) for channel in channels]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(built)
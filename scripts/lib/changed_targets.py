@@ -0,0 +1,139 @@
+"""Map changed files to the build matrix entries they affect, for
+`west zmk-build --changed-only <git-rev>`.
+
+Files are classified by where they live in a zmk-config / module tree:
+
+- `config/<name>.{keymap,conf,overlay,...}`: the entries whose board or
+  shield is `<name>` (split shields also match their base name, so
+  `config/corne.keymap` affects `corne_left` and `corne_right`),
+- `boards/shields/<dir>/...`: the entries whose shield starts with `<dir>`,
+- `boards/.../<board>/...`: the entries building `<board>` (for both, every
+  entry when none matches, e.g. for a file other shields include),
+- `snippets/<name>/...`: the entries using snippet `<name>`,
+- Markdown and `.github/` files, and files outside the zmk-config and
+  extra module trees: nothing.
+
+Anything else (module sources, bindings, Kconfig, CMake files, build.yaml,
+west.yml, or a config file no entry claims) affects every entry. The
+mapping errs towards building too much rather than skipping a target whose
+firmware changed.
+"""
+
+import subprocess
+from pathlib import Path
+
+IGNORED_SUFFIXES = {".md"}
+IGNORED_DIRS = {".github"}
+
+
+class ChangedFilesError(Exception):
+    """The changed files of a repository could not be determined."""
+
+
+def changed_files(dirs: list[Path], rev: str) -> list[Path]:
+    """Absolute paths of files differing from `rev` (committed, staged,
+    unstaged or untracked) in the git repositories containing `dirs`."""
+    tops = set()
+    for d in dirs:
+        proc = subprocess.run(
+            ["git", "rev-parse", "--show-toplevel"],
+            cwd=str(d),
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            raise ChangedFilesError(f"{d} is not inside a git repository")
+        tops.add(Path(proc.stdout.strip()))
+
+    files = []
+    for top in sorted(tops):
+        for command in (
+            ["git", "diff", "--name-only", rev, "--"],
+            ["git", "ls-files", "--others", "--exclude-standard"],
+        ):
+            proc = subprocess.run(command, cwd=str(top), capture_output=True, text=True)
+            if proc.returncode != 0:
+                raise ChangedFilesError(
+                    f"{' '.join(command)} failed in {top}: {proc.stderr.strip()}"
+                )
+            files += [top / line for line in proc.stdout.splitlines() if line]
+    return files
+
+
+def _name_candidates(name: str) -> set[str]:
+    """`corne_left` -> {"corne_left", "corne"}."""
+    parts = name.split("_")
+    return {"_".join(parts[:i]) for i in range(1, len(parts) + 1)}
+
+
+def _board_name(board: str) -> str:
+    """`xiao_ble//zmk` -> `xiao_ble`."""
+    return board.split("/")[0]
+
+
+def _shields(entry: dict) -> list[str]:
+    return (entry.get("shield") or "").split()
+
+
+def _owner(path: Path, roots: list[Path]) -> tuple[Path, Path] | None:
+    for root in sorted(roots, key=lambda r: len(r.parts), reverse=True):
+        try:
+            return root, path.relative_to(root)
+        except ValueError:
+            continue
+    return None
+
+
+def affected_entries(
+    entries: list[dict],
+    snippets: list[list[str]],
+    files: list[Path],
+    config_dir: Path,
+    roots: list[Path],
+) -> set[int]:
+    """Indexes of `entries` affected by `files`. `snippets[i]` are the
+    snippets entry i builds with; `roots` are the zmk-config and extra
+    module directories."""
+    config_dir = Path(config_dir).absolute()
+    everything = set(range(len(entries)))
+    affected: set[int] = set()
+
+    def matching(predicate) -> set[int]:
+        return {i for i, entry in enumerate(entries) if predicate(i, entry)}
+
+    for path in files:
+        path = Path(path).absolute()
+        if path.suffix in IGNORED_SUFFIXES or IGNORED_DIRS & set(path.parts):
+            continue
+
+        if path.parent == config_dir:
+            stem = path.name.split(".")[0]
+            hits = matching(
+                lambda i, e: (
+                    stem == _board_name(e["board"])
+                    or any(stem in _name_candidates(s) for s in _shields(e))
+                )
+            )
+            affected |= hits or everything
+            continue
+
+        owner = _owner(path, [config_dir.parent, *map(Path, roots)])
+        if owner is None:
+            # Elsewhere in the same repository, e.g. a zmk-config kept in a subdir.
+            continue
+        parts = owner[1].parts
+        if "shields" in parts[:-1] and "boards" in parts:
+            shield_dir = parts[parts.index("shields") + 1]
+            hits = matching(lambda i, e: any(s.startswith(shield_dir) for s in _shields(e)))
+            affected |= hits or everything
+        elif parts and parts[0] == "boards" and len(parts) > 1:
+            hits = matching(lambda i, e: _board_name(e["board"]) in parts[1:-1])
+            affected |= hits or everything
+        elif parts and parts[0] == "snippets" and len(parts) > 2:
+            affected |= matching(lambda i, e: parts[1] in snippets[i])
+        else:
+            affected |= everything
+
+        if affected == everything:
+            break
+    return affected
@@ -0,0 +1,13 @@
+# Included first by every project() call of a `west zmk-build --shared-configure`
+# follower (CMAKE_PROJECT_INCLUDE_BEFORE). Copies the compiler identification
+# of the group leader's build into this build dir before project() enables the
+# languages. With CMAKE_PLATFORM_INFO_INITIALIZED set, CMake then loads those
+# files instead of identifying and testing the compilers again; without files
+# for this CMake version it identifies them as usual.
+set(_zmk_platform_info_dir "${CMAKE_BINARY_DIR}/CMakeFiles/${CMAKE_VERSION}")
+foreach(_zmk_file CMakeSystem.cmake CMakeCCompiler.cmake CMakeCXXCompiler.cmake CMakeASMCompiler.cmake)
+  set(_zmk_source "${ZMK_COMPILER_INFO_DIR}/${CMAKE_VERSION}/${_zmk_file}")
+  if(EXISTS "${_zmk_source}" AND NOT EXISTS "${_zmk_platform_info_dir}/${_zmk_file}")
+    file(COPY "${_zmk_source}" DESTINATION "${_zmk_platform_info_dir}")
+  endif()
+endforeach()
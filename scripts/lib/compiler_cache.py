@@ -0,0 +1,143 @@
+"""ccache / sccache integration for `west zmk-build --compiler-cache`.
+
+Every matrix entry compiles largely the same Zephyr and ZMK sources, so one
+compiler cache shared by all entries (and all runs) turns most of a
+`-p always` rebuild into cache hits. The cache lives under
+`<west topdir>/.cache/` unless CCACHE_DIR / SCCACHE_DIR is already set.
+
+Hit rates: ccache writes a per-artifact stats log (CCACHE_STATSLOG), so each
+artifact gets its own numbers. sccache only keeps server-wide counters, so
+only the run total is reported for it.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+CCACHE_HITS = {
+    "direct_cache_hit",
+    "preprocessed_cache_hit",
+    "cache hit (direct)",
+    "cache hit (preprocessed)",
+}
+CCACHE_MISSES = {"cache_miss", "cache miss"}
+
+
+def parse_ccache_stats_log(path: Path) -> tuple[int, int]:
+    """(hits, misses) from a CCACHE_STATSLOG file (ccache 3 and 4 formats)."""
+    hits = misses = 0
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line in CCACHE_HITS:
+                hits += 1
+            elif line in CCACHE_MISSES:
+                misses += 1
+    return hits, misses
+
+
+def format_hit_rate(hits: int, misses: int) -> str:
+    total = hits + misses
+    if total == 0:
+        return "no compilations"
+    return f"{hits}/{total} hits ({100 * hits / total:.1f}%)"
+
+
+class CompilerCache:
+    STATS_LOG = "ccache-stats.log"
+
+    def __init__(self, kind: str, topdir: Path):
+        self.kind = kind
+        self.topdir = Path(topdir)
+        self.executable = shutil.which(kind)
+        self.env = {}
+        if kind == "ccache":
+            self.env["CCACHE_DIR"] = os.environ.get(
+                "CCACHE_DIR", str(self.topdir / ".cache" / "ccache")
+            )
+            # Hash paths relative to the workspace and ignore the build dir,
+            # so entries with different artifact dirs share cache hits.
+            self.env["CCACHE_BASEDIR"] = str(self.topdir)
+            self.env["CCACHE_NOHASHDIR"] = "1"
+        elif kind == "sccache":
+            self.env["SCCACHE_DIR"] = os.environ.get(
+                "SCCACHE_DIR", str(self.topdir / ".cache" / "sccache")
+            )
+            self.env["SCCACHE_BASEDIRS"] = str(self.topdir)
+        self._sccache_baseline = None
+
+    def cmake_args(self) -> list[str]:
+        if self.kind == "ccache":
+            # Zephyr wires ccache up itself (RULE_LAUNCH_COMPILE) when enabled.
+            return ["-DUSE_CCACHE=1"]
+        if self.kind == "sccache":
+            return [
+                "-DUSE_CCACHE=0",
+                f"-DCMAKE_C_COMPILER_LAUNCHER={self.executable}",
+                f"-DCMAKE_CXX_COMPILER_LAUNCHER={self.executable}",
+            ]
+        return ["-DUSE_CCACHE=0"]
+
+    def build_env(self, build_dir: Path) -> dict[str, str]:
+        """Environment for one artifact's `west build`."""
+        env = os.environ.copy()
+        env.update(self.env)
+        if self.kind == "ccache":
+            stats_log = Path(build_dir) / self.STATS_LOG
+            if stats_log.exists():
+                stats_log.unlink()
+            env["CCACHE_STATSLOG"] = str(stats_log)
+        return env
+
+    def begin(self) -> None:
+        if self.kind == "ccache":
+            os.makedirs(self.env["CCACHE_DIR"], exist_ok=True)
+        elif self.kind == "sccache":
+            os.makedirs(self.env["SCCACHE_DIR"], exist_ok=True)
+            # Start the server ourselves so it picks up SCCACHE_DIR.
+            subprocess.run(
+                [self.executable, "--start-server"],
+                env={**os.environ, **self.env},
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            self._sccache_baseline = self._sccache_counts()
+
+    def artifact_stats(self, build_dir: Path) -> tuple[int, int] | None:
+        stats_log = Path(build_dir) / self.STATS_LOG
+        if self.kind != "ccache" or not stats_log.exists():
+            return None
+        return parse_ccache_stats_log(stats_log)
+
+    def total_stats(self, artifact_stats: list[tuple[int, int]]) -> tuple[int, int] | None:
+        if self.kind == "ccache":
+            return (sum(s[0] for s in artifact_stats), sum(s[1] for s in artifact_stats))
+        if self.kind == "sccache" and self._sccache_baseline is not None:
+            counts = self._sccache_counts()
+            if counts is None:
+                return None
+            return (
+                counts[0] - self._sccache_baseline[0],
+                counts[1] - self._sccache_baseline[1],
+            )
+        return None
+
+    def _sccache_counts(self) -> tuple[int, int] | None:
+        proc = subprocess.run(
+            [self.executable, "--show-stats", "--stats-format", "json"],
+            env={**os.environ, **self.env},
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            return None
+        try:
+            stats = json.loads(proc.stdout)["stats"]
+            return (
+                sum(stats["cache_hits"]["counts"].values()),
+                sum(stats["cache_misses"]["counts"].values()),
+            )
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+            return None
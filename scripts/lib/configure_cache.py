@@ -0,0 +1,223 @@
+"""Shared CMake configure results for `west zmk-build --shared-configure`.
+
+Matrix entries on the same board (e.g. corne_left / corne_right / a tester
+shield) each redo Zephyr's whole CMake configure. The devicetree and Kconfig
+steps depend on the shield and must run per entry, but locating the Zephyr
+SDK (the toolchain variant and SDK directory), resolving the board directory
+and CMake's compiler identification (identifying, ABI-probing and testing the
+C, C++ and assembler compilers found in the SDK) only depend on the board,
+the board roots and extra modules, and the toolchain environment.
+
+This module groups entries by exactly those inputs: the board, the extra
+modules, the environment variables in KEY_ENV and every `-D` argument of
+KEY_VARIABLES. The first entry of a group (the leader) configures normally;
+the rest of the group waits for it and is then configured with the leader's
+results:
+
+- the lookups are passed as `-D` cache seeds, so Zephyr skips them (it still
+  runs list_boards.py for the seeded board dir only),
+- the leader's `CMakeFiles/<cmake version>/CMake*Compiler.cmake` and
+  `CMakeSystem.cmake` are kept in a stash dir, and cmake/reuse_compiler_info.cmake
+  copies them into the follower's build dir before project() enables the
+  languages, so CMake loads them instead of identifying the compilers again.
+
+The seeds and the stash are persisted next to the build dirs, so later runs
+need no leader at all.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+# CMake cache variables copied from the leader's CMakeCache.txt. Each is a
+# lookup result Zephyr skips when the variable is already defined.
+SEED_VARIABLES = ["ZEPHYR_TOOLCHAIN_VARIANT", "ZEPHYR_SDK_INSTALL_DIR", "BOARD_DIR"]
+
+# CMake's compiler identification results, under `CMakeFiles/<cmake version>`.
+COMPILER_INFO_FILES = [
+    "CMakeSystem.cmake",
+    "CMakeCCompiler.cmake",
+    "CMakeCXXCompiler.cmake",
+    "CMakeASMCompiler.cmake",
+]
+
+# Copies a stashed compiler identification into a follower's build dir.
+REUSE_COMPILER_INFO = Path(__file__).resolve().parent / "cmake" / "reuse_compiler_info.cmake"
+
+# The seeds holding paths; persisted seeds are dropped once these vanish.
+PATH_SEED_VARIABLES = [
+    "ZEPHYR_SDK_INSTALL_DIR",
+    "BOARD_DIR",
+    "ZMK_COMPILER_INFO_DIR",
+    "CMAKE_PROJECT_INCLUDE_BEFORE",
+]
+
+# CMake variables that change what the toolchain and board lookups resolve
+# to. ZMK adds ZMK_CONFIG's boards to the board roots.
+KEY_VARIABLES = [
+    *SEED_VARIABLES,
+    "BOARD",
+    "BOARD_ROOT",
+    "ZMK_CONFIG",
+    "ZMK_EXTRA_MODULES",
+    "ZEPHYR_EXTRA_MODULES",
+    "ZEPHYR_MODULES",
+    "ZEPHYR_BASE",
+    "TOOLCHAIN_ROOT",
+    "CROSS_COMPILE",
+    "GNUARMEMB_TOOLCHAIN_PATH",
+    "CMAKE_C_COMPILER",
+    "CMAKE_CXX_COMPILER",
+    "CMAKE_ASM_COMPILER",
+]
+
+# Environment variables the same lookups read.
+KEY_ENV = [
+    "ZEPHYR_TOOLCHAIN_VARIANT",
+    "ZEPHYR_SDK_INSTALL_DIR",
+    "GNUARMEMB_TOOLCHAIN_PATH",
+    "CROSS_COMPILE",
+    "ZEPHYR_BASE",
+    "ZEPHYR_EXTRA_MODULES",
+    "ZEPHYR_MODULES",
+]
+
+
+def read_cmake_cache(path: Path) -> dict[str, str]:
+    """Parse `NAME:TYPE=VALUE` lines of a CMakeCache.txt."""
+    values = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith(("#", "//")) or "=" not in line:
+                    continue
+                name_type, value = line.split("=", 1)
+                values[name_type.split(":", 1)[0]] = value
+    except OSError:
+        pass
+    return values
+
+
+def _definitions(cmake_args: list[str]) -> list[tuple[str, str]]:
+    """(name, value) of the `-DNAME[:TYPE]=VALUE` / `-D NAME=VALUE` args."""
+    definitions = []
+    args = iter(cmake_args)
+    for arg in args:
+        if arg == "-D":
+            arg = next(args, "")
+        elif arg.startswith("-D"):
+            arg = arg[2:]
+        else:
+            continue
+        name, _, value = arg.partition("=")
+        definitions.append((name.split(":", 1)[0], value))
+    return definitions
+
+
+def group_key(board: str, extra_modules: list[str], cmake_args: list[str]) -> str:
+    """Entries with equal keys resolve the same toolchain, board dir and
+    compilers."""
+    return json.dumps(
+        {
+            "board": board,
+            "extra_modules": sorted(extra_modules),
+            "env": {name: os.environ.get(name, "") for name in KEY_ENV},
+            # In order: a later definition overrides an earlier one.
+            "cmake_args": [
+                [name, value] for name, value in _definitions(cmake_args) if name in KEY_VARIABLES
+            ],
+        },
+        sort_keys=True,
+    )
+
+
+class ConfigureCache:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # Compiler identification stashes, one dir per group.
+        self.stash_dir = self.path.with_suffix("")
+        self._lock = threading.Lock()
+        self._pending: dict[str, threading.Event] = {}
+        try:
+            with open(self.path, "r") as f:
+                self._seeds: dict[str, dict[str, str]] = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self._seeds = {}
+        # Drop persisted seeds pointing at SDKs / boards that no longer exist.
+        for key, seeds in list(self._seeds.items()):
+            if not all(
+                Path(seeds[name]).exists() for name in PATH_SEED_VARIABLES if name in seeds
+            ):
+                del self._seeds[key]
+
+    def plan(self, keys: list[str]) -> list[int]:
+        """Given each matrix entry's group key, return the indexes of the
+        group leaders (first entry of every group without stored seeds).
+        Leaders must be started before their followers."""
+        leaders = []
+        for i, key in enumerate(keys):
+            if key not in self._seeds and key not in self._pending:
+                self._pending[key] = threading.Event()
+                leaders.append(i)
+        return leaders
+
+    def seeds(self, key: str) -> list[str]:
+        """`-D` arguments for a follower; blocks until the group leader is
+        done. Returns [] for groups whose leader failed before configuring."""
+        event = self._pending.get(key)
+        if event is not None:
+            event.wait()
+        with self._lock:
+            return [f"-D{name}={value}" for name, value in self._seeds.get(key, {}).items()]
+
+    def record(self, key: str, build_dir: Path) -> None:
+        """Called by the leader when its build finished (successfully or
+        not): harvest the seeds from its CMakeCache.txt and wake the group."""
+        event = self._pending.get(key)
+        if event is None:
+            return
+        cache = read_cmake_cache(Path(build_dir) / "CMakeCache.txt")
+        seeds = {name: cache[name] for name in SEED_VARIABLES if cache.get(name)}
+        if seeds:
+            seeds.update(self._stash_compiler_info(key, Path(build_dir)))
+        with self._lock:
+            if seeds:
+                self._seeds[key] = seeds
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix(".tmp")
+                with open(tmp, "w") as f:
+                    json.dump(self._seeds, f, indent=2, sort_keys=True)
+                os.replace(tmp, self.path)
+            del self._pending[key]
+        event.set()
+
+    def _stash_compiler_info(self, key: str, build_dir: Path) -> dict[str, str]:
+        """Copy the leader's compiler identification into the group's stash
+        and return the seeds making followers load it (none if the leader
+        did not get that far)."""
+        stash = self.stash_dir / hashlib.sha256(key.encode()).hexdigest()[:16]
+        stashed = False
+        for info_dir in sorted((build_dir / "CMakeFiles").glob("*")):
+            if not (info_dir / "CMakeCCompiler.cmake").is_file():
+                continue
+            target = stash / info_dir.name
+            staging = stash / f".{info_dir.name}.tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir(parents=True)
+            for name in COMPILER_INFO_FILES:
+                if (info_dir / name).is_file():
+                    shutil.copy2(info_dir / name, staging / name)
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(staging, target)
+            stashed = True
+        if not stashed:
+            return {}
+        return {
+            "ZMK_COMPILER_INFO_DIR": str(stash),
+            "CMAKE_PROJECT_INCLUDE_BEFORE": str(REUSE_COMPILER_INFO),
+            "CMAKE_PLATFORM_INFO_INITIALIZED": "1",
+        }
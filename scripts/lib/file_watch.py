@@ -0,0 +1,204 @@
+"""Recursive file watching for the `--watch` modes of zmk-build and zmk-test.
+
+On Linux the trees are watched with inotify through ctypes (one watch per
+directory, new directories are picked up as they appear). Elsewhere, or when
+inotify is unavailable (e.g. the per-user watch limit is exhausted), the
+trees are polled for changed mtimes / sizes once a second.
+
+`Watcher.wait()` blocks until something changes, then keeps collecting until
+the trees have been quiet for the debounce interval, so saving several files
+(or an editor's write-rename dance) triggers one rebuild. When inotify's
+queue overflowed the changes are unknown: the watched roots themselves are
+reported and `Watcher.lost_events()` is true for the batch.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+POLL_INTERVAL = 1.0
+SKIPPED_DIRS = {"__pycache__", "node_modules"}
+
+
+class _Skip:
+    """Hidden directories (.git, ...), caches and the `ignore` trees."""
+
+    def __init__(self, ignore: list[Path]):
+        self.ignore = [Path(p).absolute() for p in ignore]
+
+    def __call__(self, path: Path) -> bool:
+        if path.name.startswith(".") or path.name in SKIPPED_DIRS:
+            return True
+        return any(path == p or p in path.parents for p in self.ignore)
+
+
+def _walk(root: Path, skip: _Skip):
+    """(directory, file names) of the tree under `root`, skipped dirs pruned."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not skip(Path(dirpath) / d)]
+        yield Path(dirpath), filenames
+
+
+class _Inotify:
+    def __init__(self, roots: list[Path], skip: _Skip):
+        self.roots = roots
+        self.skip = skip
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs: dict[int, Path] = {}
+        try:
+            for root in roots:
+                self._add_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_tree(self, root: Path) -> set[Path]:
+        """Watch every directory under `root`; returns the files found."""
+        files = set()
+        for directory, filenames in _walk(root, self.skip):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"inotify_add_watch {directory}: {os.strerror(errno)}")
+            self.dirs[wd] = directory
+            files.update(directory / name for name in filenames)
+        return files
+
+    def read(self, timeout: float | None) -> set[Path]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size : offset + EVENT_HEADER.size + length]
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: report the roots, i.e. "anything".
+                changed.update(self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            name = name.rstrip(b"\0")
+            path = directory / os.fsdecode(name) if name else directory
+            if self.skip(path):
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    changed |= self._add_tree(path)
+                except OSError:
+                    pass
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class _Poll:
+    def __init__(self, roots: list[Path], skip: _Skip):
+        self.roots = roots
+        self.skip = skip
+        self.state = self._scan()
+
+    def _scan(self) -> dict[Path, tuple[int, int]]:
+        state = {}
+        for root in self.roots:
+            for directory, filenames in _walk(root, self.skip):
+                for name in filenames:
+                    path = directory / name
+                    try:
+                        st = path.stat()
+                    except OSError:
+                        continue
+                    state[path] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def read(self, timeout: float | None) -> set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(
+                POLL_INTERVAL if deadline is None else max(0.0, deadline - time.monotonic())
+            )
+            state = self._scan()
+            changed = {
+                path
+                for path in state.keys() | self.state.keys()
+                if state.get(path) != self.state.get(path)
+            }
+            self.state = state
+            if changed or deadline is not None:
+                return changed
+
+    def close(self) -> None:
+        pass
+
+
+class Watcher:
+    def __init__(self, roots: list[Path], ignore: list[Path] = (), debounce: float = 0.3):
+        roots = sorted({Path(r).absolute() for r in roots if Path(r).is_dir()})
+        # Nested roots would be watched twice.
+        self.roots = [r for r in roots if not any(p in r.parents for p in roots)]
+        self.debounce = debounce
+        skip = _Skip(list(ignore))
+        self.backend = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.backend = _Inotify(self.roots, skip)
+            except (OSError, AttributeError):
+                pass
+        self.polling = self.backend is None
+        if self.polling:
+            self.backend = _Poll(self.roots, skip)
+
+    def wait(self) -> set[Path]:
+        """Block until files change; returns the changed (created, written,
+        moved or deleted) paths once the trees are quiet again."""
+        changed = set()
+        while not changed:
+            changed = self.backend.read(None)
+        while True:
+            more = self.backend.read(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def lost_events(self, changed: set[Path]) -> bool:
+        """Whether `changed` from wait() stands for "anything may have
+        changed", because events were lost."""
+        return any(root in changed for root in self.roots)
+
+    def close(self) -> None:
+        self.backend.close()
@@ -0,0 +1,369 @@
+"""native_sim keymap test orchestration for `west zmk-test`.
+
+A Python port of ZMK's `app/run-test.sh`. The script hands every case to
+`xargs -P 4` and builds / runs each one in its own shell; here the cases are
+discovered once and go through a thread pool sized to the cores, each in its
+own build dir under `<build dir>/tests/<case>`.
+
+The per-case pipeline is unchanged, so existing cases give identical results:
+
+    west build -d <build>/tests/<case> --pristine -b native_sim/native/64 \\
+        -- -DCONFIG_ASSERT=y -DZMK_CONFIG=<case> [-DZMK_EXTRA_MODULES=...]
+    zmk.exe | sed -e "s/.*> //" | tee keycode_events_full.log \\
+        | sed -n -f events.patterns > keycode_events.log
+    diff -auZ keycode_events.snapshot keycode_events.log
+
+with the filter and diff evaluated in-process (see `snapshot_eval`).
+
+and `<build>/tests/pass-fail.log` gets the same `PASS: <case>`,
+`FAILED: <case>`, `FAILED: <case> did not build` and `PENDING: <case>` lines.
+
+Cases usually differ only in their keymap, so by default they don't each
+configure Zephyr from scratch: cases with the same `native_sim.conf` (and
+extra modules) form a group, and each group keeps configured build trees
+under `<build>/tests/.shared/`, at most one per worker. A case borrows a free
+tree of its group, stages its keymap and conf into the tree's ZMK_CONFIG dir
+and builds incrementally; the tree is reconfigured from scratch only when it
+is new, its configuration changed, or its last build failed. Cases carrying
+other files (overlays, boards, ...) keep a pristine build of their own.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from lib import test_impact
+from lib.snapshot_eval import sed_filter, unified_diff
+
+BOARD = "native_sim/native/64"
+
+PASS = "PASS"
+FAILED = "FAILED"
+PENDING = "PENDING"
+
+# Files of a case that don't affect its build (besides `*.snapshot`).
+CASE_FILES = {"native_sim.keymap", "native_sim.conf", "events.patterns", "pending"}
+
+# Shared build trees, under <build dir>/tests.
+SHARED_DIR = ".shared"
+
+# `sed -e "s/.*> //"`: drop the log prefix up to the last "> " of a line
+LOG_PREFIX = re.compile(rb"^.*> ", re.MULTILINE)
+
+
+def _write_if_changed(path: Path, content: bytes) -> None:
+    try:
+        if path.read_bytes() == content:
+            return
+    except OSError:
+        pass
+    path.write_bytes(content)
+
+
+def discover_cases(tests_path: Path) -> list[Path]:
+    """A directory is a test case iff it contains `native_sim.keymap`.
+    Recurse from `tests_path` (which itself may be a single case)."""
+    return sorted({p.parent for p in Path(tests_path).rglob("native_sim.keymap")})
+
+
+def case_rel(tests_path: Path, case_dir: Path) -> str:
+    """Case name, also its build dir under `<build dir>/tests`."""
+    if case_dir == tests_path:
+        return case_dir.name
+    return case_dir.relative_to(tests_path).as_posix()
+
+
+@dataclass
+class CaseResult:
+    rel: str
+    status: str
+    # pass-fail.log line, e.g. "FAILED: foo did not build"
+    summary: str
+    # Diff or build error shown for failures
+    output: str = ""
+    build_time: float = 0.0
+    # Simulation plus evaluation
+    run_time: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "case": self.rel,
+            "status": self.status,
+            "summary": self.summary,
+            "build_time": self.build_time,
+            "run_time": self.run_time,
+            "output": self.output,
+        }
+
+
+class NativeSimRunner:
+    def __init__(
+        self,
+        *,
+        zmk_app: Path,
+        tests_path: Path,
+        build_dir: Path,
+        extra_modules: list[str],
+        auto_accept: bool,
+        verbose: bool,
+        log,
+        shared: bool = True,
+        events=None,
+    ):
+        self.zmk_app = Path(zmk_app)
+        self.tests_path = Path(tests_path)
+        self.tests_build = Path(build_dir).absolute() / "tests"
+        self.extra_modules = extra_modules
+        self.auto_accept = auto_accept
+        self.verbose = verbose
+        self.log = log
+        self.shared = shared
+        # test_results.EventStream receiving per-case events, if any
+        self.events = events
+        self.ninja_jobs = None
+        self._pass_fail_lock = threading.Lock()
+        self._trees_lock = threading.Lock()
+        self._free_trees: dict[str, list[Path]] = {}
+        self._tree_count: dict[str, int] = {}
+
+    def case_rel(self, case_dir: Path) -> str:
+        return case_rel(self.tests_path, case_dir)
+
+    # ------------------------------------------------------------------
+    # Per-case pipeline
+    # ------------------------------------------------------------------
+
+    def run_case(self, case_dir: Path) -> CaseResult:
+        rel = self.case_rel(case_dir)
+        try:
+            return self._run_case(rel, case_dir)
+        except Exception as err:
+            # e.g. a missing zmk.exe or an unwritable snapshot: fail this case
+            # only, so the rest of the suite still runs and gets logged.
+            return self._record(
+                CaseResult(rel, FAILED, f"{FAILED}: {rel} ({err})", traceback.format_exc())
+            )
+
+    def _run_case(self, rel: str, case_dir: Path) -> CaseResult:
+        case_build = self.tests_build / rel
+        case_build.mkdir(parents=True, exist_ok=True)
+        self.log.inf(f"Running {rel}:")
+        self._emit("started", case=rel)
+
+        key = self.group_key(case_dir) if self.shared else None
+        if key is None:
+            return self._test(rel, case_dir, case_build)
+        tree = self._checkout_tree(key)
+        try:
+            return self._test(rel, case_dir, case_build, tree, key)
+        finally:
+            self._return_tree(key, tree)
+
+    def _test(
+        self,
+        rel: str,
+        case_dir: Path,
+        case_build: Path,
+        tree: Path | None = None,
+        key: str | None = None,
+    ) -> CaseResult:
+        """Build the case (in the shared `tree` of group `key`, if given), run
+        and evaluate it."""
+        started = time.monotonic()
+        if tree is None:
+            build_dir = case_build
+            build_log = self._build(build_dir, self._cmake_args(case_dir), pristine=True)
+        else:
+            build_dir = tree / "build"
+            build_log = self._build_shared(tree, key, case_dir)
+        build_time = time.monotonic() - started
+        self._emit("built", case=rel, success=build_log is None, build_time=build_time)
+        (case_build / "build.log").write_text(build_log or "")
+        if build_log is None:
+            test_impact.save_inputs(case_build, test_impact.build_inputs(build_dir))
+        else:
+            test_impact.clear_inputs(case_build)
+        if build_log is not None:
+            return self._record(
+                CaseResult(rel, FAILED, f"{FAILED}: {rel} did not build", build_log, build_time)
+            )
+
+        result = self._evaluate(rel, case_dir, case_build, build_dir)
+        result.build_time = build_time
+        result.run_time = time.monotonic() - started - build_time
+        return self._record(result)
+
+    def _evaluate(self, rel: str, case_dir: Path, case_build: Path, build_dir: Path) -> CaseResult:
+        full_log = case_build / "keycode_events_full.log"
+        events_log = case_build / "keycode_events.log"
+        full_output = self._run(build_dir, full_log)
+        patterns = case_dir / "events.patterns"
+        try:
+            events_log.write_bytes(sed_filter(patterns, full_output))
+        except OSError as err:
+            return CaseResult(rel, FAILED, f"{FAILED}: {rel}", f"cannot read {patterns}: {err}\n")
+
+        snapshot = case_dir / "keycode_events.snapshot"
+        diff = unified_diff(snapshot, events_log)
+        if not diff:
+            return CaseResult(rel, PASS, f"{PASS}: {rel}")
+        if (case_dir / "pending").is_file():
+            return CaseResult(rel, PENDING, f"{PENDING}: {rel}", diff)
+        if self.auto_accept:
+            self.log.inf(f"Auto-accepting failure for {rel}")
+            shutil.copy(events_log, snapshot)
+            return CaseResult(rel, PASS, f"{PASS}: {rel}")
+        return CaseResult(rel, FAILED, f"{FAILED}: {rel}", diff)
+
+    def _cmake_args(self, config_dir: Path) -> list[str]:
+        args = ["-DCONFIG_ASSERT=y", f"-DZMK_CONFIG={config_dir}"]
+        if self.extra_modules:
+            args.append(f"-DZMK_EXTRA_MODULES={';'.join(self.extra_modules)}")
+        return args
+
+    def _build(self, build_dir: Path, cmake_args: list[str], pristine: bool) -> str | None:
+        """Build into `build_dir`; returns None on success, else the build output.
+
+        Without `pristine` the existing build dir is built incrementally with
+        the CMake arguments it was configured with.
+        """
+        command = ["west", "build", "-d", str(build_dir)]
+        if pristine:
+            command += ["-s", str(self.zmk_app), "--pristine", "-b", BOARD]
+        if self.ninja_jobs:
+            command.append(f"-o=-j{self.ninja_jobs}")
+        if pristine:
+            command += ["--", *cmake_args]
+        proc = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        if self.verbose:
+            for line in proc.stdout.splitlines():
+                self.log.dbg(line)
+        return None if proc.returncode == 0 else proc.stdout
+
+    # ------------------------------------------------------------------
+    # Shared build trees
+    # ------------------------------------------------------------------
+
+    def group_key(self, case_dir: Path) -> str | None:
+        """Cases with equal keys configure identically and differ only in
+        their keymap, so they can share a build tree. None if the case has
+        files other than the keymap, conf and test expectations."""
+        conf = b""
+        for path in sorted(case_dir.iterdir()):
+            if path.name == "native_sim.conf":
+                conf = path.read_bytes()
+            elif path.name not in CASE_FILES and path.suffix != ".snapshot":
+                return None
+        digest = hashlib.sha256(conf)
+        digest.update("\0".join(self.extra_modules).encode())
+        return digest.hexdigest()[:16]
+
+    def _checkout_tree(self, key: str) -> Path:
+        """A build tree of group `key` no other case is using; at most one
+        per worker, so a group of many cases still builds in parallel."""
+        with self._trees_lock:
+            free = self._free_trees.setdefault(key, [])
+            if free:
+                return free.pop()
+            index = self._tree_count.get(key, 0)
+            self._tree_count[key] = index + 1
+        return self.tests_build / SHARED_DIR / f"{key}-{index}"
+
+    def _return_tree(self, key: str, tree: Path) -> None:
+        with self._trees_lock:
+            self._free_trees[key].append(tree)
+
+    def _build_shared(self, tree: Path, key: str, case_dir: Path) -> str | None:
+        config_dir = tree / "config"
+        config_dir.mkdir(parents=True, exist_ok=True)
+        # Only the keymap differs within a group. The staged keymap includes
+        # the case's own, so relative #includes keep resolving from the case
+        # dir; files are only rewritten when their content changes, leaving
+        # Ninja nothing to redo for the conf.
+        _write_if_changed(
+            config_dir / "native_sim.keymap",
+            f'#include "{(case_dir / "native_sim.keymap").absolute()}"\n'.encode(),
+        )
+        conf = case_dir / "native_sim.conf"
+        _write_if_changed(
+            config_dir / "native_sim.conf", conf.read_bytes() if conf.is_file() else b""
+        )
+
+        cmake_args = self._cmake_args(config_dir)
+        stamp = tree / "configured.json"
+        configured = json.dumps({"key": key, "cmake_args": cmake_args})
+        pristine = not stamp.is_file() or stamp.read_text() != configured
+        stamp.unlink(missing_ok=True)
+        build_log = self._build(tree / "build", cmake_args, pristine)
+        if build_log is None:
+            stamp.write_text(configured)
+        return build_log
+
+    def _run(self, build_dir: Path, full_log: Path) -> bytes:
+        proc = subprocess.run(
+            [str(build_dir / "zephyr" / "zmk.exe")],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+        output = LOG_PREFIX.sub(b"", proc.stdout)
+        full_log.write_bytes(output)
+        if self.verbose and proc.stderr:
+            self.log.dbg(proc.stderr.decode(errors="replace"))
+        return output
+
+    def _emit(self, event: str, **fields) -> None:
+        if self.events is not None:
+            self.events.emit(event, **fields)
+
+    def _record(self, result: CaseResult) -> CaseResult:
+        with self._pass_fail_lock:
+            with open(self.tests_build / "pass-fail.log", "a") as f:
+                f.write(f"{result.summary}\n")
+        self.log.inf(result.summary)
+        self._emit("finished", **result.as_dict())
+        if self.verbose and result.output:
+            for line in result.output.rstrip().splitlines():
+                self.log.dbg(line)
+        return result
+
+    # ------------------------------------------------------------------
+    # Driver
+    # ------------------------------------------------------------------
+
+    def run(self, cases: list[Path], jobs: int) -> list[CaseResult]:
+        jobs = max(1, min(jobs, len(cases)))
+        # Split the cores between the concurrent builds, like xargs -P with
+        # a fair share of Ninja jobs each.
+        self.ninja_jobs = math.ceil((os.cpu_count() or 1) / jobs)
+        self.tests_build.mkdir(parents=True, exist_ok=True)
+        # run-test.sh starts the log with an empty line
+        (self.tests_build / "pass-fail.log").write_text("\n")
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(self.run_case, cases))
+
+    def write_pass_fail(self, results: list[CaseResult]) -> None:
+        """Rewrite pass-fail.log with `results`, e.g. the latest result of
+        every case after a partial re-run."""
+        self.tests_build.mkdir(parents=True, exist_ok=True)
+        with open(self.tests_build / "pass-fail.log", "w") as f:
+            f.write("\n")
+            for result in sorted(results, key=lambda r: r.rel):
+                f.write(f"{result.summary}\n")
@@ -0,0 +1,634 @@
+"""In-process snapshot evaluation for `west zmk-test` and `west zmk-ble-test`.
+
+Both test pipelines filter a firmware log with a case's `events.patterns` sed
+script and diff the result against a snapshot:
+
+    zmk-test:      sed -n -f events.patterns keycode_events_full.log
+    zmk-ble-test:  sort -s -t ':' -k 1,1 output.log | sed -E -n -f events.patterns
+
+    diff -auZ <snapshot> <filtered log>
+
+This module does the same without forking where it can reproduce the tools
+exactly, and runs the tools themselves everywhere else:
+
+- sed: scripts made of `/regex/` addresses (with `!` and `I`), `{ ... }`
+  blocks and the `s`, `p` and `d` commands, in basic or extended regex
+  syntax, are compiled into Python regular expressions when the script and
+  the input are ASCII. Python picks the leftmost-first match where POSIX
+  picks the leftmost-longest, so `s` regexes are limited to ones they agree
+  on (no alternation, no quantified groups), and back-references, bracket
+  expressions containing a backslash, repeated quantifiers and anything
+  else outside the subset go to `sed`.
+- sort: an in-process stable sort when the order is plain byte order (a C
+  locale, or bsim's `d_NN` keys only); `sort` otherwise.
+- diff: pass / fail is decided in-process, comparing lines with trailing
+  whitespace (isspace() bytes) ignored like `-Z`; a failing case runs
+  `diff -auZN` for the report.
+
+test_lib.py runs the repo's `events.patterns` files and random scripts
+through both implementations.
+"""
+
+from __future__ import annotations
+
+import difflib
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+
+
+class UnsupportedSed(Exception):
+    """The sed script uses something the in-process evaluator doesn't do."""
+
+
+POSIX_CLASSES = {
+    "alpha": "a-zA-Z",
+    "digit": "0-9",
+    "alnum": "0-9a-zA-Z",
+    "upper": "A-Z",
+    "lower": "a-z",
+    "space": " \\t\\n\\r\\f\\v",
+    "blank": " \\t",
+    "punct": re.escape("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"),
+    "xdigit": "0-9A-Fa-f",
+    "cntrl": "\\x00-\\x1f\\x7f",
+    "print": "\\x20-\\x7e",
+    "graph": "\\x21-\\x7e",
+}
+
+# Python escapes with the meaning GNU sed gives them.
+SAME_ESCAPES = set("wWsSbB")
+OTHER_ESCAPES = {"n": "\n", "t": "\t", "<": r"\b(?=\w)", ">": r"\b(?<=\w)", "`": r"\A", "'": r"\Z"}
+
+# Characters special to Python inside a character set (or warned about).
+SET_ESCAPES = set("[]^&~|")
+
+INTERVAL = re.compile(r"\d*(,\d*)?")
+
+
+def _translate_bracket(rx: str, i: int) -> tuple[str, int]:
+    """Translate the bracket expression starting at `rx[i] == "["`."""
+    j = i + 1
+    out = ["["]
+    if j < len(rx) and rx[j] == "^":
+        out.append("^")
+        j += 1
+    first = True
+    while True:
+        if j >= len(rx):
+            raise UnsupportedSed(f"unterminated bracket expression in {rx!r}")
+        c = rx[j]
+        if c == "]" and not first:
+            out.append("]")
+            return "".join(out), j + 1
+        first = False
+        if c == "\\":
+            # Literal in POSIX, but GNU sed turns `\n`, `\t`, ... into the
+            # characters before compiling the regex.
+            raise UnsupportedSed(f"backslash in bracket expression in {rx!r}")
+        if c == "[" and j + 1 < len(rx) and rx[j + 1] in ":.=":
+            kind = rx[j + 1]
+            end = rx.find(kind + "]", j + 2)
+            if end < 0 or kind != ":" or rx[j + 2 : end] not in POSIX_CLASSES:
+                raise UnsupportedSed(f"bracket expression {rx[j:]!r}")
+            out.append(POSIX_CLASSES[rx[j + 2 : end]])
+            j = end + 2
+            continue
+        out.append("\\" + c if c in SET_ESCAPES else c)
+        j += 1
+
+
+def translate_regex(rx: str, extended: bool, strict: bool = False) -> str:
+    """POSIX basic (or with `extended`, extended) regex -> Python regex.
+
+    Python picks the leftmost-first match where POSIX picks the
+    leftmost-longest one. They agree on whether a line matches, but with
+    `strict` (for `s`, where the matched text matters) only regexes on which
+    they also agree on the match and its groups are accepted: no alternation
+    and no quantified groups.
+    """
+    out: list[str] = []
+    # Whether the next token starts an expression (BRE `*` / `^` rules).
+    at_start = True
+    # What the previous token was, for the quantifier rules: "atom",
+    # "group" (a closing parenthesis), "quantifier" or "" (start / anchor).
+    prev = ""
+    i = 0
+    while i < len(rx):
+        c = rx[i]
+        op = ""
+        if c == "[":
+            token, i = _translate_bracket(rx, i)
+            out.append(token)
+            at_start = False
+            prev = "atom"
+            continue
+        if c == "\\":
+            i += 1
+            if i >= len(rx):
+                raise UnsupportedSed(f"trailing backslash in {rx!r}")
+            c = rx[i]
+            if not extended and c in "(){}+?|":
+                op = c
+            elif c in ".[]*^$\\/(){}+?|":
+                token = "\\" + c
+            elif c.isdigit():
+                raise UnsupportedSed(f"back-reference \\{c} in {rx!r}")
+            elif c in SAME_ESCAPES:
+                token = "\\" + c
+            elif c in OTHER_ESCAPES:
+                token = OTHER_ESCAPES[c]
+            else:
+                raise UnsupportedSed(f"escape \\{c} in {rx!r}")
+        elif extended and c in "(){}+?|*^$":
+            op = c
+        elif not extended and c == "*" and not at_start:
+            op = c
+        elif not extended and c == "^" and at_start:
+            op = c
+        elif (
+            not extended
+            and c == "$"
+            and (i == len(rx) - 1 or rx.startswith(("\\)", "\\|"), i + 1))
+        ):
+            op = c
+        elif c in "(){}+?|*^$.":
+            token = "\\" + c if c not in "." else c
+        else:
+            token = re.escape(c)
+
+        starts = False
+        if not op:
+            out.append(token)
+            prev = "atom"
+        elif op in "(|":
+            if op == "|" and strict:
+                raise UnsupportedSed(f"alternation in {rx!r}")
+            out.append(op)
+            starts = True
+            prev = ""
+        elif op == ")":
+            out.append(op)
+            prev = "group"
+        elif op in "^$":
+            # Without the M flag they only match at the ends of the pattern
+            # space, even after a `s` put a newline into it.
+            out.append("\\A" if op == "^" else "\\Z")
+            starts = op == "^"
+            prev = ""
+        elif op == "}":
+            raise UnsupportedSed(f"unmatched }} in {rx!r}")
+        else:
+            if op == "{":
+                close = "}" if extended else "\\}"
+                end = rx.find(close, i + 1)
+                if end < 0 or not INTERVAL.fullmatch(rx[i + 1 : end]):
+                    raise UnsupportedSed(f"bad interval in {rx!r}")
+                op = "{" + rx[i + 1 : end] + "}"
+                i = end + len(close) - 1
+            if prev == "":
+                raise UnsupportedSed(f"quantifier without an operand in {rx!r}")
+            if prev == "quantifier":
+                # POSIX repeats the repetition; Python reads `*?`, `++`, ...
+                # as lazy / possessive.
+                raise UnsupportedSed(f"repeated quantifier in {rx!r}")
+            if prev == "group" and strict:
+                raise UnsupportedSed(f"quantified group in {rx!r}")
+            out.append(op)
+            prev = "quantifier"
+        at_start = starts
+        i += 1
+    return "".join(out)
+
+
+class _Parser:
+    def __init__(self, script: str, extended: bool):
+        self.s = script
+        self.i = 0
+        self.extended = extended
+
+    def peek(self) -> str:
+        return self.s[self.i] if self.i < len(self.s) else ""
+
+    def take(self) -> str:
+        c = self.peek()
+        self.i += 1
+        return c
+
+    def skip_blanks(self, newlines: bool = False) -> None:
+        while self.peek() and (self.peek() in " \t" or (newlines and self.peek() in "\n;")):
+            self.i += 1
+
+    def delimited(self, delim: str, regex: bool) -> str:
+        """Text up to the unescaped `delim`; `\\<delim>` is a literal delim."""
+        out = []
+        while True:
+            c = self.take()
+            if not c:
+                raise UnsupportedSed("unterminated regex or replacement")
+            if c == delim:
+                return "".join(out)
+            if c == "\\":
+                d = self.take()
+                if d == delim and regex:
+                    out.append("\\^" if delim == "^" else f"[{delim}]")
+                elif d == "\n":
+                    out.append("\\n")
+                else:
+                    out.append("\\" + d)
+            else:
+                out.append(c)
+
+    def regex(self, rx: str, flags: int, strict: bool = False) -> re.Pattern:
+        if not rx:
+            raise UnsupportedSed("empty regex (reuse of the last regex)")
+        try:
+            # sed's `.` matches any character, including a newline put into
+            # the pattern space by `s`; text is ASCII (see sed_filter).
+            return re.compile(
+                translate_regex(rx, self.extended, strict), re.ASCII | re.DOTALL | flags
+            )
+        except re.error as err:
+            raise UnsupportedSed(f"regex {rx!r}: {err}")
+
+    def end_of_command(self) -> None:
+        self.skip_blanks()
+        c = self.peek()
+        if c == "#":
+            while self.peek() and self.peek() != "\n":
+                self.i += 1
+        elif c in ("\n", ";"):
+            self.i += 1
+        elif c not in ("", "}"):
+            raise UnsupportedSed(f"unexpected {c!r} after a command")
+
+    def commands(self, in_block: bool = False) -> list:
+        commands = []
+        while True:
+            self.skip_blanks(newlines=True)
+            c = self.peek()
+            if not c:
+                if in_block:
+                    raise UnsupportedSed("unterminated {")
+                return commands
+            if c == "#":
+                while self.peek() and self.peek() != "\n":
+                    self.i += 1
+                continue
+            if c == "}":
+                if not in_block:
+                    raise UnsupportedSed("unexpected }")
+                self.i += 1
+                self.end_of_command()
+                return commands
+
+            address = None
+            if c == "/":
+                self.i += 1
+                rx = self.delimited("/", regex=True)
+                flags = 0
+                while self.peek() in ("I", "M") and self.peek():
+                    if self.take() == "M":
+                        raise UnsupportedSed("address flag M")
+                    flags |= re.IGNORECASE
+                address = self.regex(rx, flags)
+            elif c.isdigit() or c in "$\\":
+                raise UnsupportedSed(f"address {c!r}")
+            self.skip_blanks()
+            negate = False
+            if self.peek() == "!":
+                negate = True
+                self.i += 1
+                self.skip_blanks()
+            if negate and address is None:
+                raise UnsupportedSed("! without an address")
+
+            command = self.take()
+            if command == "{":
+                commands.append((address, negate, "{", self.commands(in_block=True)))
+            elif command in ("p", "d"):
+                commands.append((address, negate, command, None))
+                self.end_of_command()
+            elif command == "s":
+                commands.append((address, negate, "s", self.substitution()))
+                self.end_of_command()
+            else:
+                raise UnsupportedSed(f"command {command!r}")
+
+    def substitution(self):
+        delim = self.take()
+        if not delim or delim in "\\\n":
+            raise UnsupportedSed("bad s delimiter")
+        rx = self.delimited(delim, regex=True)
+        replacement = self.delimited(delim, regex=False)
+        flags = 0
+        glob = False
+        print_ = False
+        nth = ""
+        while self.peek() and self.peek() in "gpIi0123456789":
+            f = self.take()
+            if f == "g":
+                glob = True
+            elif f == "p":
+                print_ = True
+            elif f in "Ii":
+                flags |= re.IGNORECASE
+            else:
+                nth += f
+        regex = self.regex(rx, flags, strict=True)
+        parts = _parse_replacement(replacement)
+        if any(isinstance(p, int) and p > regex.groups for p in parts):
+            raise UnsupportedSed("reference to a missing group in the replacement")
+        return (
+            regex,
+            parts,
+            glob,
+            print_,
+            int(nth) if nth else 1,
+        )
+
+
+def _parse_replacement(text: str) -> list:
+    """Literal strings and group numbers (0 for `&`)."""
+    parts: list = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "&":
+            parts.append(0)
+        elif c == "\\" and i + 1 < len(text):
+            i += 1
+            d = text[i]
+            if d.isdigit():
+                parts.append(int(d))
+            elif d.isalnum() and d not in "nt":
+                # Case conversion (\U, ...) and character escapes (\x41, ...).
+                raise UnsupportedSed(f"escape \\{d} in replacement")
+            else:
+                parts.append({"n": "\n", "t": "\t"}.get(d, d))
+        else:
+            parts.append(c)
+        i += 1
+    return parts
+
+
+def _expand(parts: list, m: re.Match) -> str:
+    return "".join(p if isinstance(p, str) else (m.group(p) or "") for p in parts)
+
+
+def _substitute(s: str, regex: re.Pattern, parts: list, glob: bool, nth: int) -> str | None:
+    """sed's `s`; None if nothing was replaced. Like GNU sed, an empty match
+    right after the previous match isn't replaced."""
+    out = []
+    pos = 0
+    prev_end = None
+    count = 0
+    replaced = False
+    while pos <= len(s):
+        m = regex.search(s, pos)
+        if m is None:
+            break
+        start, end = m.span()
+        if start == end == prev_end:
+            if start >= len(s):
+                break
+            out.append(s[pos : start + 1])
+            pos = start + 1
+            continue
+        count += 1
+        out.append(s[pos:start])
+        if count >= nth:
+            out.append(_expand(parts, m))
+            replaced = True
+        else:
+            out.append(m.group(0))
+        pos = end
+        prev_end = end
+        if replaced and not glob:
+            break
+        if start == end:
+            if end >= len(s):
+                break
+            out.append(s[end])
+            pos = end + 1
+    if not replaced:
+        return None
+    out.append(s[pos:])
+    return "".join(out)
+
+
+class SedScript:
+    """A compiled sed script; see the module docstring for the subset."""
+
+    def __init__(self, script: str, extended: bool = False, quiet: bool = True):
+        self.commands = _Parser(script, extended).commands()
+        self.quiet = quiet
+
+    def apply(self, text: str) -> str:
+        out: list[str] = []
+        missing_newline = False
+
+        def emit(line: str, newline: bool) -> None:
+            nonlocal missing_newline
+            if missing_newline:
+                out.append("\n")
+            out.append(line + "\n" if newline else line)
+            missing_newline = not newline
+
+        lines = text.split("\n")
+        last_has_newline = lines[-1] == ""
+        if last_has_newline:
+            lines.pop()
+        for n, line in enumerate(lines):
+            newline = last_has_newline or n < len(lines) - 1
+            space = [line]
+            deleted = self._execute(self.commands, space, lambda s: emit(s, newline))
+            if not deleted and not self.quiet:
+                emit(space[0], newline)
+        return "".join(out)
+
+    def _execute(self, commands: list, space: list[str], emit) -> bool:
+        """Run `commands` on the pattern space `space[0]`; True on `d`."""
+        for address, negate, command, arg in commands:
+            if address is not None and (address.search(space[0]) is None) != negate:
+                continue
+            if command == "p":
+                emit(space[0])
+            elif command == "d":
+                return True
+            elif command == "{":
+                if self._execute(arg, space, emit):
+                    return True
+            else:
+                regex, parts, glob, print_, nth = arg
+                result = _substitute(space[0], regex, parts, glob, nth)
+                if result is not None:
+                    space[0] = result
+                    if print_:
+                        emit(result)
+        return False
+
+
+def _locale(*names: str) -> str:
+    """The locale sed / sort / diff use for a category: the first of LC_ALL,
+    the category's variable and LANG that is set."""
+    for name in ("LC_ALL", *names, "LANG"):
+        value = os.environ.get(name)
+        if value:
+            return value
+    return "C"
+
+
+def utf8_locale() -> bool:
+    """Whether the tools run in a UTF-8 locale (else bytes are characters)."""
+    return _locale("LC_CTYPE").lower().replace("-", "").endswith("utf8")
+
+
+def _decode(data: bytes, utf8: bool) -> str:
+    # Invalid UTF-8 round-trips as lone surrogates; in the C locale every
+    # byte is one character, which latin-1 maps one to one.
+    return data.decode("utf-8", "surrogateescape") if utf8 else data.decode("latin-1")
+
+
+def sed_filter(patterns: Path, data: bytes, extended: bool = False) -> bytes:
+    """`sed [-E] -n -f patterns` over `data`.
+
+    Runs sed itself for scripts outside the supported subset and for
+    non-ASCII scripts or input, where character classes, case folding and
+    ranges depend on the locale.
+    """
+    script = Path(patterns).read_bytes()
+    if script.isascii() and data.isascii():
+        try:
+            sed = SedScript(script.decode("ascii"), extended)
+        except UnsupportedSed:
+            pass
+        else:
+            return sed.apply(data.decode("ascii")).encode("ascii")
+    command = ["sed", *(["-E"] if extended else []), "-n", "-f", str(patterns)]
+    return subprocess.run(command, input=data, stdout=subprocess.PIPE).stdout
+
+
+# Locales whose collation is byte order.
+BYTE_ORDER_LOCALES = {"c", "posix", "c.utf8"}
+
+# bsim device prefixes (`d_00:`); any locale orders these by their digits.
+DEVICE_KEY = re.compile(rb"d_[0-9]+")
+
+
+def sort_first_field(data: bytes) -> bytes:
+    """`sort -s -t ':' -k 1,1`: a stable sort of the lines on the text
+    before their first `:`.
+
+    Sorts in-process when the order doesn't depend on the locale: in the C
+    locale, or when every key is a bsim device prefix of the same width.
+    Otherwise runs `sort`.
+    """
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    keys = [line.split(b":", 1)[0] for line in lines]
+    collation = _locale("LC_COLLATE").lower().replace("-", "")
+    if collation not in BYTE_ORDER_LOCALES and not (
+        all(DEVICE_KEY.fullmatch(key) for key in keys) and len({len(key) for key in keys}) <= 1
+    ):
+        command = ["sort", "-s", "-t", ":", "-k", "1,1"]
+        return subprocess.run(command, input=data, stdout=subprocess.PIPE).stdout
+    order = sorted(range(len(lines)), key=keys.__getitem__)
+    return b"".join(lines[i] + b"\n" for i in order)
+
+
+def _read(path: Path) -> bytes:
+    """The file's bytes; a missing file is empty, like `diff -N`."""
+    try:
+        return Path(path).read_bytes()
+    except FileNotFoundError:
+        return b""
+
+
+def _label(path: Path) -> str:
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = 0
+    local = time.localtime(mtime_ns // 1_000_000_000)
+    return "{}\t{}.{:09d} {}".format(
+        path,
+        time.strftime("%Y-%m-%d %H:%M:%S", local),
+        mtime_ns % 1_000_000_000,
+        time.strftime("%z", local),
+    )
+
+
+def _range(start: int, length: int) -> str:
+    if length == 1:
+        return f"{start + 1}"
+    if length == 0:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+# What `diff -Z` counts as trailing whitespace: isspace() on bytes.
+TRAILING_SPACE = b" \t\n\v\f\r"
+
+
+def _lines(data: bytes) -> list[bytes]:
+    lines = data.split(b"\n")
+    # "" after a final newline isn't a line; a missing final newline doesn't
+    # count with -Z.
+    if lines[-1] == b"":
+        lines.pop()
+    return [line.rstrip(TRAILING_SPACE) for line in lines]
+
+
+def unified_diff(from_path: Path, to_path: Path) -> str:
+    """`diff -auZN from_path to_path`; "" when the files are equal. A missing
+    file (e.g. a new case's snapshot) compares as empty.
+
+    Equality is decided in-process; only a failing case runs `diff` for the
+    report (or, without `diff`, renders one with difflib).
+    """
+    if _lines(_read(from_path)) == _lines(_read(to_path)):
+        return ""
+    try:
+        proc = subprocess.run(
+            ["diff", "-auZN", str(from_path), str(to_path)], stdout=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        return _difflib_diff(Path(from_path), Path(to_path))
+    return _decode(proc.stdout, utf8_locale())
+
+
+def _difflib_diff(from_path: Path, to_path: Path) -> str:
+    utf8 = utf8_locale()
+    a = _decode(_read(from_path), utf8).split("\n")
+    b = _decode(_read(to_path), utf8).split("\n")
+    # Lines as (text, has newline); "" after a final newline isn't a line.
+    a = [(line, i < len(a) - 1) for i, line in enumerate(a) if i < len(a) - 1 or line]
+    b = [(line, i < len(b) - 1) for i, line in enumerate(b) if i < len(b) - 1 or line]
+    strip = TRAILING_SPACE.decode()
+    matcher = difflib.SequenceMatcher(
+        None, [line.rstrip(strip) for line, _ in a], [line.rstrip(strip) for line, _ in b], False
+    )
+    out = [f"--- {_label(from_path)}\n", f"+++ {_label(to_path)}\n"]
+
+    def line_out(prefix: str, line: tuple[str, bool]) -> None:
+        out.append(f"{prefix}{line[0]}\n")
+        if not line[1]:
+            out.append("\\ No newline at end of file\n")
+
+    for group in matcher.get_grouped_opcodes(3):
+        a1, a2, b1, b2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        out.append(f"@@ -{_range(a1, a2 - a1)} +{_range(b1, b2 - b1)} @@\n")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    line_out(" ", line)
+                continue
+            for line in a[i1:i2]:
+                line_out("-", line)
+            for line in b[j1:j2]:
+                line_out("+", line)
+    return "".join(out)
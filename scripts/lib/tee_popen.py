@@ -1,8 +1,327 @@
+"""Run a child process while teeing its output to the console, a log file and
+an in-memory capture.
+
+All TeePopen instances share one OutputMultiplexer: a single thread waiting
+on every child's stdout / stderr with `selectors` and doing non-blocking
+reads. `-P 32` parallel builds thus cost one reader thread instead of 64, and
+each wakeup does one batched write + flush per console stream and log file
+instead of one per line. Windows can't select() on pipes, so there each
+child keeps its two reader threads.
+
+What is kept in memory for the `stdout` / `stderr` properties is chosen by
+`capture`:
+
+- "full" (default): everything. With a (named) log file, only the length
+  and stream of each line is kept while the child runs, and the text is
+  read back from the log through a descriptor opened at the start, so the
+  log may be renamed or deleted meanwhile. wait() reads it before returning.
+- "tail": the last `capture_lines` lines of each stream, as bytes.
+- "none": nothing.
+
+With text=False the output is never decoded: each read goes into one
+reusable buffer (`readv`) and straight to the log file with `os.write`,
+unprefixed. Lines are only split when an output prefix is needed for the
+console. stdout / stderr are bytes then.
+"""
+
+import codecs
+import collections
+import io
+import locale
+import os
+import selectors
 import subprocess
 import sys
 import threading
+from array import array
 from typing import List, Optional
 
+READ_SIZE = 1 << 16
+CAPTURE_POLICIES = ["full", "tail", "none"]
+
+
+class _Capture:
+    """The part of a child's output kept for TeePopen.stdout / .stderr."""
+
+    def __init__(self, policy: str, lines: int, log_file, text: bool):
+        if policy not in CAPTURE_POLICIES:
+            raise ValueError(f"capture must be one of {CAPTURE_POLICIES}, not {policy!r}")
+        self.policy = policy
+        self.text = text
+        self.lock = threading.Lock()
+        self._log_file = log_file
+        self._reader = self._open_reader(log_file) if policy == "full" else None
+        self._lazy = self._reader is not None
+        if self._lazy:
+            self._log_start = log_file.tell()
+            # Per line in log order: its length, negated for stderr lines
+            self._lengths = array("i")
+        elif policy == "full":
+            self._lines = ([], [])
+        elif policy == "tail":
+            self._lines = (collections.deque(maxlen=lines), collections.deque(maxlen=lines))
+
+        self._tail_partial = [b"", b""]
+
+    def add(self, index: int, line) -> None:
+        """Record `line` (or a raw chunk of binary output) of stdout (index 0)
+        or stderr (1), in the order it was written to the log file."""
+        if self._lazy:
+            self._lengths.append(len(line) if index == 0 else -len(line))
+        elif self.policy == "full":
+            self._lines[index].append(bytes(line) if isinstance(line, memoryview) else line)
+        elif self.policy == "tail":
+            data = self._tail_partial[index] + (
+                line.encode() if isinstance(line, str) else bytes(line)
+            )
+            *lines, self._tail_partial[index] = data.split(b"\n")
+            self._lines[index].extend(line + b"\n" for line in lines)
+
+    @staticmethod
+    def _open_reader(log_file):
+        """A read handle on the log file itself, or None."""
+        name = getattr(log_file, "name", None)
+        if not isinstance(name, str):
+            return None
+        binary = "b" in getattr(log_file, "mode", "")
+        try:
+            reader = open(
+                name,
+                "rb" if binary else "r",
+                encoding=None if binary else getattr(log_file, "encoding", None),
+            )
+        except OSError:
+            return None
+        try:
+            same = os.path.samestat(os.fstat(reader.fileno()), os.fstat(log_file.fileno()))
+        except (OSError, ValueError, io.UnsupportedOperation):
+            same = False
+        if not same:
+            reader.close()
+            return None
+        return reader
+
+    def _split_log(self) -> tuple:
+        empty = "" if self.text else b""
+        log = self._read_log()
+        parts: tuple = ([], [])
+        pos = 0
+        for length in self._lengths:
+            parts[0 if length > 0 else 1].append(log[pos : pos + abs(length)])
+            pos += abs(length)
+        return empty.join(parts[0]), empty.join(parts[1])
+
+    def finish(self) -> None:
+        """Read the captured output back from the log once the child's
+        output is complete, and release the log's read handle."""
+        if not self._lazy:
+            return
+        self._lines = tuple([part] for part in self._split_log())
+        self._lazy = False
+        self._reader.close()
+
+    def get(self, index: int):
+        empty = "" if self.text else b""
+        if self._lazy:
+            return self._split_log()[index]
+        if self.policy == "full":
+            return empty.join(self._lines[index])
+        if self.policy == "tail":
+            data = b"".join(self._lines[index]) + self._tail_partial[index]
+            return data.decode(errors="replace") if self.text else data
+        return empty
+
+    def _read_log(self):
+        if not self._log_file.closed:
+            self._log_file.flush()
+        self._reader.seek(self._log_start)
+        return self._reader.read()
+
+
+class _Pipe:
+    """Read side of one child stdout / stderr pipe."""
+
+    def __init__(self, owner: "TeePopen", fileobj, index: int, target_stream):
+        self.owner = owner
+        self.fileobj = fileobj
+        self.fd = fileobj.fileno()
+        self.index = index
+        self.target_stream = target_stream
+        self.binary = not owner.text
+        if self.binary:
+            self.prefix = owner.output_prefix.encode()
+            self.partial = b""
+        else:
+            # Same decoding as text=True pipes (universal newlines), but never
+            # raising on odd bytes in the shared reader.
+            self.decoder = io.IncrementalNewlineDecoder(
+                codecs.getincrementaldecoder(locale.getpreferredencoding(False))("replace"),
+                translate=True,
+            )
+            self.partial = ""
+
+    def feed(self, data: bytes) -> str:
+        """Decode `data` (b"" at EOF) and return the prefixed complete lines."""
+        parts = (self.partial + self.decoder.decode(data, final=not data)).split("\n")
+        self.partial = parts.pop()
+        lines = [f"{part}\n" for part in parts]
+        if not data and self.partial:
+            lines.append(self.partial)
+            self.partial = ""
+        if self.owner.output_prefix:
+            lines = [f"{self.owner.output_prefix}{line}" for line in lines]
+        for line in lines:
+            self.owner._capture.add(self.index, line)
+        return "".join(lines)
+
+    def console_bytes(self, data: memoryview) -> bytes:
+        """Console output for a raw chunk (empty at EOF): the chunk itself,
+        or its complete lines prefixed when there is a prefix."""
+        if not self.prefix:
+            return bytes(data)
+        parts = (self.partial + data).split(b"\n")
+        self.partial = parts.pop()
+        if not data and self.partial:
+            parts.append(self.partial)
+            self.partial = b""
+            return self.prefix + (b"\n" + self.prefix).join(parts)
+        if not parts:
+            return b""
+        return self.prefix + (b"\n" + self.prefix).join(parts) + b"\n"
+
+
+def _write(stream, chunks: list) -> None:
+    """Write str or bytes chunks to a text or binary stream and flush it."""
+    data = chunks[0][:0].join(chunks)
+    if isinstance(data, bytes):
+        if hasattr(stream, "buffer"):
+            # e.g. sys.stdout: bypass the text layer
+            stream.flush()
+            stream = stream.buffer
+        elif "b" not in getattr(stream, "mode", ""):
+            data = data.decode(errors="replace")
+    stream.write(data)
+    stream.flush()
+
+
+class OutputMultiplexer:
+    """One thread reading the output pipes of all running TeePopen children."""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending: List[_Pipe] = []
+        self._thread: Optional[threading.Thread] = None
+        # Reused by every read of a binary pipe
+        self._buffer = bytearray(READ_SIZE)
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def add(self, pipes: List[_Pipe]) -> None:
+        with self._lock:
+            self._pending.extend(pipes)
+        self.ensure_running()
+        os.write(self._wake_w, b"\0")
+
+    def ensure_running(self) -> None:
+        """Start the reader thread, or restart it if it died, e.g. on an
+        unexpected error outside the reading of one pipe."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="tee-popen-output", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            events = self._selector.select()
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for pipe in pending:
+                try:
+                    os.set_blocking(pipe.fd, False)
+                    self._selector.register(pipe.fd, selectors.EVENT_READ, pipe)
+                except (OSError, ValueError):
+                    self._finish(pipe)
+
+            # stream -> chunks, written in one go after reading every ready pipe
+            writes: dict = {}
+            finished = []
+            for key, _ in events:
+                pipe = key.data
+                if pipe is None:
+                    try:
+                        os.read(self._wake_r, READ_SIZE)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    if not self._read(pipe, writes):
+                        finished.append(pipe)
+                except BlockingIOError:
+                    pass
+                except Exception:
+                    # One child's broken capture or log must not stop the
+                    # thread every other child's wait() depends on.
+                    finished.append(pipe)
+
+            for stream, chunks in writes.items():
+                try:
+                    _write(stream, chunks)
+                except Exception:
+                    # A closed or unusable console or log must not stall the
+                    # other children.
+                    pass
+            for pipe in finished:
+                self._finish(pipe)
+
+    def _read(self, pipe: _Pipe, writes: dict) -> bool:
+        """Read what `pipe` has and queue its console / log writes; False at EOF."""
+        if pipe.binary:
+            try:
+                size = os.readv(pipe.fd, [self._buffer])
+            except BlockingIOError:
+                raise
+            except OSError:
+                size = 0
+            data = memoryview(self._buffer)[:size]
+            if size:
+                pipe.owner._capture.add(pipe.index, data)
+                pipe.owner._write_log(data)
+            chunk = pipe.console_bytes(data)
+            if chunk and pipe.target_stream:
+                writes.setdefault(pipe.target_stream, []).append(chunk)
+            return bool(size)
+        try:
+            data = os.read(pipe.fd, READ_SIZE)
+        except BlockingIOError:
+            raise
+        except OSError:
+            data = b""
+        chunk = pipe.feed(data)
+        if chunk:
+            for stream in (pipe.target_stream, pipe.owner._log_file):
+                if stream:
+                    writes.setdefault(stream, []).append(chunk)
+        return bool(data)
+
+    def _finish(self, pipe: _Pipe) -> None:
+        """Stop reading `pipe`, close it and tell its owner."""
+        try:
+            self._selector.unregister(pipe.fd)
+        except (KeyError, ValueError):
+            pass
+        try:
+            pipe.fileobj.close()
+        except OSError:
+            pass
+        pipe.owner._pipe_closed()
+
+
+_multiplexer = OutputMultiplexer() if sys.platform != "win32" else None
+
 
 class TeePopen:
     def __init__(
@@ -18,6 +337,8 @@ class TeePopen:
         bufsize=1,
         output_prefix="",
         log_file=None,
+        capture="full",
+        capture_lines=200,
     ):
         self.args = args
         self.stdin = stdin
@@ -28,32 +349,87 @@ class TeePopen:
         self.output_prefix = output_prefix
 
         self._proc: Optional[subprocess.Popen] = None
-        self._stdout_buf: List[str] = []
-        self._stderr_buf: List[str] = []
+        self._capture = _Capture(capture, capture_lines, log_file, text)
         self._threads: List[threading.Thread] = []
         self._stdout = stdout
         self._stderr = stderr
         self._log_file = log_file
+        self._log_fd: Optional[int] = None
+        self._rusage = None
+        self._multiplexed = False
+        self._open_pipes = 0
+        self._pipes_done = threading.Event()
+        self._pipes_lock = threading.Lock()
 
-    def _reader(self, pipe, buf, target_stream):
+    def _write_log(self, data) -> None:
+        """Write raw output to the log file (binary mode)."""
+        if self._log_fd is not None:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._log_fd, view) :]
+        elif self._log_file:
+            self._log_file.write(bytes(data).decode(errors="replace"))
+
+    def _reader(self, pipe, index, target_stream):
         try:
-            for line in pipe:
+            for raw in pipe:
+                line = raw
                 if self.output_prefix:
-                    line = f"{self.output_prefix}{line}"
+                    line = (
+                        f"{self.output_prefix}{raw}"
+                        if self.text
+                        else self.output_prefix.encode() + raw
+                    )
                 if target_stream:
-                    target_stream.write(line)
-                    target_stream.flush()
-                if self._log_file:
-                    self._log_file.write(line)
-                buf.append(line)
+                    _write(target_stream, [line])
+                # Keep the log and the capture in the same line order.
+                with self._capture.lock:
+                    if not self.text:
+                        self._write_log(raw)
+                        self._capture.add(index, raw)
+                        continue
+                    if self._log_file:
+                        self._log_file.write(line)
+                    self._capture.add(index, line)
         finally:
             pipe.close()
 
+    def _pipe_closed(self):
+        with self._pipes_lock:
+            self._open_pipes -= 1
+            if self._open_pipes == 0:
+                self._pipes_done.set()
+
     def __del__(self):
         if self._proc and self._proc.poll() is None:
             self._proc.terminate()
 
     def start(self):
+        if not self.text and self._log_file and "b" in getattr(self._log_file, "mode", ""):
+            # Binary output goes to the log's fd directly, behind anything
+            # already buffered in the file object.
+            self._log_file.flush()
+            self._log_fd = self._log_file.fileno()
+        if _multiplexer is not None:
+            self._proc = subprocess.Popen(
+                self.args,
+                stdin=self.stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=self.cwd,
+                env=self.env,
+                bufsize=0,
+            )
+            self._multiplexed = True
+            self._open_pipes = 2
+            _multiplexer.add(
+                [
+                    _Pipe(self, self._proc.stdout, 0, self._stdout),
+                    _Pipe(self, self._proc.stderr, 1, self._stderr),
+                ]
+            )
+            return self
+
         self._proc = subprocess.Popen(
             self.args,
             stdin=self.stdin,
@@ -62,17 +438,17 @@ class TeePopen:
             cwd=self.cwd,
             env=self.env,
             text=self.text,
-            bufsize=self.bufsize,
+            bufsize=self.bufsize if self.text else -1,
         )
 
         t_out = threading.Thread(
             target=self._reader,
-            args=(self._proc.stdout, self._stdout_buf, self._stdout),
+            args=(self._proc.stdout, 0, self._stdout),
             daemon=True,
         )
         t_err = threading.Thread(
             target=self._reader,
-            args=(self._proc.stderr, self._stderr_buf, self._stderr),
+            args=(self._proc.stderr, 1, self._stderr),
             daemon=True,
         )
 
@@ -87,10 +463,19 @@ class TeePopen:
         if self._proc is None:
             raise RuntimeError("Process not started")
 
+        if hasattr(os, "wait4") and self._proc.returncode is None:
+            # Reap the child ourselves to also get its resource usage (which
+            # covers the descendants it waited for, e.g. compilers).
+            _, status, self._rusage = os.wait4(self._proc.pid, 0)
+            self._proc.returncode = os.waitstatus_to_exitcode(status)
         returncode = self._proc.wait()
 
+        if self._multiplexed:
+            while not self._pipes_done.wait(1.0):
+                _multiplexer.ensure_running()
         for t in self._threads:
             t.join()
+        self._capture.finish()
         return returncode
 
     def run(self):
@@ -99,11 +484,20 @@ class TeePopen:
 
     @property
     def stdout(self) -> str:
-        return "".join(self._stdout_buf)
+        return self._capture.get(0)
 
     @property
     def stderr(self) -> str:
-        return "".join(self._stderr_buf)
+        return self._capture.get(1)
+
+    @property
+    def peak_rss(self) -> Optional[int]:
+        """Peak resident set size in bytes of the child and its waited-for
+        descendants, once it finished (None where unsupported)."""
+        if self._rusage is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS
+        return self._rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
 
     @property
     def returncode(self) -> Optional[int]:
@@ -0,0 +1,125 @@
+"""Test-impact selection for `west zmk-test --affected-by <git-rev>`.
+
+After every successful build a case records the files its firmware was built
+from, read from the build's own dependency data:
+
+- `compile_commands.json`: the compiled C sources,
+- `ninja -t deps`: the headers each object included (depfiles recorded by
+  Ninja), including the generated devicetree / Kconfig headers' inputs,
+- the implicit inputs of build.ninja's RERUN_CMAKE rule: the files CMake
+  reconfigures on, i.e. Kconfig files, devicetree sources and bindings, the
+  keymap and conf of the case and the CMake scripts.
+
+A case is affected by a set of changed files if it has no recorded inputs
+yet (never built, or its last build failed), one of the changed files is in
+its case directory, or one is among its recorded inputs.
+"""
+
+import json
+import shutil
+import subprocess
+from pathlib import Path
+
+INPUTS_FILE = "build_inputs.json"
+
+
+def _ninja_unescape(text: str) -> list[str]:
+    """Split a Ninja path list on unescaped spaces."""
+    paths, current, i = [], [], 0
+    while i < len(text):
+        c = text[i]
+        if c == "$" and i + 1 < len(text):
+            current.append(text[i + 1])
+            i += 2
+            continue
+        if c == " ":
+            if current:
+                paths.append("".join(current))
+            current = []
+        else:
+            current.append(c)
+        i += 1
+    if current:
+        paths.append("".join(current))
+    return paths
+
+
+def _rerun_cmake_inputs(build_dir: Path) -> set[str]:
+    try:
+        with open(build_dir / "build.ninja", "r") as f:
+            lines = f.read().split("\n")
+    except OSError:
+        return set()
+    inputs = set()
+    for n, line in enumerate(lines):
+        if not (line.startswith("build ") and ": RERUN_CMAKE" in line):
+            continue
+        statement = line
+        while statement.endswith("$") and n + 1 < len(lines):
+            n += 1
+            statement = statement[:-1] + lines[n].lstrip()
+        deps = statement.split(": RERUN_CMAKE", 1)[1]
+        if " | " in deps:
+            implicit = deps.split(" | ", 1)[1].split(" || ", 1)[0]
+            inputs.update(_ninja_unescape(implicit))
+    return inputs
+
+
+def _compiled_sources(build_dir: Path) -> set[str]:
+    try:
+        with open(build_dir / "compile_commands.json", "r") as f:
+            commands = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {str(Path(c.get("directory", build_dir)) / c["file"]) for c in commands if "file" in c}
+
+
+def _ninja_deps(build_dir: Path) -> set[str]:
+    ninja = shutil.which("ninja")
+    if ninja is None:
+        return set()
+    proc = subprocess.run(
+        [ninja, "-C", str(build_dir), "-t", "deps"],
+        capture_output=True,
+        text=True,
+        errors="replace",
+    )
+    if proc.returncode != 0:
+        return set()
+    return {line.strip() for line in proc.stdout.splitlines() if line.startswith("    ")}
+
+
+def build_inputs(build_dir: Path) -> set[str]:
+    """Absolute, normalized paths of the files the build in `build_dir` read."""
+    build_dir = Path(build_dir)
+    paths = _rerun_cmake_inputs(build_dir) | _compiled_sources(build_dir) | _ninja_deps(build_dir)
+    return {str((build_dir / p).resolve()) for p in paths if p}
+
+
+def save_inputs(case_build: Path, inputs: set[str]) -> None:
+    with open(Path(case_build) / INPUTS_FILE, "w") as f:
+        json.dump(sorted(inputs), f)
+
+
+def clear_inputs(case_build: Path) -> None:
+    (Path(case_build) / INPUTS_FILE).unlink(missing_ok=True)
+
+
+def load_inputs(case_build: Path) -> set[str] | None:
+    try:
+        with open(Path(case_build) / INPUTS_FILE, "r") as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return None
+
+
+def is_affected(case_dir: Path, case_build: Path, changed: list[Path]) -> bool:
+    inputs = load_inputs(case_build)
+    if inputs is None:
+        return True
+    case_dir = Path(case_dir).resolve()
+    for path in changed:
+        path = Path(path).resolve()
+        if path.is_relative_to(case_dir) or str(path) in inputs:
+            return True
+    return False
@@ -0,0 +1,113 @@
+"""Structured results of `west zmk-test` for CI.
+
+While the tests run, every case appends events to a JSON-lines file, one
+object per line and flushed as it happens, so a dashboard (or `tail -f`) can
+follow a run:
+
+    {"event": "started", "case": "test1", "time": 1700000000.0}
+    {"event": "built", "case": "test1", "time": ..., "success": true, "build_time": 41.2}
+    {"event": "finished", "case": "test1", "time": ..., "status": "FAILED",
+     "build_time": 41.2, "run_time": 0.8, "output": "--- ..."}
+    {"event": "summary", "time": ..., "total": 2, "passed": 1, "failed": 1, ...}
+
+At the end the same results are written as a JUnit XML report, which CI
+systems render and track per case: the test time is build plus run time,
+FAILED cases carry their diff (or build output) as a failure and PENDING ones
+are reported as skipped.
+"""
+
+import json
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+JSON_RESULTS = "results.jsonl"
+JUNIT_XML = "junit.xml"
+
+# Characters XML 1.0 can't carry (e.g. control characters in a firmware log).
+_XML_INVALID = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+
+class EventStream:
+    """Thread-safe JSON-lines event writer."""
+
+    def __init__(self, path: Path, append: bool = False):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, "a" if append else "w")
+        self._lock = threading.Lock()
+
+    def emit(self, event: str, **fields) -> None:
+        line = json.dumps({"event": event, "time": time.time(), **fields})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def counts(results: list[dict]) -> dict[str, int]:
+    statuses = [r["status"] for r in results]
+    return {
+        "total": len(results),
+        "passed": statuses.count("PASS"),
+        "failed": statuses.count("FAILED"),
+        "pending": statuses.count("PENDING"),
+    }
+
+
+def write_junit(path: Path, suite: str, results: list[dict], wall: float) -> None:
+    """`results` are dicts with case, status, summary, build_time, run_time
+    and output (the diff or build output)."""
+    total = counts(results)
+    testsuite = ET.Element(
+        "testsuite",
+        name=suite,
+        tests=str(total["total"]),
+        failures=str(total["failed"]),
+        skipped=str(total["pending"]),
+        errors="0",
+        time=f"{wall:.3f}",
+    )
+    for r in sorted(results, key=lambda r: r["case"]):
+        testcase = ET.SubElement(
+            testsuite,
+            "testcase",
+            classname=suite,
+            name=r["case"],
+            time=f"{r['build_time'] + r['run_time']:.3f}",
+        )
+        properties = ET.SubElement(testcase, "properties")
+        for name in ("build_time", "run_time"):
+            ET.SubElement(properties, "property", name=name, value=f"{r[name]:.3f}")
+        if r["status"] == "FAILED":
+            failure = ET.SubElement(testcase, "failure", message=r["summary"])
+            failure.text = _XML_INVALID.sub("?", r["output"])
+        elif r["status"] == "PENDING":
+            skipped = ET.SubElement(testcase, "skipped", message=r["summary"])
+            skipped.text = _XML_INVALID.sub("?", r["output"])
+    testsuites = ET.Element("testsuites")
+    testsuites.append(testsuite)
+    ET.indent(testsuites)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    ET.ElementTree(testsuites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m{seconds % 60:04.1f}s"
+    return f"{seconds:.1f}s"
+
+
+def slowest_lines(results: list[dict], count: int = 5) -> list[str]:
+    """The `count` slowest cases and their share of the summed case time."""
+    total = sum(r["build_time"] + r["run_time"] for r in results) or 1.0
+    slowest = sorted(results, key=lambda r: r["build_time"] + r["run_time"], reverse=True)
+    return [
+        f"{r['case']}: {_format_seconds(r['build_time'] + r['run_time'])}"
+        f" (build {_format_seconds(r['build_time'])}, run {_format_seconds(r['run_time'])},"
+        f" {100 * (r['build_time'] + r['run_time']) / total:.0f}%)"
+        for r in slowest[:count]
+    ]
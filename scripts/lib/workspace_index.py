@@ -0,0 +1,217 @@
+"""Cached west workspace resolution shared by the zmk-* commands.
+
+Parsing the west manifest (`Manifest.from_topdir()`, which follows the
+manifest's imports into zmk's and Zephyr's own west.yml) and scanning its
+projects takes seconds on a large workspace, and every command did it on
+startup just to find a few project paths. This index resolves the project
+paths once and keeps them in `<topdir>/.west/zmk-workspace-index.json`.
+
+The index is keyed on everything the resolution read: the content of
+`.west/config`, the manifest file and the files it imports from the
+manifest repository (`self: import:`), and, for every project, the commit of
+its `manifest-rev` branch, which is where west reads a project's imported
+manifests from (e.g. `zmk/app/west.yml`, and Zephyr's west.yml through it).
+Checking them is a few small file reads; any change (e.g. after
+`west update`) rebuilds the index. Paths found by searching the workspace,
+like the zmk-studio-messages proto dir, are cached in the same file.
+
+The full `Manifest` object is still available, lazily, for the commands
+that need more than paths (`WorkspaceIndex.manifest()`).
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+INDEX_FILE = "zmk-workspace-index.json"
+INDEX_VERSION = 2
+MANIFEST_REV = "refs/heads/manifest-rev"
+
+
+class Project(NamedTuple):
+    """The part of a west `Project` the commands use."""
+
+    name: str
+    abspath: str
+
+
+def _digest(path: Path) -> str | None:
+    """Hash of a file's content, or of a directory's file names (imports of
+    a directory take every .yml file in it); None if missing."""
+    try:
+        if path.is_dir():
+            content = "\n".join(sorted(os.listdir(path))).encode()
+        else:
+            content = path.read_bytes()
+    except OSError:
+        return None
+    return hashlib.sha256(content).hexdigest()
+
+
+def _git_dir(project_dir: Path) -> Path:
+    git = project_dir / ".git"
+    if git.is_file():
+        # "gitdir: <path>", e.g. a submodule-style checkout
+        text = git.read_text().strip()
+        if text.startswith("gitdir:"):
+            return project_dir / text[len("gitdir:") :].strip()
+    return git
+
+
+def _manifest_rev(project_dir: Path) -> str | None:
+    """The commit west imports the project's manifests from, or None."""
+    git = _git_dir(project_dir)
+    try:
+        return (git / MANIFEST_REV).read_text().strip()
+    except OSError:
+        pass
+    try:
+        with open(git / "packed-refs") as f:
+            for line in f:
+                if line.rstrip().endswith(" " + MANIFEST_REV):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+def _import_paths(imp) -> list[str]:
+    """The files or directories named by an `import:` value."""
+    if imp is True:
+        return ["west.yml"]
+    if isinstance(imp, str):
+        return [imp]
+    if isinstance(imp, list):
+        return [path for item in imp for path in _import_paths(item)]
+    if isinstance(imp, dict):
+        return [imp.get("file", "west.yml")]
+    return []
+
+
+def _manifest_files(manifest_file: Path, repo: Path) -> list[Path]:
+    """The manifest file and the files it imports from the manifest
+    repository, which west reads from the file system."""
+    import yaml
+
+    files: list[Path] = []
+    pending = [manifest_file]
+    while pending:
+        path = pending.pop()
+        if path in files:
+            continue
+        files.append(path)
+        if path.is_dir():
+            pending += sorted(path.glob("*.yml"), reverse=True)
+            continue
+        try:
+            data = yaml.safe_load(path.read_text())
+            imp = data["manifest"]["self"]["import"]
+        except (OSError, ValueError, yaml.YAMLError, KeyError, TypeError):
+            continue
+        pending += [repo / p for p in reversed(_import_paths(imp))]
+    return files
+
+
+class WorkspaceIndex:
+    def __init__(self, topdir: Path, data: dict, manifest=None):
+        self.topdir = Path(topdir)
+        self._data = data
+        self._manifest = manifest
+
+    @property
+    def manifest_path(self) -> Path:
+        return Path(self._data["manifest_path"])
+
+    def project(self, name: str) -> Project | None:
+        path = self._data["projects"].get(name)
+        return Project(name, path) if path is not None else None
+
+    def manifest(self):
+        """The full west Manifest, parsed on first use."""
+        if self._manifest is None:
+            from west.manifest import Manifest
+
+            self._manifest = Manifest.from_topdir(topdir=str(self.topdir))
+        return self._manifest
+
+    def studio_proto_dir(self, search) -> Path:
+        """zmk-studio-messages' `proto/zmk` dir: from the manifest project,
+        else the cached result of `search(topdir)` (e.g. the renode harness's
+        recursive `find_studio_proto_dir`), else a fresh search."""
+        project = self.project("zmk-studio-messages")
+        if project is not None:
+            candidate = Path(project.abspath) / "proto" / "zmk"
+            if candidate.is_dir():
+                return candidate
+        cached = self._data.setdefault("found", {}).get("studio_proto_dir")
+        if cached and Path(cached).is_dir():
+            return Path(cached)
+        found = Path(search(self.topdir))
+        self._data["found"]["studio_proto_dir"] = str(found)
+        _save(self.topdir, self._data)
+        return found
+
+
+def _valid(data: dict, topdir: Path) -> bool:
+    if data.get("version") != INDEX_VERSION or data.get("topdir") != str(topdir):
+        return False
+    return all(_digest(Path(path)) == digest for path, digest in data["files"]) and all(
+        _manifest_rev(Path(path)) == rev for path, rev in data["manifest_revs"]
+    )
+
+
+def _save(topdir: Path, data: dict) -> None:
+    path = topdir / ".west" / INDEX_FILE
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, prefix=f".{INDEX_FILE}.", delete=False
+        ) as f:
+            json.dump(data, f, indent=2)
+        os.replace(f.name, path)
+    except OSError:
+        pass
+
+
+def load(topdir: Path | str | None = None) -> WorkspaceIndex:
+    """The index of the workspace at `topdir` (default: the enclosing one),
+    rebuilt from the west manifest when stale."""
+    if topdir is None:
+        from west.util import west_topdir
+
+        topdir = west_topdir()
+    topdir = Path(topdir).absolute()
+
+    try:
+        with open(topdir / ".west" / INDEX_FILE, "r") as f:
+            data = json.load(f)
+        if _valid(data, topdir):
+            return WorkspaceIndex(topdir, data)
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+
+    from west.manifest import Manifest
+
+    manifest = Manifest.from_topdir(topdir=str(topdir))
+    files = [
+        topdir / ".west" / "config",
+        *_manifest_files(Path(manifest.abspath), Path(manifest.repo_abspath)),
+    ]
+    data = {
+        "version": INDEX_VERSION,
+        "topdir": str(topdir),
+        "manifest_path": str(manifest.abspath),
+        "projects": {project.name: project.abspath for project in manifest.projects},
+        # Missing files and refs are recorded too, so that one appearing is
+        # a change.
+        "files": [[str(path), _digest(path)] for path in files],
+        "manifest_revs": [
+            [project.abspath, _manifest_rev(Path(project.abspath))]
+            for project in manifest.projects[1:]
+        ],
+        "found": {},
+    }
+    _save(topdir, data)
+    return WorkspaceIndex(topdir, data, manifest)
@@ -18,9 +18,10 @@ from pathlib import Path
 
 from west import log
 from west.commands import WestCommand
-from west.manifest import Manifest
 from west.util import west_topdir
 
+from lib import workspace_index
+
 # scripts/lib/ble holds the orchestration core (runner.py).
 LIB_BLE_DIR = Path(__file__).resolve().parent / "lib" / "ble"
 
@@ -90,6 +91,25 @@ class ZMKBleTest(WestCommand):
             default=1,
             help="Run cases concurrently (default 1). Per-case sim ids isolate the phys.",
         )
+        parser.add_argument(
+            "--build-parallel",
+            type=int,
+            metavar="N",
+            help=(
+                "Firmware builds run concurrently (default: --parallel), sharing the CPUs "
+                "via ninja -j. Simulations start as soon as a case is built."
+            ),
+        )
+        parser.add_argument(
+            "--sim-timeout",
+            type=float,
+            default=120.0,
+            metavar="SECONDS",
+            help=(
+                "Wall-clock limit for one case's simulation (default 120). Cases end "
+                "earlier at their simulated length or when their sim_done patterns match."
+            ),
+        )
         parser.add_argument(
             "-v",
             "--verbose",
@@ -100,10 +120,8 @@ class ZMKBleTest(WestCommand):
 
     def do_run(self, args, unknown_args):
         # Resolve the zmk project the same way zmk_test.py does.
-        manifest = Manifest.from_topdir()
-        try:
-            zmk = next(filter(lambda p: p.name == "zmk", manifest.projects))
-        except StopIteration:
+        zmk = workspace_index.load().project("zmk")
+        if zmk is None:
             log.die("ZMK project not found in the west manifest.")
         zmk_app = Path(zmk.abspath) / "app"
         if not zmk_app.is_dir():
@@ -140,11 +158,14 @@ class ZMKBleTest(WestCommand):
             auto_accept=auto_accept,
             verbose=args.verbose,
             log=log,
+            sim_timeout=args.sim_timeout,
         )
 
         try:
             runner.build_host_apps()
-            results = runner.run(cases, parallel=max(1, args.parallel))
+            results = runner.run(
+                cases, parallel=max(1, args.parallel), build_parallel=args.build_parallel
+            )
         except Exception as err:  # BleTestError and friends
             log.die(str(err))
 
@@ -2,10 +2,11 @@ import concurrent.futures
 import itertools
 import json
 import sys
+import threading
+import time
 from west import log
 from west.commands import WestCommand
 from west.util import west_topdir
-from west.manifest import Manifest
 import yaml
 import tempfile
 import shutil
@@ -15,6 +16,11 @@ import os
 import re
 import argparse
 import traceback
+from lib import build_timing, build_workers, file_watch, workspace_index
+from lib.build_cache import CACHED_FILES, BuildCache
+from lib.changed_targets import ChangedFilesError, affected_entries, changed_files
+from lib.compiler_cache import CompilerCache, format_hit_rate
+from lib.configure_cache import ConfigureCache, group_key
 from lib.tee_popen import TeePopen
 
 
@@ -25,6 +31,44 @@ def check_regex(pattern):
         raise argparse.ArgumentTypeError(f"Invalid regex pattern: {pattern}")
 
 
+class JobBudget:
+    """One compile-job budget shared by all concurrently running builds.
+
+    Every `west build` would otherwise let Ninja spawn a job per core, so
+    `--parallelism` concurrent builds run `parallelism * cores` compilers.
+    Instead, each build takes its share of the jobs still free when it starts
+    (at least 1, waiting for a finishing build when none are free) and hands
+    them back when it finishes; builds starting near the end of the matrix,
+    when fewer are left to share with, get more.
+    """
+
+    def __init__(self, total: int, pending: int, parallelism: int):
+        self.total = total
+        self.free = total
+        self.pending = pending
+        self.running = 0
+        self.parallelism = parallelism
+        self._free_changed = threading.Condition()
+
+    def acquire(self) -> int:
+        with self._free_changed:
+            while self.free <= 0:
+                self._free_changed.wait()
+            sharers = max(1, min(self.parallelism - self.running, self.pending))
+            # Rounded up, but at most all that is free.
+            jobs = -(-self.free // sharers)
+            self.free -= jobs
+            self.running += 1
+            self.pending -= 1
+            return jobs
+
+    def release(self, jobs: int) -> None:
+        with self._free_changed:
+            self.free += jobs
+            self.running -= 1
+            self._free_changed.notify_all()
+
+
 class ZMKBuild(WestCommand):
     # CMake args for debug build with Segger J-Link and RTT console
     DEBUG_CMAKE_ARGS = [
@@ -48,6 +92,19 @@ class ZMKBuild(WestCommand):
         "-DCONFIG_THREAD_STACK_INFO=y",
         "-DCONFIG_INIT_STACKS=y",
     ]
+    # Records the CMake invocation of the last successful build for --pristine smart
+    FINGERPRINT_FILE = ".zmk-build-fingerprint.json"
+    # Options of the --serve coordinator that --worker builds use instead of their own.
+    # Paths and caches (config path, build dir, extra modules, ...) stay the worker's.
+    WORKER_OPTIONS = [
+        "west_args",
+        "cmake_args",
+        "snippet",
+        "pristine",
+        "debug_jlink",
+        "reset",
+        "debug_print",
+    ]
 
     def __init__(self):
         super().__init__(
@@ -58,6 +115,8 @@ class ZMKBuild(WestCommand):
             The command parses build.yaml to set up the build target automatically.
             """,
         )
+        # Output of builds run for a --serve coordinator, by matrix id
+        self._log_streams: dict[int, build_workers.LogStream] = {}
 
     def do_add_parser(self, parser_adder):
         parser = parser_adder.add_parser(self.name, help=self.help, description=self.description)
@@ -206,12 +265,107 @@ class ZMKBuild(WestCommand):
             Number of parallel build jobs. Defaults to number of CPU cores.
             """,
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=os.cpu_count(),
+            help="""
+            Total number of compile jobs shared by all parallel builds. Each build passes its share to
+            Ninja as -j, so the whole matrix runs about this many compilers at once.
+            Defaults to number of CPU cores. 0 leaves Ninja's own default to each build.
+            Not applied when a build tool option (-o) is passed in west_args.
+            """,
+        )
         parser.add_argument(
             "-p",
             "--pristine",
-            choices=["auto", "always", "never"],
-            default="always",
-            help="pristine build folder setting (the same to west build argument)",
+            choices=["auto", "always", "never", "smart"],
+            default=None,
+            help="""
+            pristine build folder setting (the same to west build argument).
+            'smart' goes pristine only when the CMake invocation of the target (board, shield, extra modules,
+            snippets, cmake args) differs from the last successful build in the artifact directory,
+            otherwise it rebuilds incrementally.
+            Defaults to 'always', or to 'smart' with --watch.
+            """,
+        )
+        parser.add_argument(
+            "--build-cache",
+            nargs="?",
+            const="",
+            default=None,
+            metavar="CACHE_DIR",
+            help="""
+            Reuse firmware from a content-addressed cache when nothing that affects a build target changed
+            (board, shield, snippets, cmake args, zmk-config / extra module contents, ZMK and Zephyr revisions).
+            A cache hit restores zmk.uf2, zmk.elf and .config into the artifact directory without running CMake.
+            `<west workspace root>/.cache/zmk-build` by default. Ignored when --flash is specified.
+            """,
+        )
+        parser.add_argument(
+            "--compiler-cache",
+            choices=["ccache", "sccache", "none"],
+            help="""
+            Compiler cache used by all build targets, shared under `<west workspace root>/.cache/`
+            (unless CCACHE_DIR / SCCACHE_DIR is set). Hit rates are reported after the build.
+            'none' disables Zephyr's own ccache detection. Zephyr's default is used when omitted.
+            """,
+        )
+        parser.add_argument(
+            "--changed-only",
+            metavar="GIT_REV",
+            help="""
+            Only build the targets affected by files changed since GIT_REV in the zmk-config and extra module
+            repositories (e.g. `--changed-only origin/main`). Shield, board, keymap / conf and snippet files
+            select their own targets; any other change builds everything. The rest are reported as skipped.
+            """,
+        )
+        parser.add_argument(
+            "--watch",
+            action="store_true",
+            help="""
+            After building, keep watching the zmk-config and extra module directories and rebuild the
+            targets affected by each saved change (incrementally, flashing them with --flash).
+            Prints which targets broke or got fixed.
+            """,
+        )
+        parser.add_argument(
+            "--shared-configure",
+            action="store_true",
+            help="""
+            Share toolchain detection, board lookup and CMake's compiler identification between build
+            targets on the same board. The first target of each board configures normally and the rest
+            reuse its results.
+            """,
+        )
+        parser.add_argument(
+            "--serve",
+            metavar="ADDRESS",
+            help="""
+            Hand the build targets out to `--worker` processes instead of building them here.
+            ADDRESS is `host:port` or a Unix socket path. Build output and firmware files are sent back
+            into the local build directory. Set ZMK_BUILD_AUTHKEY to the same secret on all sides;
+            it is required for TCP addresses.
+            """,
+        )
+        parser.add_argument(
+            "--worker-timeout",
+            type=float,
+            default=600,
+            metavar="SECONDS",
+            help="""
+            With --serve, give up on the remaining build targets once no worker has been connected for
+            this long (none came, or all of them dropped). 600 seconds by default.
+            """,
+        )
+        parser.add_argument(
+            "--worker",
+            metavar="ADDRESS",
+            help="""
+            Build targets handed out by the `--serve` coordinator at ADDRESS, --parallelism at a time,
+            until it has none left. Uses this workspace, zmk-config and build directory.
+            """,
         )
         parser.add_argument(
             "--debug-jlink",
@@ -251,6 +405,8 @@ class ZMKBuild(WestCommand):
             Flash the built firmware after successful build.
             Flash arguments can be specified like `+r uf2 ++foo bar`.
             + or ++ is replaced with -, -- and passed to west flash command.
+            With multiple build targets, each is flashed as soon as its build finishes, one at a time.
+            `flash-args` of a build.yaml entry are appended for that target.
             """,
         )
         parser.add_argument(
@@ -264,12 +420,11 @@ class ZMKBuild(WestCommand):
         return parser
 
     def do_run(self, args, unknown_args):
-        manifest = Manifest.from_topdir()
-        log.inf(f"[*] west workspace: {manifest.topdir}")
-        log.inf(f"[*] west manifest: {manifest.abspath}")
-        try:
-            zmk = next(filter(lambda p: p.name == "zmk", manifest.projects))
-        except StopIteration:
+        workspace = workspace_index.load()
+        log.inf(f"[*] west workspace: {workspace.topdir}")
+        log.inf(f"[*] west manifest: {workspace.manifest_path}")
+        zmk = workspace.project("zmk")
+        if zmk is None:
             log.die("[*] ZMK project not found in manifest.")
 
         # Rewrite args
@@ -277,13 +432,20 @@ class ZMKBuild(WestCommand):
             log.inf(f"[*] zmk-config/config directory: {Path(args.config_path)}")
             args.config_path = str(Path(args.config_path) / "config")
 
+        # Watch rebuilds run on every save, so they keep the build dirs by default.
+        if args.pristine is None:
+            args.pristine = "smart" if args.watch else "always"
+
+        if args.worker:
+            exit(self._run_worker(zmk, workspace, args))
+
         zmk_config = args.config_path
         build_yaml = (
             self._load_yaml(args.build_yaml)
             if args.build_yaml
             else self._find_build_yaml(Path(zmk_config))
         )
-        exit(self._run_for_all(zmk, manifest, args, build_yaml))
+        exit(self._run_for_all(zmk, workspace, args, build_yaml))
 
     def _find_build_yaml(self, config_path: Path) -> dict:
         parent_dir = config_path.parent
@@ -334,7 +496,7 @@ class ZMKBuild(WestCommand):
             log.dbg(f"[{id}] Auto discovered extra modules ({strategy}): {result}")
         return result
 
-    def _run_for_all(self, zmk, manifest, args, build_yaml: dict) -> int:
+    def _run_for_all(self, zmk, workspace, args, build_yaml: dict) -> int:
         # build all build matrix
         boards = set(args.board if args.board else build_yaml.get("boards", []))
         shields = set(args.shield if args.shield else build_yaml.get("shields", []))
@@ -365,8 +527,10 @@ class ZMKBuild(WestCommand):
         if len(matrix) == 0:
             log.die("No build targets found. Specify boards/shields or check build.yaml.")
 
-        if len(matrix) > 1 and args.flash is not None:
-            log.die("Cannot flash when multiple build targets are specified.")
+        if args.serve and args.flash is not None:
+            log.die("Cannot flash when serving build targets to workers.")
+        if args.serve and args.watch:
+            log.die("Cannot watch for changes when serving build targets to workers.")
 
         # set artifact name if not exists
         for i, inc in enumerate(matrix):
@@ -419,43 +583,337 @@ class ZMKBuild(WestCommand):
         if args.vscode:
             self._generate_vscode_settings(args, matrix)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallelism) as executor:
-            futures = [
-                executor.submit(self._run_single_build, id, zmk, manifest, args, inc)
+        skipped_results = []
+        if args.changed_only:
+            affected = self._changed_targets(args, matrix)
+            for id, inc in enumerate(matrix):
+                if id not in affected:
+                    message = f"Skipped, no inputs changed since {args.changed_only}"
+                    log.inf(f"[{id}] {inc['artifact']} : {message}")
+                    skipped_results.append(
+                        {
+                            "id": id,
+                            "artifact": inc["artifact"],
+                            "success": True,
+                            "message": message,
+                        }
+                    )
+        skipped_ids = {result["id"] for result in skipped_results}
+        build_ids = [id for id in range(len(matrix)) if id not in skipped_ids]
+
+        # Build order: longest expected build first, so that a slow target
+        # does not start last and stretch the total time.
+        order = [
+            build_ids[i]
+            for i in build_timing.longest_first(
+                [matrix[id]["artifact"] for id in build_ids],
+                build_timing.load_history(self._build_root(args)),
+            )
+        ]
+        if args.serve:
+            results = self._serve(args, matrix, order)
+        else:
+            results = self._run_local(zmk, workspace, args, matrix, order)
+        status = self._report_results(args, skipped_results + results)
+        if args.watch:
+            return self._watch(zmk, workspace, args, matrix, skipped_results + results)
+        return status
+
+    def _watch(self, zmk, workspace, args, matrix, results) -> int:
+        """Rebuild the entries affected by each batch of file changes until
+        interrupted, classified like --changed-only."""
+        config_path = Path(args.config_path).absolute()
+        extra_modules = self._extra_modules(0, args)
+        snippets = [self._snippets(args, inc) for inc in matrix]
+        latest = {result["id"]: result for result in results}
+        watcher = file_watch.Watcher(
+            [config_path.parent, *map(Path, extra_modules)], ignore=[self._build_root(args)]
+        )
+        log.inf(
+            f"[*] Watching {', '.join(map(str, watcher.roots))}"
+            f"{' (polling)' if watcher.polling else ''}, Ctrl-C to stop."
+        )
+        try:
+            while True:
+                files = watcher.wait()
+                for path in sorted(files):
+                    log.dbg(f"[*]  - changed: {path}")
+                if watcher.lost_events(files):
+                    log.wrn("[*] File change events were lost, rebuilding every target.")
+                    affected = set(range(len(matrix)))
+                else:
+                    affected = affected_entries(
+                        matrix, snippets, files, config_path, extra_modules
+                    )
+                if not affected:
+                    log.inf(f"[*] {len(files)} files changed, no build targets affected.")
+                    continue
+                log.inf(f"[*] {len(files)} files changed, rebuilding {len(affected)} targets...")
+                started = time.monotonic()
+                batch = self._run_local(zmk, workspace, args, matrix, sorted(affected))
+                self._report_delta(latest, batch, time.monotonic() - started)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        return 1 if any(not result["success"] for result in latest.values()) else 0
+
+    def _report_delta(self, latest, batch, wall) -> None:
+        """One line per rebuilt entry, marking the ones that broke or got
+        fixed since their previous build, then a total."""
+        for result in sorted(batch, key=lambda result: result["id"]):
+            previous = latest.get(result["id"])
+            change = ""
+            if previous is not None and previous["success"] != result["success"]:
+                change = " (fixed)" if result["success"] else " (broke)"
+            line = f"  [{result['id']}] {result['artifact']}: "
+            if result["success"]:
+                log.inf(f"{line}ok{change}")
+            else:
+                log.err(f"{line}FAILED{change} {result['message']}")
+            latest[result["id"]] = result
+        ok = sum(result["success"] for result in latest.values())
+        log.inf(
+            f"[*] {ok} of {len(latest)} build targets OK ({len(batch)} rebuilt in {wall:.1f}s)."
+        )
+
+    def _prepare_builds(self, args, workspace, pending: int) -> None:
+        """Set up the state shared by the builds run in this process."""
+        self._build_cache = None
+        if args.build_cache is not None and args.flash is None:
+            cache_dir = (
+                Path(args.build_cache)
+                if args.build_cache
+                else workspace.topdir / ".cache" / "zmk-build"
+            )
+            log.inf(f"[*] Build cache: {cache_dir}")
+            self._build_cache = BuildCache(cache_dir, workspace.manifest())
+
+        self._job_budget = None
+        if args.jobs and args.jobs > 0:
+            self._job_budget = JobBudget(
+                args.jobs, pending, min(args.parallelism, max(pending, 1))
+            )
+
+        self._compiler_cache = None
+        if args.compiler_cache and not args.skip_build:
+            self._compiler_cache = CompilerCache(args.compiler_cache, Path(west_topdir()))
+            if args.compiler_cache != "none" and self._compiler_cache.executable is None:
+                log.die(f"--compiler-cache {args.compiler_cache}: {args.compiler_cache} not found")
+            self._compiler_cache.begin()
+
+        self._configure_cache = None
+        self._configure_groups = {}
+        self._configure_leaders = set()
+
+    def _run_local(self, zmk, workspace, args, matrix, order) -> list[dict]:
+        self._prepare_builds(args, workspace, len(order))
+        # --shared-configure group leaders go before everything else so that
+        # no follower waits on a leader still queued.
+        if args.shared_configure and not args.skip_build:
+            self._configure_cache = ConfigureCache(
+                self._build_root(args) / ".zmk-build-configure-cache.json"
+            )
+            self._configure_groups = {
+                id: group_key(
+                    inc["board"], self._extra_modules(id, args), self._cmake_args(args, inc)
+                )
                 for id, inc in enumerate(matrix)
-            ]
-            any_failed = False
+            }
+            self._configure_leaders = {
+                order[i]
+                for i in self._configure_cache.plan([self._configure_groups[id] for id in order])
+            }
+            order.sort(key=lambda id: id not in self._configure_leaders)
+
+        self._run_started = time.monotonic()
+        # Flashing runs on its own single thread, one device at a time, each
+        # target as soon as its build is done while the others still build.
+        with (
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.parallelism) as executor,
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as flash_executor,
+        ):
+            futures = {
+                executor.submit(self._run_single_build, id, zmk, workspace, args, matrix[id]): id
+                for id in order
+            }
             results = []
-            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            flash_futures = {}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
                 try:
                     result = future.result()
-                    results.append(result)
-                    if not result["success"]:
-                        any_failed = True
                 except Exception as e:
                     trace_str = traceback.format_exc()
-                    results.append(
-                        {
-                            "id": i,
-                            "artifact": matrix[i]["artifact"],
-                            "success": False,
-                            "message": "Unexpected error: " + f"{e}\n{trace_str}",
-                        }
-                    )
-                    any_failed = True
-            if any_failed:
-                log.err("Some builds failed!")
-                for result in results:
-                    message = f"[{result['id']}] {result['artifact']} : {result['message']}"
-                    if not result["success"]:
-                        log.err(message)
-                    else:
-                        log.inf(message)
+                    result = {
+                        "id": i,
+                        "artifact": matrix[i]["artifact"],
+                        "success": False,
+                        "message": "Unexpected error: " + f"{e}\n{trace_str}",
+                    }
+                results.append(result)
+                if args.flash is not None and result["success"]:
+                    flash_futures[flash_executor.submit(self._flash, i, args, matrix[i])] = result
+
+            for future, result in flash_futures.items():
+                try:
+                    flashed = future.result() == 0
+                except Exception as e:
+                    log.err(f"[{result['id']}] Flashing failed: {e}")
+                    flashed = False
+                if not flashed:
+                    result["success"] = False
+                if result["message"]:
+                    result["message"] += " and flashed." if flashed else " but flashing failed."
+                else:
+                    result["message"] = "Flashed." if flashed else "Flashing failed."
+            return results
+
+    def _report_results(self, args, results) -> int:
+        any_failed = any(not result["success"] for result in results)
+        if any_failed:
+            log.err("Some builds failed!")
+        if any_failed or args.flash is not None:
+            for result in results:
+                message = f"[{result['id']}] {result['artifact']} : {result['message']}"
+                if not result["success"]:
+                    log.err(message)
+                else:
+                    log.inf(message)
+        if not any_failed:
+            log.inf("All builds succeeded.")
+        if self._compiler_cache is not None and args.compiler_cache != "none":
+            self._report_compiler_cache(results)
+        self._report_timings(args, results)
+        return 1 if any_failed else 0
+
+    def _serve(self, args, matrix, order) -> list[dict]:
+        """Build `order` on --worker processes; see lib/build_workers.py."""
+        self._compiler_cache = None
+        address = build_workers.parse_address(args.serve)
+        if isinstance(address, str) and Path(address).is_socket():
+            # Left over from a coordinator that did not shut down cleanly
+            os.unlink(address)
+        self._dispatched = {}
+        try:
+            coordinator = build_workers.Coordinator(
+                args.serve,
+                order,
+                {id: {"build_setup": matrix[id]} for id in order},
+                {name: getattr(args, name) for name in self.WORKER_OPTIONS},
+                lambda id, message, payload: self._on_worker_message(
+                    args, matrix[id], id, message, payload
+                ),
+            )
+        except ValueError as e:
+            log.die(f"[*] Cannot serve on {args.serve}: {e}")
+        log.inf(f"[*] Serving {len(order)} build targets on {args.serve}, waiting for workers")
+        self._run_started = time.monotonic()
+        results = coordinator.run(idle_timeout=args.worker_timeout)
+
+        for result in results:
+            worker, dispatched = self._dispatched[result["id"]]
+            build_dir = self._build_root(args) / result["artifact"]
+            if result["success"]:
+                result["message"] = f"Succeeded on {worker} in {build_dir / 'zephyr' / 'zmk.uf2'}"
             else:
-                log.inf("All builds succeeded.")
-            return 1 if any_failed else 0
+                result["message"] += (
+                    f" (on {worker}, log in {build_dir / 'stdout_and_stderr.log'})"
+                )
+            if "timing" in result:
+                # Worker clocks are unrelated to ours; place the build at the
+                # time it was handed out.
+                timing = result["timing"]
+                timing["worker"] = f"{worker}/{timing['worker']}"
+                timing["queue_wait"] = timing["start"] = dispatched - self._run_started
+                timing["end"] = timing["start"] + timing["wall"]
+
+        unbuilt = sorted(set(order) - {result["id"] for result in results})
+        if unbuilt:
+            log.err(
+                f"[*] No worker connected for {args.worker_timeout:g}s, "
+                f"giving up on {len(unbuilt)} build targets."
+            )
+        for id in unbuilt:
+            results.append(
+                {
+                    "id": id,
+                    "artifact": matrix[id]["artifact"],
+                    "success": False,
+                    "message": "No worker was left to build it.",
+                }
+            )
+        return results
+
+    def _on_worker_message(self, args, build_setup, id, message, payload) -> None:
+        build_dir = self._build_root(args) / build_setup["artifact"]
+        log_file_path = build_dir / "stdout_and_stderr.log"
+        if message["type"] == "dispatched":
+            self._dispatched[id] = (message["worker"], time.monotonic())
+            os.makedirs(build_dir, exist_ok=True)
+            open(log_file_path, "w").close()
+            log.inf(f"[{id}] Building {build_setup['artifact']} on {message['worker']}")
+        elif message["type"] == "log":
+            with open(log_file_path, "a") as f:
+                f.write(message["text"])
+            if not args.quiet:
+                sys.stdout.write(message["text"])
+                sys.stdout.flush()
+        elif message["type"] == "artifact":
+            # Only accept the known firmware files, never arbitrary paths.
+            name = message["name"]
+            if name not in CACHED_FILES or payload is None:
+                log.wrn(f"[{id}] Ignoring unexpected artifact {name!r} from worker")
+                return
+            os.makedirs(build_dir / "zephyr", exist_ok=True)
+            with open(build_dir / "zephyr" / name, "wb") as f:
+                f.write(payload)
+
+    def _run_worker(self, zmk, workspace, args) -> int:
+        # The worker can't tell how many targets are left to share the jobs with.
+        self._prepare_builds(args, workspace, sys.maxsize)
+        self._run_started = time.monotonic()
+        log.inf(f"[*] Connecting {args.parallelism} build slots to {args.worker}")
+        try:
+            built = build_workers.work(
+                args.worker,
+                args.parallelism,
+                lambda channel, options, request: self._build_for_coordinator(
+                    channel, options, request, zmk, workspace, args
+                ),
+            )
+        except (OSError, ValueError, build_workers.AuthenticationError) as e:
+            log.die(f"[*] Cannot connect to {args.worker}: {e}")
+        log.inf(f"[*] No build targets left, built {built}.")
+        return 0
 
-    def _run_single_build(self, id, zmk, manifest, args, build_setup) -> dict:
+    def _build_for_coordinator(self, channel, options, request, zmk, workspace, args) -> dict:
+        id = request["id"]
+        build_setup = request["build_setup"]
+        worker_args = argparse.Namespace(**{**vars(args), **options})
+        self._log_streams[id] = build_workers.LogStream(channel, id)
+        try:
+            result = self._run_single_build(id, zmk, workspace, worker_args, build_setup)
+        except Exception as e:
+            result = {
+                "id": id,
+                "artifact": build_setup["artifact"],
+                "success": False,
+                "message": "Unexpected error: " + f"{e}\n{traceback.format_exc()}",
+            }
+        finally:
+            del self._log_streams[id]
+        if result["success"]:
+            zephyr_dir = self._build_root(args) / build_setup["artifact"] / "zephyr"
+            for name in CACHED_FILES:
+                if (zephyr_dir / name).is_file():
+                    channel.send(
+                        {"type": "artifact", "id": id, "name": name},
+                        (zephyr_dir / name).read_bytes(),
+                    )
+        return result
+
+    def _run_single_build(self, id, zmk, workspace, args, build_setup) -> dict:
         artifact_name = build_setup["artifact"]
         build_dir = (
             Path(args.build_dir) / artifact_name
@@ -469,31 +927,85 @@ class ZMKBuild(WestCommand):
             "message": "",
         }
         log.inf(f"[{id}] ---------------------")
+        started = time.monotonic()
+        ninja_log_offset = build_timing.ninja_log_offset(build_dir)
         if not args.skip_build:
-            result.update(self._build(id, zmk, args, build_setup, build_dir))
+            try:
+                result.update(self._build(id, zmk, args, build_setup, build_dir))
+            finally:
+                if id in self._configure_leaders:
+                    self._configure_cache.record(self._configure_groups[id], build_dir)
         else:
             log.inf(f"[{id}] Skipping build for {artifact_name} as per argument.")
-        if args.flash is not None and result["success"]:
-            log.inf(f"[{id}] ---------------------")
-            if self._flash(id, args, build_dir) != 0:
-                result["message"] += " but flashing failed."
-                result["success"] = False
+        finished = time.monotonic()
+        wall = finished - started
+        result["timing"] = {
+            "id": id,
+            "artifact": artifact_name,
+            "worker": threading.current_thread().name,
+            "queue_wait": started - self._run_started,
+            "start": started - self._run_started,
+            "end": finished - self._run_started,
+            "wall": wall,
+            **build_timing.split_phases(
+                wall, *build_timing.ninja_phases(build_dir, ninja_log_offset)
+            ),
+            "peak_rss": result.pop("peak_rss", None),
+            "cached": result.pop("cached", False),
+            "success": result["success"],
+        }
         return result
 
-    def _build(self, id, zmk, args, build_setup, build_dir) -> dict:
-        artifact_name = build_setup["artifact"]
-        zmk_src_dir = Path(zmk.abspath) / "app"
-        west_args = args.west_args
+    def _build_root(self, args) -> Path:
+        return Path(args.build_dir) if args.build_dir else Path(west_topdir()) / "build"
+
+    def _cmake_args(self, args, build_setup) -> list[str]:
         build_cmake_args = build_setup.get("cmake-args", build_setup.get("cmake_args", ""))
-        cmake_args = (
+        return (
             (args.cmake_args.split() if args.cmake_args else [])
             + build_cmake_args.split()
             + (self.DEBUG_CMAKE_ARGS if args.debug_jlink else [])
             + (["-DCONFIG_ZMK_SETTINGS_RESET_ON_START=y"] if args.reset else [])
         )
+
+    def _snippets(self, args, build_setup) -> list[str]:
+        # NOTE: 'snippets' is this commands' extension. Not supported by ZMK official build
+        snippets = args.snippet + build_setup.get("snippets", [])
+        if "snippet" in build_setup:
+            snippets.append(build_setup["snippet"])
+        if args.debug_print:
+            snippets.append("zmk-usb-logging")
+        return snippets
+
+    def _changed_targets(self, args, matrix) -> set[int]:
+        """Indexes of the matrix entries affected by changes since --changed-only."""
         config_path = Path(args.config_path).absolute()
+        extra_modules = self._extra_modules(0, args)
+        try:
+            files = changed_files(
+                [config_path] + [Path(m) for m in extra_modules], args.changed_only
+            )
+        except ChangedFilesError as e:
+            log.wrn(f"[*] --changed-only: {e}. Building all targets.")
+            return set(range(len(matrix)))
+        for path in files:
+            log.dbg(f"[*]  - changed: {path}")
+        affected = affected_entries(
+            matrix,
+            [self._snippets(args, inc) for inc in matrix],
+            files,
+            config_path,
+            extra_modules,
+        )
+        log.inf(
+            f"[*] {len(files)} files changed since {args.changed_only}, "
+            f"{len(affected)} of {len(matrix)} build targets affected"
+        )
+        return affected
 
-        extra_modules = list(
+    def _extra_modules(self, id, args) -> list[str]:
+        config_path = Path(args.config_path).absolute()
+        return list(
             set(
                 [str(Path(extra_module).absolute()) for extra_module in args.extra_modules]
                 + list(
@@ -506,27 +1018,23 @@ class ZMKBuild(WestCommand):
                 )
             )
         )
-        # NOTE: 'snippets' is this commands' extension. Not supported by ZMK official build
-        snippets = list(map(lambda s: f"-S {s}", args.snippet + build_setup.get("snippets", [])))
-        if "snippet" in build_setup:
-            snippets.append(f"-S {build_setup['snippet']}")
-        if args.debug_print:
-            snippets.append("-S zmk-usb-logging")
+
+    def _build(self, id, zmk, args, build_setup, build_dir) -> dict:
+        artifact_name = build_setup["artifact"]
+        zmk_src_dir = Path(zmk.abspath) / "app"
+        west_args = args.west_args
+        cmake_args = self._cmake_args(args, build_setup)
+        if self._compiler_cache is not None:
+            cmake_args += self._compiler_cache.cmake_args()
+        config_path = Path(args.config_path).absolute()
+        extra_modules = self._extra_modules(id, args)
+        snippets = [f"-S {s}" for s in self._snippets(args, build_setup)]
         os.makedirs(build_dir, exist_ok=True)
 
-        command = (
-            [
-                "west",
-                "build",
-                "-s",
-                str(zmk_src_dir),
-                "-d",
-                str(build_dir),
-                "-b",
-                build_setup["board"],
-                "-p",
-                args.pristine,
-            ]
+        # Everything that selects what gets built, i.e. the command minus the
+        # per-artifact build dir and pristine setting.
+        target_args = (
+            ["-s", str(zmk_src_dir), "-b", build_setup["board"]]
             + west_args
             + snippets
             + [
@@ -537,19 +1045,72 @@ class ZMKBuild(WestCommand):
             ]
             + cmake_args
         )
-        log.inf(f"[{id}] Building for {artifact_name} with command: " + " ".join(command))
         log_file_path = build_dir / "stdout_and_stderr.log"
 
-        with tempfile.NamedTemporaryFile(mode="w+", delete=False) as log_file:
-            proc = TeePopen(
-                command,
-                output_prefix=f"[{id}] ",
-                stdin=sys.stdin,
-                stdout=sys.stdout if not args.quiet else open(os.devnull, "w"),
-                stderr=sys.stderr if not args.quiet else open(os.devnull, "w"),
-                log_file=log_file,
-            ).start()
-            proc.wait()
+        cache_key = None
+        if self._build_cache is not None:
+            cache_key, cache_inputs = self._build_cache.key(
+                target_args, [str(config_path)] + extra_modules
+            )
+            if self._build_cache.restore(cache_key, build_dir / "zephyr"):
+                with open(log_file_path, "w") as f:
+                    f.write(f"Restored from build cache entry {cache_key}\n")
+                result = {
+                    "success": True,
+                    "cached": True,
+                    "message": f"Restored from cache in {build_dir / 'zephyr' / 'zmk.uf2'}",
+                }
+                log.inf(f"[{id}] {result['message']}")
+                return result
+            log.dbg(f"[{id}] Build cache miss: {cache_key}")
+
+        # After the cache lookup: a cache hit leaves the fingerprint in place,
+        # so the next smart build can still go incremental.
+        pristine = args.pristine
+        if pristine == "smart":
+            pristine = self._smart_pristine(id, build_dir, target_args)
+        command = ["west", "build", "-d", str(build_dir), "-p", pristine] + target_args
+
+        if self._configure_cache is not None and id not in self._configure_leaders:
+            seeds = self._configure_cache.seeds(self._configure_groups[id])
+            if seeds:
+                log.dbg(f"[{id}] Reusing configure results: {seeds}")
+                separator = command.index("--") + 1
+                command[separator:separator] = seeds
+
+        jobs = None
+        if self._job_budget is not None and not any(
+            arg.startswith("-o") or arg.startswith("--build-opt") for arg in west_args
+        ):
+            jobs = self._job_budget.acquire()
+            # `west build -o` forwards options to the build tool (Ninja)
+            command.insert(command.index("--"), f"-o=-j{jobs}")
+
+        log.inf(f"[{id}] Building for {artifact_name} with command: " + " ".join(command))
+
+        try:
+            with tempfile.NamedTemporaryFile(mode="wb+", delete=False) as log_file:
+                stream = self._log_streams.get(id)
+                # Binary mode: compiler output goes to the log undecoded
+                proc = TeePopen(
+                    command,
+                    output_prefix=f"[{id}] ",
+                    stdin=sys.stdin,
+                    stdout=stream or (sys.stdout if not args.quiet else None),
+                    stderr=stream or (sys.stderr if not args.quiet else None),
+                    log_file=log_file,
+                    text=False,
+                    capture="none",
+                    env=(
+                        self._compiler_cache.build_env(build_dir)
+                        if self._compiler_cache is not None
+                        else None
+                    ),
+                ).start()
+                proc.wait()
+        finally:
+            if jobs is not None:
+                self._job_budget.release(jobs)
         shutil.move(log_file.name, log_file_path)
         result = {
             # "success": boolean
@@ -559,7 +1120,7 @@ class ZMKBuild(WestCommand):
             result["message"] = f"Failed. See log in {log_file_path}"
             result["success"] = False
             if args.quiet:
-                with open(log_file_path, "r") as f:
+                with open(log_file_path, "r", errors="replace") as f:
                     log.wrn(f.read())
         elif not Path(build_dir / "zephyr" / "zmk.uf2").exists():
             result["message"] = (
@@ -569,6 +1130,15 @@ class ZMKBuild(WestCommand):
         else:
             result["message"] = f"Succeeded in {build_dir / 'zephyr' / 'zmk.uf2'}"
             result["success"] = True
+            if cache_key is not None:
+                self._build_cache.store(cache_key, cache_inputs, build_dir / "zephyr")
+        if proc.returncode == 0:
+            with open(build_dir / self.FINGERPRINT_FILE, "w") as f:
+                json.dump(target_args, f, indent=2)
+
+        if self._compiler_cache is not None:
+            result["compiler_cache"] = self._compiler_cache.artifact_stats(build_dir)
+        result["peak_rss"] = proc.peak_rss
 
         if result["success"]:
             log.inf(f"[{id}] {result['message']}")
@@ -576,7 +1146,55 @@ class ZMKBuild(WestCommand):
             log.err(f"[{id}] {result['message']}")
         return result
 
-    def _flash(self, id, args, build_dir: Path) -> int:
+    def _report_timings(self, args, results):
+        timings = [result["timing"] for result in results if "timing" in result]
+        if not timings:
+            return
+        makespan = time.monotonic() - self._run_started
+        timings_path = self._build_root(args) / "zmk-build-timings.json"
+        build_timing.write_json(timings_path, timings, makespan, args.parallelism)
+        if not args.skip_build:
+            build_timing.update_history(self._build_root(args), timings)
+        if not args.quiet:
+            log.inf(f"[*] Build timings (also written to {timings_path}):")
+            for line in build_timing.summary_lines(timings, makespan):
+                log.inf(f"[*] {line}")
+
+    def _report_compiler_cache(self, results):
+        log.inf(f"[*] {self._compiler_cache.kind} hit rates:")
+        artifact_stats = []
+        for result in sorted(results, key=lambda r: r["id"]):
+            stats = result.get("compiler_cache")
+            if stats is not None:
+                artifact_stats.append(stats)
+                log.inf(f"[{result['id']}] {result['artifact']} : {format_hit_rate(*stats)}")
+        total = self._compiler_cache.total_stats(artifact_stats)
+        if total is not None:
+            log.inf(f"[*] Total : {format_hit_rate(*total)}")
+
+    def _smart_pristine(self, id, build_dir: Path, target_args: list[str]) -> str:
+        """Pick the west build pristine setting for --pristine smart.
+
+        The fingerprint is dropped before building and rewritten only on
+        success, so an interrupted or failed build is configured from scratch
+        next time.
+        """
+        fingerprint_path = build_dir / self.FINGERPRINT_FILE
+        try:
+            with open(fingerprint_path, "r") as f:
+                previous = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            previous = None
+        if fingerprint_path.exists():
+            fingerprint_path.unlink()
+        if previous == target_args and (build_dir / "CMakeCache.txt").exists():
+            log.inf(f"[{id}] CMake invocation unchanged, building incrementally")
+            return "auto"
+        log.inf(f"[{id}] CMake invocation changed or unknown, building pristine")
+        return "always"
+
+    def _flash(self, id, args, build_setup) -> int:
+        build_dir = self._build_root(args) / build_setup["artifact"]
         command = [
             "west",
             "flash",
@@ -589,6 +1207,9 @@ class ZMKBuild(WestCommand):
             re.sub(r"^\+{1,2}", lambda m: "-" * len(m.group(0)), flash_arg)
             for flash_arg in args.flash
         ]
+        # Per-target runner arguments (e.g. which device to flash) from build.yaml
+        command += build_setup.get("flash-args", build_setup.get("flash_args", "")).split()
+        log.inf(f"[{id}] ---------------------")
         log.inf(f"[{id}] Flashing with command: " + " ".join(command))
         log_file_path = build_dir / "flash.log"
         with tempfile.NamedTemporaryFile(mode="w+", delete=False) as log_file:
@@ -598,6 +1219,7 @@ class ZMKBuild(WestCommand):
                 stdin=sys.stdin,
                 stdout=sys.stdout if not args.quiet else None,
                 log_file=log_file,
+                capture="none",
             ).start()
             proc.wait()
         shutil.move(log_file.name, log_file_path)
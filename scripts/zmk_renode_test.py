@@ -45,9 +45,10 @@ from pathlib import Path
 
 from west import log
 from west.commands import WestCommand
-from west.manifest import Manifest
 from west.util import west_topdir
 
+from lib import workspace_index
+
 # scripts/lib/renode holds the harness (renode_harness.py, renode_smoke.py,
 # rpc_client.py), install_renode.sh and platforms/. It is put on PYTHONPATH
 # for the module's own test files too -- they do `import renode_harness`.
@@ -469,27 +470,23 @@ class ZMKRenodeTest(WestCommand):
     def _find_studio_proto_dir(self, renode_harness) -> Path:
         """Resolve zmk-studio-messages' proto/zmk dir. Prefer the west
         manifest (same pattern zmk_test.py uses for `zmk`); fall back to the
-        harness's recursive glob under the west topdir."""
-        topdir = Path(west_topdir())
-        try:
-            manifest = Manifest.from_topdir()
-            project = next(filter(lambda p: p.name == "zmk-studio-messages", manifest.projects))
-            candidate = Path(project.abspath) / "proto" / "zmk"
-            if candidate.is_dir():
-                log.inf(f"[*] Studio protos: {candidate} (from manifest)")
-                return candidate
-            log.wrn(
-                f"zmk-studio-messages resolved to {project.abspath} but "
-                f"{candidate} does not exist; falling back to a recursive search."
-            )
-        except StopIteration:
+        harness's recursive glob under the west topdir, whose result the
+        workspace index keeps for the next run."""
+        workspace = workspace_index.load(west_topdir())
+        project = workspace.project("zmk-studio-messages")
+        if project is None:
             log.wrn(
                 "zmk-studio-messages not found in the west manifest; "
                 "falling back to a recursive search under the workspace."
             )
-
-        proto_dir = renode_harness.find_studio_proto_dir(topdir)
-        log.inf(f"[*] Studio protos: {proto_dir} (from search)")
+        elif not (Path(project.abspath) / "proto" / "zmk").is_dir():
+            log.wrn(
+                f"zmk-studio-messages resolved to {project.abspath} but "
+                f"{Path(project.abspath) / 'proto' / 'zmk'} does not exist; "
+                "falling back to a recursive search."
+            )
+        proto_dir = workspace.studio_proto_dir(renode_harness.find_studio_proto_dir)
+        log.inf(f"[*] Studio protos: {proto_dir}")
         return proto_dir
 
     def _run_module_tests(self, args, elf: Path) -> None:
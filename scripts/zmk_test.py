@@ -1,14 +1,22 @@
-import shutil
-import tempfile
 from west import log
 from west.commands import WestCommand
 from west.util import west_topdir
-from west.manifest import Manifest
 
 import os
-import subprocess
+import time
 from pathlib import Path
 
+from lib import file_watch, test_impact, test_results, workspace_index
+from lib.changed_targets import ChangedFilesError, changed_files
+from lib.native_sim_tests import (
+    FAILED,
+    PASS,
+    PENDING,
+    NativeSimRunner,
+    case_rel,
+    discover_cases,
+)
+
 
 class ZMKTest(WestCommand):
     """Run ZMK tests."""
@@ -17,7 +25,7 @@ class ZMKTest(WestCommand):
         super().__init__(
             name="zmk-test",
             help="run ZMK tests",
-            description="Run the ZMK test suite with zmk's run-test.sh script.",
+            description="Run ZMK native_sim test cases in parallel, like zmk's run-test.sh script.",
         )
 
     def do_add_parser(self, parser_adder):
@@ -49,6 +57,39 @@ class ZMKTest(WestCommand):
             Useful when running test under your zmk-module to include your module itself by specifying zmk-module repository root.
             """,
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            help="Number of test cases to build and run in parallel. CPU count by default.",
+        )
+        parser.add_argument(
+            "-p",
+            "--pristine",
+            action="store_true",
+            help="""
+            Build every test case from scratch in its own build directory, like run-test.sh.
+            By default cases differing only in their keymap share configured build trees.
+            """,
+        )
+        parser.add_argument(
+            "--affected-by",
+            metavar="GIT_REV",
+            help="""
+            Only run the test cases affected by files changed since GIT_REV in the test and extra module
+            repositories (e.g. `--affected-by origin/main`), judged by the sources, headers, Kconfig and
+            devicetree files each case's last build used. Cases not built successfully before always run.
+            """,
+        )
+        parser.add_argument(
+            "-w",
+            "--watch",
+            action="store_true",
+            help="""
+            After running, keep watching the test and extra module directories and re-run the test cases
+            affected by each saved change, with incremental builds. Prints the status changes.
+            """,
+        )
         parser.add_argument(
             "-v",
             "--verbose",
@@ -58,13 +99,10 @@ class ZMKTest(WestCommand):
         return parser
 
     def do_run(self, args, unknown_args):
-        manifest = Manifest.from_topdir()
-        try:
-            zmk = next(filter(lambda p: p.name == "zmk", manifest.projects))
-        except StopIteration:
+        zmk = workspace_index.load().project("zmk")
+        if zmk is None:
             log.die("ZMK project not found in manifest.")
 
-        zmk_src_dir = os.path.join(zmk.abspath, "app")
         test_path = (
             Path(args.test_path).absolute()
             if args.test_path and args.test_path != "all"
@@ -74,42 +112,163 @@ class ZMKTest(WestCommand):
             Path(args.build_dir).absolute() if args.build_dir else Path(west_topdir()) / "build"
         )
         extra_modules = list(map(lambda m: str(Path(m).absolute()), args.extra_modules))
-        log.inf(f"Running ZMK tests under {test_path} with build dir {build_dir}")
-
-        env = os.environ.copy()
-        env["ZMK_SRC_DIR"] = zmk_src_dir
-        env["ZMK_BUILD_DIR"] = str(build_dir)
-        env["ZMK_EXTRA_MODULES"] = ";".join(extra_modules)
-        env["ZMK_TESTS_VERBOSE"] = "1"
-        with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", delete=False) as out_log:
-            proc = subprocess.Popen(
-                [f"{zmk_src_dir}/run-test.sh", "."],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=10,
-                env=env,
-                cwd=test_path,
-            )
+        cases = discover_cases(test_path)
+        if not cases:
+            log.die(f"No test cases (native_sim.keymap) found under {test_path}")
+        if args.affected_by:
+            cases = self._affected_cases(args, cases, test_path, build_dir, extra_modules)
+            if not cases:
+                log.inf("No test cases affected.")
+                exit(0)
+        jobs = args.jobs or os.cpu_count() or 1
+        log.inf(
+            f"Running {len(cases)} ZMK tests under {test_path} with build dir {build_dir}"
+            f" ({min(jobs, len(cases))} in parallel)"
+        )
+
+        runner = NativeSimRunner(
+            zmk_app=Path(zmk.abspath) / "app",
+            tests_path=test_path,
+            build_dir=build_dir,
+            extra_modules=extra_modules,
+            auto_accept=bool(os.environ.get("ZMK_TESTS_AUTO_ACCEPT")),
+            verbose=args.verbose,
+            log=log,
+            shared=not args.pristine,
+        )
+        results = self._run_cases(runner, cases, jobs, build_dir)
+        self._report(args, results, build_dir)
+        if args.watch:
+            results = self._watch(args, runner, jobs, test_path, build_dir, extra_modules, results)
+        exit(1 if any(r.status == FAILED for r in results) else 0)
+
+    def _run_cases(self, runner, cases, jobs, build_dir, latest=None) -> list:
+        """Run `cases` and write the result files. With `latest` (the latest
+        result of every case so far, for a watch re-run), the new results are
+        merged into it: events are appended to the stream, and the summary,
+        reports and logs cover every case."""
+        tests_build = build_dir / "tests"
+        runner.events = test_results.EventStream(
+            tests_build / test_results.JSON_RESULTS, append=latest is not None
+        )
+        started = time.monotonic()
+        batch = runner.run(cases, jobs)
+        wall = time.monotonic() - started
+
+        results = batch
+        if latest is not None:
+            results = list({**latest, **{r.rel: r for r in batch}}.values())
+            runner.write_pass_fail(results)
+        records = [r.as_dict() for r in results]
+        runner.events.emit("summary", wall=wall, **test_results.counts(records))
+        runner.events.close()
+        test_results.write_junit(tests_build / test_results.JUNIT_XML, "zmk-test", records, wall)
+
+        with open(build_dir / "stdout_and_stderr.log", "w") as log_file:
+            for result in results:
+                log_file.write(f"{result.summary}\n")
+                if result.output:
+                    log_file.write(result.output.rstrip() + "\n")
+        return batch
+
+    def _report(self, args, results, build_dir) -> None:
+        tests_build = build_dir / "tests"
+        log.inf("")
+        for result in sorted(results, key=lambda r: r.rel):
+            log.inf(result.summary)
+        if len(results) > 1:
+            log.inf("Slowest test cases:")
+            for line in test_results.slowest_lines([r.as_dict() for r in results]):
+                log.inf(f"  {line}")
+        log.inf(
+            f"Results: {tests_build / test_results.JSON_RESULTS},"
+            f" {tests_build / test_results.JUNIT_XML}"
+        )
+        failed = [r for r in results if r.status == FAILED]
+        if failed and not args.verbose:
+            log.err(f"Tests failed. See {build_dir / 'stdout_and_stderr.log'} for details.")
+            for result in failed:
+                log.inf(result.summary)
+                for line in result.output.rstrip().splitlines():
+                    log.inf(line)
 
-            for line in proc.stdout:
-                out_log.write(line)
-                if (
-                    line.startswith("PASS:")
-                    or line.startswith("FAILED:")
-                    or line.startswith("PENDING:")
-                    or line.startswith("Running:")
-                ):
-                    log.inf(line.rstrip())
-                elif args.verbose:
-                    log.dbg(line.rstrip())
-        proc.wait()
-        log_file_path = build_dir / "stdout_and_stderr.log"
-        shutil.move(out_log.name, log_file_path)
-
-        if proc.returncode != 0 and not args.verbose:
-            log.err(f"Tests failed. See {log_file_path} for details.")
-            with open(log_file_path, "r") as log_file:
-                for line in log_file:
-                    log.inf(line.rstrip())
-        exit(proc.returncode)
+    def _watch(self, args, runner, jobs, test_path, build_dir, extra_modules, results) -> list:
+        """Re-run the cases affected by each batch of file changes until
+        interrupted; returns the latest result of every case."""
+        latest = {r.rel: r for r in results}
+        watcher = file_watch.Watcher([test_path, *map(Path, extra_modules)], ignore=[build_dir])
+        log.inf(
+            f"Watching {', '.join(map(str, watcher.roots))}"
+            f"{' (polling)' if watcher.polling else ''}, Ctrl-C to stop."
+        )
+        try:
+            while True:
+                files = watcher.wait()
+                for path in sorted(files):
+                    log.dbg(f" - changed: {path}")
+                if watcher.lost_events(files):
+                    log.wrn("File change events were lost, re-running every test case.")
+                    cases = discover_cases(test_path)
+                else:
+                    cases = [
+                        case
+                        for case in discover_cases(test_path)
+                        if test_impact.is_affected(
+                            case, build_dir / "tests" / case_rel(test_path, case), files
+                        )
+                    ]
+                if not cases:
+                    log.inf(f"{len(files)} files changed, no test cases affected.")
+                    continue
+                log.inf(f"{len(files)} files changed, running {len(cases)} test cases...")
+                started = time.monotonic()
+                batch = self._run_cases(runner, cases, jobs, build_dir, latest)
+                self._report_delta(latest, batch, time.monotonic() - started)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        return list(latest.values())
+
+    def _report_delta(self, latest, batch, wall) -> None:
+        """Status changes of `batch` against `latest` (updated), the diffs of
+        failures and a one-line total."""
+        for result in sorted(batch, key=lambda r: r.rel):
+            previous = latest.get(result.rel)
+            if previous is None or previous.status != result.status:
+                change = f"{previous.status if previous else 'new'} -> {result.status}"
+                message = f"  {result.rel}: {change}"
+                if result.status == FAILED:
+                    log.err(message)
+                else:
+                    log.inf(message)
+            if result.status == FAILED:
+                for line in result.output.rstrip().splitlines():
+                    log.inf(f"    {line}")
+            latest[result.rel] = result
+        statuses = [r.status for r in latest.values()]
+        log.inf(
+            f"{statuses.count(PASS)} passed, {statuses.count(FAILED)} failed,"
+            f" {statuses.count(PENDING)} pending ({len(batch)} run in {wall:.1f}s)."
+        )
+
+    def _affected_cases(self, args, cases, test_path, build_dir, extra_modules) -> list[Path]:
+        try:
+            files = changed_files([test_path] + [Path(m) for m in extra_modules], args.affected_by)
+        except ChangedFilesError as e:
+            log.wrn(f"--affected-by: {e}. Running all test cases.")
+            return cases
+        for path in files:
+            log.dbg(f" - changed: {path}")
+        affected = [
+            case
+            for case in cases
+            if test_impact.is_affected(
+                case, build_dir / "tests" / case_rel(test_path, case), files
+            )
+        ]
+        log.inf(
+            f"{len(files)} files changed since {args.affected_by}, "
+            f"{len(affected)} of {len(cases)} test cases affected"
+        )
+        return affected
@@ -1,6 +1,8 @@
+import json
 import platform
 import shutil
 import subprocess
+import time
 import unittest
 from pathlib import Path
 
@@ -36,6 +38,16 @@ class WestCommandsTests(unittest.TestCase):
         for name in ("test1", "test2"):
             self.assertIn(f"PASS: {name}", log_content)
 
+        events = [
+            json.loads(line) for line in (tests_build / "results.jsonl").read_text().splitlines()
+        ]
+        finished = {e["case"]: e for e in events if e["event"] == "finished"}
+        self.assertEqual(finished["test1"]["status"], "PASS")
+        self.assertGreater(finished["test1"]["build_time"], 0)
+        self.assertEqual(events[-1]["event"], "summary")
+        junit = (tests_build / "junit.xml").read_text()
+        self.assertIn('name="test1"', junit)
+
     @unittest.skipUnless(platform.system() == "Linux", "zmk-test is only supported on Linux")
     def test_zmk_test_fail(self):
         tests_build = BUILD_DIR / "tests"
@@ -44,15 +56,14 @@ class WestCommandsTests(unittest.TestCase):
 
         result = run_west(["zmk-test", "tests-fail"])
         self.assertNotEqual(result.returncode, 0, result.stdout + result.stderr)
-        self.assertIn("FAILED:  did not buil", result.stdout)
-        # Failed case is not shown..
-        # self.assertIn("FAILED: output-diff", result.stdout)
+        self.assertIn("FAILED: build-error did not build", result.stdout)
+        self.assertIn("FAILED: output-diff", result.stdout)
 
         pass_log = tests_build / "pass-fail.log"
         self.assertTrue(pass_log.exists(), "pass-fail.log should be generated")
         log_content = pass_log.read_text()
-        self.assertIn("FAILED:  did not build", log_content)
-        # self.assertIn("FAILED: output-diff", log_content)
+        self.assertIn("FAILED: build-error did not build", log_content)
+        self.assertIn("FAILED: output-diff", log_content)
 
     def test_zmk_build_generates_expected_configs(self):
         artifacts = [
@@ -142,6 +153,80 @@ class WestCommandsTests(unittest.TestCase):
         ]:
             self.assertIn(entry, config_text, f"{entry} not found in {artifact}")
 
+    def test_zmk_build_smart_pristine_rebuilds_incrementally(self):
+        artifact = "xiao_ble__zmk__my_awesome_keyboard"
+        shutil.rmtree(BUILD_DIR / artifact, ignore_errors=True)
+
+        first = run_west(["zmk-build", "tests/zmk-config", "-p", "smart"])
+        self.assertEqual(first.returncode, 0, first.stdout + first.stderr)
+        self.assertIn("building pristine", first.stdout + first.stderr)
+
+        second = run_west(["zmk-build", "tests/zmk-config", "-p", "smart"])
+        self.assertEqual(second.returncode, 0, second.stdout + second.stderr)
+        self.assertIn("building incrementally", second.stdout + second.stderr)
+
+        third = run_west(
+            [
+                "zmk-build",
+                "tests/zmk-config",
+                "-p",
+                "smart",
+                "--cmake-args",
+                "-DCONFIG_ZMK_SLEEP=n",
+            ]
+        )
+        self.assertEqual(third.returncode, 0, third.stdout + third.stderr)
+        self.assertIn("building pristine", third.stdout + third.stderr)
+
+    def test_zmk_build_changed_only_skips_unchanged_targets(self):
+        result = run_west(["zmk-build", "tests/zmk-config", "--changed-only", "HEAD"])
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertIn("Skipped, no inputs changed since HEAD", result.stdout + result.stderr)
+
+    def test_zmk_build_serve_to_workers(self):
+        artifact = "xiao_ble__zmk__my_awesome_keyboard"
+        shutil.rmtree(BUILD_DIR / artifact, ignore_errors=True)
+        BUILD_DIR.mkdir(parents=True, exist_ok=True)
+        socket_path = BUILD_DIR / "zmk-build-test.sock"
+
+        coordinator = subprocess.Popen(
+            ["west", "zmk-build", "tests/zmk-config", "--serve", str(socket_path)],
+            cwd=REPO_ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        deadline = time.monotonic() + 60
+        while not socket_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        workers = [
+            subprocess.Popen(
+                [
+                    "west",
+                    "zmk-build",
+                    "tests/zmk-config",
+                    "--worker",
+                    str(socket_path),
+                    "-P",
+                    "1",
+                    "-d",
+                    str(BUILD_DIR / f"worker{i}"),
+                ],
+                cwd=REPO_ROOT,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for i in range(2)
+        ]
+        output, _ = coordinator.communicate(timeout=1800)
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=60), 0)
+
+        self.assertEqual(coordinator.returncode, 0, output)
+        self.assertIn(f"Building {artifact} on", output)
+        self.assertTrue((BUILD_DIR / artifact / "zephyr" / "zmk.uf2").exists())
+        self.assertTrue((BUILD_DIR / artifact / "stdout_and_stderr.log").exists())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,1698 @@
+"""Unit tests for the helper modules under scripts/lib.
+
+Unlike test.py these don't need a west workspace or a toolchain; tests
+comparing against a system tool are skipped when it isn't installed.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+
+REPO_ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(REPO_ROOT / "scripts"))
+
+from lib import (  # noqa: E402
+    build_cache,
+    build_timing,
+    build_workers,
+    changed_targets,
+    compiler_cache,
+    configure_cache,
+    file_watch,
+    native_sim_tests,
+    snapshot_eval,
+    tee_popen,
+    test_impact,
+    test_results,
+    workspace_index,
+)
+
+# scripts/lib/ble modules import each other as top-level modules.
+sys.path.insert(0, str(REPO_ROOT / "scripts" / "lib" / "ble"))
+import runner  # noqa: E402
+import studio_requests  # noqa: E402
+
+try:
+    import zmk_build
+    import zmk_test
+except ImportError:  # west isn't installed
+    zmk_build = zmk_test = None
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+
+class FakeProject:
+    def __init__(self, name: str, revision: str, head: str | None = None):
+        self.name = name
+        self.revision = revision
+        self.head = head
+
+    def sha(self, rev: str) -> str:
+        if self.head is None:
+            raise RuntimeError("not cloned")
+        return self.head
+
+
+class FakeManifest:
+    def __init__(self, *projects: FakeProject):
+        self.projects = list(projects)
+
+
+class BuildCacheTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = self.tmp / "config"
+        (self.config / "boards").mkdir(parents=True)
+        (self.config / "west.yml").write_text("manifest: {}\n")
+        (self.config / "boards" / "kbd.overlay").write_text("/ {};\n")
+        manifest = FakeManifest(
+            FakeProject("zmk", "main", head="1" * 40),
+            FakeProject("zephyr", "v3.5.0+zmk-fixes"),
+            FakeProject("other", "main", head="2" * 40),
+        )
+        self.cache = build_cache.BuildCache(self.tmp / "cache", manifest)
+
+    def test_hash_tree_skips_build_outputs_and_hidden_dirs(self):
+        before = build_cache.hash_tree(self.config)
+        for skipped in ["build", ".git", "dependencies"]:
+            (self.config / skipped).mkdir()
+            (self.config / skipped / "out").write_text("x")
+        self.assertEqual(build_cache.hash_tree(self.config), before)
+
+        (self.config / "boards" / "kbd.overlay").write_text("/ { };\n")
+        self.assertNotEqual(build_cache.hash_tree(self.config), before)
+
+    def test_hash_tree_covers_paths(self):
+        before = build_cache.hash_tree(self.config)
+        (self.config / "boards" / "kbd.overlay").rename(self.config / "kbd.overlay")
+        self.assertNotEqual(build_cache.hash_tree(self.config), before)
+
+    def test_revisions(self):
+        # HEAD of a cloned project, the manifest revision of one that isn't.
+        self.assertEqual(self.cache.revisions(), {"zmk": "1" * 40, "zephyr": "v3.5.0+zmk-fixes"})
+
+    def test_key_depends_on_command_and_trees(self):
+        command = ["-b", "nice_nano_v2", "--", "-DSHIELD=corne_left"]
+        key, inputs = self.cache.key(command, [str(self.config), str(self.config)])
+        self.assertEqual(list(inputs["trees"]), [str(self.config)])
+        self.assertEqual(self.cache.key(command, [str(self.config)])[0], key)
+        other = ["-b", "nice_nano_v2", "--", "-DSHIELD=corne_right"]
+        self.assertNotEqual(self.cache.key(other, [str(self.config)])[0], key)
+
+        # Tree hashes are computed once per run; a new cache sees the edit.
+        (self.config / "west.yml").write_text("manifest: {projects: []}\n")
+        self.assertEqual(self.cache.key(command, [str(self.config)])[0], key)
+        fresh = build_cache.BuildCache(self.cache.cache_dir, self.cache.manifest)
+        self.assertNotEqual(fresh.key(command, [str(self.config)])[0], key)
+
+    def test_store_and_restore(self):
+        key, inputs = self.cache.key(["-b", "nice_nano_v2"], [str(self.config)])
+        built = self.tmp / "build" / "zephyr"
+        built.mkdir(parents=True)
+        (built / "zmk.uf2").write_bytes(b"UF2\x00firmware")
+        (built / ".config").write_text("CONFIG_ZMK=y\n")
+        (built / "zephyr.map").write_text("not cached\n")
+
+        restored = self.tmp / "restored" / "zephyr"
+        self.assertFalse(self.cache.restore(key, restored))
+        self.assertFalse(restored.exists())
+
+        self.cache.store(key, inputs, built)
+        # A second store of the same key keeps the first entry.
+        (built / "zmk.uf2").write_bytes(b"changed")
+        self.cache.store(key, inputs, built)
+
+        self.assertTrue(self.cache.restore(key, restored))
+        self.assertEqual(sorted(p.name for p in restored.iterdir()), [".config", "zmk.uf2"])
+        self.assertEqual((restored / "zmk.uf2").read_bytes(), b"UF2\x00firmware")
+        entry = self.cache.cache_dir / key[:2] / key
+        self.assertEqual(sorted(p.name for p in entry.parent.iterdir()), [key])
+
+
+class CompilerCacheTests(TempDirTestCase):
+    def test_parse_ccache_stats_log(self):
+        # ccache 4 writes one counter name per compilation, ccache 3 a
+        # description; anything else (e.g. uncacheable calls) is ignored.
+        log = self.tmp / "stats.log"
+        log.write_text(
+            "# build/zephyr/main.c\n"
+            "direct_cache_hit\n"
+            "preprocessed_cache_hit\n"
+            "cache_miss\n"
+            "cache hit (direct)\n"
+            "cache miss\n"
+            "called_for_link\n"
+        )
+        self.assertEqual(compiler_cache.parse_ccache_stats_log(log), (3, 2))
+
+    def test_format_hit_rate(self):
+        self.assertEqual(compiler_cache.format_hit_rate(0, 0), "no compilations")
+        self.assertEqual(compiler_cache.format_hit_rate(3, 1), "3/4 hits (75.0%)")
+
+    def test_ccache_per_artifact_stats(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("CCACHE_DIR", None)
+            cache = compiler_cache.CompilerCache("ccache", self.tmp)
+        self.assertEqual(cache.env["CCACHE_DIR"], str(self.tmp / ".cache" / "ccache"))
+        self.assertEqual(cache.cmake_args(), ["-DUSE_CCACHE=1"])
+
+        build_dir = self.tmp / "build"
+        build_dir.mkdir()
+        stats_log = build_dir / cache.STATS_LOG
+        stats_log.write_text("cache_miss\n")
+        env = cache.build_env(build_dir)
+        # A rebuild starts a fresh log instead of adding to the last one.
+        self.assertFalse(stats_log.exists())
+        self.assertEqual(env["CCACHE_STATSLOG"], str(stats_log))
+        self.assertEqual(env["CCACHE_BASEDIR"], str(self.tmp))
+        self.assertIsNone(cache.artifact_stats(build_dir))
+
+        stats_log.write_text("direct_cache_hit\ncache_miss\n")
+        self.assertEqual(cache.artifact_stats(build_dir), (1, 1))
+        self.assertEqual(cache.total_stats([(1, 1), (4, 0)]), (5, 1))
+
+    def test_sccache_total_stats(self):
+        def stats(hits: int, misses: int) -> mock.Mock:
+            counts = {
+                "cache_hits": {"counts": {"C/C++": hits}},
+                "cache_misses": {"counts": {"C/C++": misses}},
+            }
+            return mock.Mock(returncode=0, stdout=json.dumps({"stats": counts}))
+
+        with mock.patch.dict(os.environ, {"SCCACHE_DIR": str(self.tmp / "sccache")}):
+            cache = compiler_cache.CompilerCache("sccache", self.tmp)
+        self.assertEqual(cache.env["SCCACHE_DIR"], str(self.tmp / "sccache"))
+        self.assertIn("-DUSE_CCACHE=0", cache.cmake_args())
+        self.assertIsNone(cache.total_stats([]))
+
+        runs = [mock.Mock(returncode=0), stats(10, 5), stats(25, 7)]
+        with mock.patch.object(compiler_cache.subprocess, "run", side_effect=runs):
+            cache.begin()
+            # Only the counts since begin() belong to this run.
+            self.assertEqual(cache.total_stats([]), (15, 2))
+        self.assertIsNone(cache.artifact_stats(self.tmp))
+
+        failed = mock.Mock(returncode=2, stdout="")
+        with mock.patch.object(compiler_cache.subprocess, "run", return_value=failed):
+            self.assertIsNone(cache.total_stats([]))
+
+
+def timing(id: int, artifact: str, worker: int, start: float, wall: float, **kwargs) -> dict:
+    return {
+        "id": id,
+        "artifact": artifact,
+        "worker": worker,
+        "start": start,
+        "end": start + wall,
+        "wall": wall,
+        "queue_wait": start,
+        "configure": 0.0,
+        "compile": wall,
+        "link": 0.0,
+        "peak_rss": None,
+        "cached": False,
+        "success": True,
+        **kwargs,
+    }
+
+
+class BuildTimingTests(TempDirTestCase):
+    def write_ninja_log(self, *entries: tuple[int, int, str], append: bool = False) -> None:
+        with open(self.tmp / build_timing.NINJA_LOG, "a" if append else "w") as f:
+            if not append:
+                f.write("# ninja log v5\n")
+            for start, end, output in entries:
+                f.write(f"{start}\t{end}\t0\t{output}\tdeadbeef\n")
+
+    def test_ninja_phases_of_this_build_only(self):
+        self.assertEqual(build_timing.ninja_log_offset(self.tmp), (0, 0))
+        self.assertEqual(build_timing.ninja_phases(self.tmp, (0, 0)), (0.0, 0.0))
+
+        self.write_ninja_log((0, 90000, "zephyr/zephyr_pre0.elf"))
+        offset = build_timing.ninja_log_offset(self.tmp)
+        self.write_ninja_log(
+            (100, 2100, "zephyr/main.c.obj"),
+            (1000, 4000, "zephyr/kernel.c.obj"),
+            (4000, 5500, "zephyr/zephyr_pre0.elf"),
+            (5500, 6100, "zephyr/zephyr.elf"),
+            append=True,
+        )
+        # Only the entries appended since `offset`: 6s of Ninja, 2.1s linking.
+        self.assertEqual(build_timing.ninja_phases(self.tmp, offset), (6.0, 2.1))
+        self.assertEqual(
+            build_timing.split_phases(10.0, 6.0, 2.1),
+            {"configure": 4.0, "compile": 3.9, "link": 2.1},
+        )
+
+        # A pristine build recreated the log: all of it belongs to this build.
+        (self.tmp / build_timing.NINJA_LOG).unlink()
+        self.write_ninja_log((0, 3000, "zephyr/zephyr.elf"))
+        self.assertEqual(build_timing.ninja_phases(self.tmp, offset), (3.0, 3.0))
+
+    def test_critical_path_and_summary(self):
+        timings = [
+            timing(0, "left", worker=1, start=0.0, wall=30.0),
+            timing(1, "right", worker=2, start=0.0, wall=70.0, peak_rss=300 << 20),
+            timing(2, "reset", worker=1, start=30.0, wall=50.0),
+        ]
+        path = build_timing.critical_path(timings)
+        self.assertEqual([t["id"] for t in path], [0, 2])
+        self.assertEqual(build_timing.critical_path([]), [])
+
+        lines = build_timing.summary_lines(timings, makespan=80.0)
+        self.assertTrue(lines[0].startswith("id  artifact  queue"))
+        self.assertEqual([line.split()[1] for line in lines[1:4]], ["right", "reset", "left"])
+        self.assertIn("1m10.0s", lines[1])
+        self.assertIn("300MiB", lines[1])
+        self.assertEqual(
+            lines[-1],
+            "Critical path (1m20.0s total): [0] left (30.0s) -> [2] reset (50.0s)",
+        )
+
+        report = self.tmp / "out" / "timings.json"
+        build_timing.write_json(report, list(reversed(timings)), 80.0, parallelism=2)
+        data = json.loads(report.read_text())
+        self.assertEqual(data["critical_path"], [0, 2])
+        self.assertEqual([t["id"] for t in data["targets"]], [0, 1, 2])
+
+    def test_duration_history(self):
+        self.assertEqual(build_timing.load_history(self.tmp), {})
+        (self.tmp / build_timing.HISTORY_FILE).write_text("[1, 2]")
+        self.assertEqual(build_timing.load_history(self.tmp), {})
+
+        build_root = self.tmp / "build"
+        build_timing.update_history(
+            build_root,
+            [
+                timing(0, "left", worker=1, start=0.0, wall=40.0),
+                timing(1, "right", worker=2, start=0.0, wall=5.0, cached=True),
+                timing(2, "reset", worker=2, start=0.0, wall=1.0, success=False),
+            ],
+        )
+        # Cached and failed builds say nothing about how long a build takes.
+        self.assertEqual(build_timing.load_history(build_root), {"left": 40.0})
+        build_timing.update_history(build_root, [timing(0, "left", 1, 0.0, 20.0)])
+        self.assertEqual(build_timing.load_history(build_root), {"left": 30.0})
+
+    def test_longest_first(self):
+        artifacts = ["short", "new", "long", "newer", "medium"]
+        history = {"short": 10.0, "long": 90.0, "medium": 40.0}
+        order = build_timing.longest_first(artifacts, history)
+        self.assertEqual(
+            [artifacts[i] for i in order], ["new", "newer", "long", "medium", "short"]
+        )
+        self.assertEqual(build_timing.longest_first(artifacts, {}), [0, 1, 2, 3, 4])
+
+
+class TestImpactTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.case = self.tmp / "tests" / "hold-tap"
+        self.case.mkdir(parents=True)
+        self.module = self.tmp / "module"
+        (self.module / "src").mkdir(parents=True)
+        self.build = self.tmp / "build" / "hold-tap"
+        self.build.mkdir(parents=True)
+
+    def test_build_inputs(self):
+        (self.build / "build.ninja").write_text(
+            "rule RERUN_CMAKE\n"
+            "  command = cmake\n"
+            f"build build.ninja: RERUN_CMAKE | {self.case}/native_sim.keymap $\n"
+            f"    {self.module}/Kconfig {self.module}/dts/my$ binding.yaml || order\n"
+            "build all: phony zephyr/zephyr.exe\n"
+        )
+        (self.build / "compile_commands.json").write_text(
+            json.dumps(
+                [
+                    {"directory": str(self.build), "file": f"{self.module}/src/behavior.c"},
+                    {"directory": str(self.build / "zephyr"), "file": "misc/empty_file.c"},
+                    {"directory": str(self.build)},
+                ]
+            )
+        )
+        deps = mock.Mock(
+            returncode=0,
+            stdout=(
+                "zephyr/CMakeFiles/behavior.c.obj: #deps 2, deps mtime 1 (VALID)\n"
+                f"    {self.module}/src/behavior.c\n"
+                f"    {self.module}/include/../include/behavior.h\n"
+                "\n"
+            ),
+        )
+        with (
+            mock.patch.object(test_impact.shutil, "which", return_value="/usr/bin/ninja"),
+            mock.patch.object(test_impact.subprocess, "run", return_value=deps),
+        ):
+            inputs = test_impact.build_inputs(self.build)
+        self.assertEqual(
+            inputs,
+            {
+                str(self.case / "native_sim.keymap"),
+                str(self.module / "Kconfig"),
+                str(self.module / "dts" / "my binding.yaml"),
+                str(self.module / "src" / "behavior.c"),
+                str(self.module / "include" / "behavior.h"),
+                str(self.build / "zephyr" / "misc" / "empty_file.c"),
+            },
+        )
+
+        # Without Ninja (or a build) only the files it can read are known.
+        with mock.patch.object(test_impact.shutil, "which", return_value=None):
+            self.assertNotIn(
+                str(self.module / "include" / "behavior.h"), test_impact.build_inputs(self.build)
+            )
+        self.assertEqual(test_impact.build_inputs(self.tmp / "missing"), set())
+
+    def test_is_affected(self):
+        source = self.module / "src" / "behavior.c"
+        other = self.module / "src" / "other.c"
+        # Never built (or last build failed): always affected.
+        self.assertTrue(test_impact.is_affected(self.case, self.build, []))
+
+        test_impact.save_inputs(self.build, {str(source)})
+        self.assertEqual(test_impact.load_inputs(self.build), {str(source)})
+        self.assertFalse(test_impact.is_affected(self.case, self.build, [other]))
+        self.assertTrue(test_impact.is_affected(self.case, self.build, [other, source]))
+        # Relative and unnormalized paths of inputs and case files count too.
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp)
+        self.assertTrue(
+            test_impact.is_affected(self.case, self.build, [Path("module/src/../src/behavior.c")])
+        )
+        self.assertTrue(
+            test_impact.is_affected(
+                self.case, self.build, [Path("tests/hold-tap/events.patterns")]
+            )
+        )
+
+        test_impact.clear_inputs(self.build)
+        test_impact.clear_inputs(self.build)
+        self.assertIsNone(test_impact.load_inputs(self.build))
+        (self.build / test_impact.INPUTS_FILE).write_text("{")
+        self.assertTrue(test_impact.is_affected(self.case, self.build, [other]))
+
+
+class FakeRequest:
+    """Stands in for a zmk.studio.Request; only its encoding is used."""
+
+    def __init__(self, encoded: bytes):
+        self.encoded = encoded
+
+    def SerializeToString(self) -> bytes:
+        return self.encoded
+
+
+class StudioRequestsTests(TempDirTestCase):
+    def test_framed_payloads(self):
+        requests = [FakeRequest(b"\x08\x01"), ("named", FakeRequest(b"\x10\xab\xac\xad"))]
+        self.assertEqual(
+            studio_requests.framed_payloads(requests),
+            [b"\xab\x08\x01\xad", b"\xab\x10\xac\xab\xac\xac\xac\xad\xad"],
+        )
+        self.assertEqual(studio_requests.framed_payloads([]), [])
+
+    def test_render_requests_file(self):
+        payloads = [b"\xab\x08\x01\xad", b"", b"\xab" + b"\x00" * 300 + b"\xad"]
+        blob = studio_requests.render_requests_file(payloads)
+        self.assertEqual(blob[:6], b"\x04\x00\xab\x08\x01\xad")
+        self.assertEqual(blob[6:8], b"\x00\x00")
+        self.assertEqual(blob[8:10], (302).to_bytes(2, "little"))
+        self.assertEqual(len(blob), 10 + 302)
+        self.assertEqual(studio_requests.render_requests_file([]), b"")
+        with self.assertRaises(ValueError):
+            studio_requests.render_requests_file([b"\x00" * 0x10000])
+
+    def test_hex_file_round_trip(self):
+        requests = [("first", FakeRequest(b"\x08\x01")), ("second", FakeRequest(b"\xad"))]
+        hex_file = self.tmp / "studio_requests.hex"
+        hex_file.write_text(studio_requests.render_hex(requests))
+        self.assertEqual(
+            studio_requests.parse_hex_file(hex_file), studio_requests.framed_payloads(requests)
+        )
+
+
+class BleRunnerTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.module = self.tmp / "module"
+        (self.module / "src").mkdir(parents=True)
+        (self.module / "src" / "behavior.c").write_text("int x;\n")
+        self.runner = runner.BleRunner(
+            zmk_app=self.tmp / "zmk" / "app",
+            module_dir=self.module,
+            topdir=self.tmp,
+            bsim_out_path=self.tmp / "bsim",
+            bsim_components_path=None,
+            prefix="module",
+            auto_accept=False,
+            verbose=False,
+            log=mock.Mock(),
+        )
+
+    def make_case(self, name: str, **files: str) -> Path:
+        case = self.module / "tests" / "ble" / name
+        case.mkdir(parents=True)
+        for filename, content in {"nrf52_bsim.keymap": "/ {};\n", **files}.items():
+            (case / filename).write_text(content)
+        return case
+
+
+class BleFirmwareFingerprintTests(BleRunnerTestCase):
+    def fingerprint(self, case: Path, *args: str) -> str:
+        return self.runner._firmware_fingerprint(case, [f"-DZMK_CONFIG={case}", *args])
+
+    def test_identical_firmware_inputs(self):
+        first = self.make_case("a", sim_length="1e6", **{"events.patterns": "s/x//"})
+        second = self.make_case("b", sim_done="done", **{"events.snapshot": "x\n"})
+        # Only the runtime files differ, and the case dir is abstracted away.
+        self.assertEqual(self.fingerprint(first), self.fingerprint(second))
+        self.assertNotEqual(
+            self.fingerprint(first), self.fingerprint(second, "-DEXTRA_CONF_FILE=x.conf")
+        )
+
+        (second / "nrf52_bsim.conf").write_text("CONFIG_ZMK_SLEEP=y\n")
+        self.assertNotEqual(self.fingerprint(first), self.fingerprint(second))
+
+    def test_includes_leaving_the_case_dir(self):
+        keymap = '#include "../common.dtsi"\n'
+        first = self.make_case("a/x", **{"nrf52_bsim.keymap": keymap})
+        second = self.make_case("b/x", **{"nrf52_bsim.keymap": keymap})
+        # The included file differs per location, so the cases don't share.
+        self.assertNotEqual(self.fingerprint(first), self.fingerprint(second))
+        third = self.make_case("a/y", **{"nrf52_bsim.keymap": keymap})
+        self.assertEqual(self.fingerprint(first), self.fingerprint(third))
+
+    def test_identical_firmware_is_built_once(self):
+        cases = [self.make_case("a"), self.make_case("b")]
+        with (
+            mock.patch.object(self.runner, "_west_build") as west_build,
+            mock.patch.object(self.runner, "_stage") as stage,
+        ):
+            staged = [self.runner.build_case(case) for case in cases]
+        west_build.assert_called_once()
+        exe = self.runner.build_root / "a" / "dut" / "zephyr" / "zmk.exe"
+        self.assertEqual(
+            stage.call_args_list, [mock.call(exe, "module_a"), mock.call(exe, "module_b")]
+        )
+        reused = (staged[1].case_build / "dut.build.log").read_text()
+        self.assertEqual(reused, f"Identical inputs: reused {exe}\n")
+
+    def test_module_sources(self):
+        case = self.make_case("a")
+        before = self.fingerprint(case)
+        (self.module / "src" / "behavior.c").write_text("int y;\n")
+        self.runner._fingerprint_base = None
+        self.assertNotEqual(self.fingerprint(case), before)
+
+
+class BleIncrementalBuildTests(BleRunnerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build = self.tmp / "build" / "dut"
+        (self.build / "zephyr").mkdir(parents=True)
+        self.exe = self.build / "zephyr" / "zmk.exe"
+        self.source = self.module / "src" / "behavior.c"
+        self.generated = self.build / "zephyr" / "include" / "generated" / "autoconf.h"
+        self.command = ["west", "build", "-d", str(self.build), "-b", "nrf52_bsim"]
+
+    def built(self, inputs: set[str]) -> None:
+        """Pretend a build of `inputs` just produced zmk.exe."""
+        self.exe.write_bytes(b"\x7fELF")
+        os.utime(self.source, ns=(0, 1_000_000_000))
+        os.utime(self.exe, ns=(0, 2_000_000_000))
+        with mock.patch.object(runner, "build_inputs", return_value=inputs):
+            self.runner._record_build(self.build, self.command)
+
+    def test_record_build(self):
+        self.built({str(self.source), str(self.generated)})
+        record = json.loads((self.build / runner.BUILD_RECORD).read_text())
+        # Generated files under the build dir are not inputs of their own.
+        self.assertEqual(
+            record,
+            {"command": self.command, "outputs": [str(self.exe)], "inputs": [str(self.source)]},
+        )
+
+    def test_up_to_date(self):
+        self.assertFalse(self.runner._up_to_date(self.build, self.command))
+        self.built({str(self.source)})
+        self.assertTrue(self.runner._up_to_date(self.build, self.command))
+        self.assertFalse(self.runner._up_to_date(self.build, [*self.command, "-DX=y"]))
+
+        # An input edited after the build, or deleted since.
+        os.utime(self.source, ns=(0, 3_000_000_000))
+        self.assertFalse(self.runner._up_to_date(self.build, self.command))
+        self.source.unlink()
+        self.assertFalse(self.runner._up_to_date(self.build, self.command))
+
+    def test_unknown_inputs_and_outputs_rebuild(self):
+        self.built(set())
+        self.assertFalse(self.runner._up_to_date(self.build, self.command))
+        self.built({str(self.source)})
+        self.exe.unlink()
+        self.assertFalse(self.runner._up_to_date(self.build, self.command))
+        (self.build / runner.BUILD_RECORD).write_text("{")
+        self.assertFalse(self.runner._up_to_date(self.build, self.command))
+
+    def test_west_build_skips_up_to_date_builds(self):
+        def west_build(cmd, **kwargs):
+            self.exe.write_bytes(b"\x7fELF")
+            os.utime(self.source, ns=(0, 1_000_000_000))
+            return mock.Mock(returncode=returncode)
+
+        def build(*extra_args: str) -> None:
+            self.runner._west_build(
+                self.build, "nrf52_bsim", self.runner.zmk_app, list(extra_args), log_path
+            )
+
+        returncode = 0
+        log_path = self.tmp / "build" / "dut.build.log"
+        with (
+            mock.patch.object(runner.subprocess, "run", side_effect=west_build) as run,
+            mock.patch.object(runner, "build_inputs", return_value={str(self.source)}),
+        ):
+            build()
+            build()
+            run.assert_called_once()
+            self.assertEqual(run.call_args.args[0][-3:], ["-p", "auto", "--"])
+
+            # A failed build leaves no record, so the next run builds again.
+            returncode = 1
+            with self.assertRaises(runner.BleTestError):
+                build("-DX=y")
+            self.assertFalse((self.build / runner.BUILD_RECORD).exists())
+            returncode = 0
+            build("-DX=y")
+            self.assertEqual(run.call_count, 3)
+
+
+class BleSimulationTests(BleRunnerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.runner.bin_dir.mkdir(parents=True)
+        self.output_log = self.tmp / "build" / "case" / "output.log"
+        # A phy that runs until terminated, and devices that print and exit.
+        self.fake_binary("bs_2G4_phy_v1", "exec sleep 60")
+        self.fake_binary("bs_device_handbrake", "exit 0")
+        self.fake_binary(
+            "module_case",
+            "echo 'd_00: @00:00:01.500000  booted'",
+            "echo 'd_00: @00:01:02.250000  studio: response 1'",
+        )
+
+    def fake_binary(self, name: str, *lines: str) -> None:
+        path = self.runner.bin_dir / name
+        path.write_text("\n".join(["#!/bin/sh", *lines]) + "\n")
+        path.chmod(0o755)
+
+    def simulate(self, done: list[str], sim_timeout: float) -> tuple[float, float]:
+        self.runner.sim_timeout = sim_timeout
+        start = time.monotonic()
+        sim_time = self.runner._run_simulation(
+            "module_case", [], self.output_log, "50e6", [re.compile(rx) for rx in done]
+        )
+        return sim_time, time.monotonic() - start
+
+    def test_read_sim_settings(self):
+        case = self.make_case("a")
+        self.assertEqual(self.runner._read_sim_settings(case, "a"), ("50e6", []))
+        (case / "sim_length").write_text("5e6\n")
+        (case / "sim_done").write_text("# the last response\nresponse 1$\n\nbooted\n")
+        sim_length, done = self.runner._read_sim_settings(case, "a")
+        self.assertEqual(sim_length, "5e6")
+        self.assertEqual([rx.pattern for rx in done], ["response 1$", "booted"])
+
+        (case / "sim_done").write_text("(unclosed\n")
+        with self.assertRaises(runner.BleTestError):
+            self.runner._read_sim_settings(case, "a")
+        (case / "sim_length").write_text("long\n")
+        with self.assertRaises(runner.BleTestError):
+            self.runner._read_sim_settings(case, "a")
+
+    def test_stops_once_every_pattern_matched(self):
+        sim_time, elapsed = self.simulate(["booted", "response 1$"], sim_timeout=30)
+        self.assertLess(elapsed, 10)
+        self.assertEqual(sim_time, 62.25)
+        self.assertEqual(len(self.output_log.read_text().splitlines()), 2)
+        self.runner.log.wrn.assert_not_called()
+
+    def test_runs_until_the_timeout_otherwise(self):
+        sim_time, elapsed = self.simulate(["booted", "never printed"], sim_timeout=0.5)
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertEqual(sim_time, 62.25)
+        self.runner.log.wrn.assert_called_once()
+
+    def test_phy_ends_the_simulation(self):
+        self.fake_binary("bs_2G4_phy_v1", "exit 0")
+        sim_time, elapsed = self.simulate([], sim_timeout=30)
+        self.assertLess(elapsed, 10)
+        self.assertEqual(sim_time, 62.25)
+        self.runner.log.wrn.assert_not_called()
+
+
+class SharedTestBuildTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.runner = native_sim_tests.NativeSimRunner(
+            zmk_app=self.tmp / "zmk" / "app",
+            tests_path=self.tmp / "tests",
+            build_dir=self.tmp / "build",
+            extra_modules=[str(self.tmp / "module")],
+            auto_accept=False,
+            verbose=False,
+            log=mock.Mock(),
+        )
+
+    def make_case(self, name: str, **files: str) -> Path:
+        case = self.tmp / "tests" / name
+        case.mkdir(parents=True)
+        files = {"native_sim.keymap": "/ {};\n", "keycode_events.snapshot": "", **files}
+        for filename, content in files.items():
+            (case / filename).write_text(content)
+        return case
+
+    def test_group_key(self):
+        plain = self.make_case("a", **{"events.patterns": "s/x//p\n"})
+        same = self.make_case("b", pending="")
+        self.assertEqual(self.runner.group_key(plain), self.runner.group_key(same))
+
+        conf = self.make_case("c", **{"native_sim.conf": "CONFIG_ZMK_HID_REPORT_TYPE_NKRO=y\n"})
+        self.assertNotEqual(self.runner.group_key(conf), self.runner.group_key(plain))
+        # Anything else may change the configuration: build on its own.
+        self.assertIsNone(self.runner.group_key(self.make_case("d", **{"app.overlay": ""})))
+
+        key = self.runner.group_key(plain)
+        self.runner.extra_modules = []
+        self.assertNotEqual(self.runner.group_key(plain), key)
+
+    def test_one_tree_per_concurrent_case(self):
+        first = self.runner._checkout_tree("k")
+        second = self.runner._checkout_tree("k")
+        self.assertNotEqual(first, second)
+        self.runner._return_tree("k", first)
+        self.assertEqual(self.runner._checkout_tree("k"), first)
+        self.assertEqual(self.runner._checkout_tree("other").name, "other-0")
+
+    def test_build_shared_reconfigures_only_when_needed(self):
+        plain = self.make_case("a")
+        conf = self.make_case("b", **{"native_sim.conf": "CONFIG_X=y\n"})
+        tree = self.runner._checkout_tree("k")
+        results = [None, None, "error", None, None]
+        with mock.patch.object(self.runner, "_build", side_effect=results) as build:
+            for case, key in [(plain, "k"), (plain, "k"), (conf, "j"), (conf, "j"), (conf, "j")]:
+                self.runner._build_shared(tree, key, case)
+        # New tree, same group, new group (fails), failed last time, same.
+        self.assertEqual(
+            [c.args[2] for c in build.call_args_list], [True, False, True, True, False]
+        )
+        self.assertEqual(
+            build.call_args.args[1],
+            [
+                "-DCONFIG_ASSERT=y",
+                f"-DZMK_CONFIG={tree / 'config'}",
+                f"-DZMK_EXTRA_MODULES={self.tmp / 'module'}",
+            ],
+        )
+        keymap = (tree / "config" / "native_sim.keymap").read_text()
+        self.assertEqual(keymap, f'#include "{conf / "native_sim.keymap"}"\n')
+        self.assertEqual((tree / "config" / "native_sim.conf").read_text(), "CONFIG_X=y\n")
+
+        # Unchanged staged files keep their mtime, leaving Ninja nothing to redo.
+        staged = tree / "config" / "native_sim.conf"
+        os.utime(staged, ns=(0, 1_000_000_000))
+        with mock.patch.object(self.runner, "_build", return_value=None):
+            self.runner._build_shared(tree, "j", conf)
+        self.assertEqual(staged.stat().st_mtime_ns, 1_000_000_000)
+
+    def test_a_raising_case_fails_alone(self):
+        cases = [self.make_case(name, **{"events.patterns": "p\n"}) for name in "ab"]
+
+        def run(build_dir, full_log):
+            if full_log.parent.name == "a":
+                raise FileNotFoundError("zmk.exe not found")
+            return b""
+
+        with (
+            mock.patch.object(self.runner, "_build", return_value=None),
+            mock.patch.object(self.runner, "_run", side_effect=run),
+        ):
+            results = self.runner.run(cases, 2)
+        self.assertEqual(
+            [(r.rel, r.status, r.summary) for r in results],
+            [("a", "FAILED", "FAILED: a (zmk.exe not found)"), ("b", "PASS", "PASS: b")],
+        )
+        self.assertIn("FileNotFoundError", results[0].output)
+        pass_fail = (self.tmp / "build" / "tests" / "pass-fail.log").read_text()
+        self.assertEqual(
+            sorted(pass_fail.splitlines()), ["", "FAILED: a (zmk.exe not found)", "PASS: b"]
+        )
+
+
+class BuildWorkersTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop(build_workers.AUTHKEY_ENV, None)
+        self.address = str(self.tmp / "zmk-build.sock")
+
+    def coordinator(self, order: list[int]) -> build_workers.Coordinator:
+        return build_workers.Coordinator(
+            self.address, order, {id: {} for id in order}, {}, lambda *args: None
+        )
+
+    def test_tcp_needs_a_key(self):
+        with self.assertRaises(ValueError):
+            build_workers.authkey("0.0.0.0:7600")
+        self.assertEqual(build_workers.authkey(self.address), build_workers.DEFAULT_AUTHKEY)
+        os.environ[build_workers.AUTHKEY_ENV] = "secret"
+        self.assertEqual(build_workers.authkey("0.0.0.0:7600"), b"secret")
+
+    def test_builds_on_workers(self):
+        coordinator = self.coordinator([0, 1, 2])
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(coordinator.run(5)))
+        thread.start()
+        built = build_workers.work(
+            self.address, 2, lambda channel, options, request: {"id": request["id"]}
+        )
+        thread.join(5)
+        self.assertEqual(built, 3)
+        self.assertEqual(sorted(r["id"] for r in results), [0, 1, 2])
+
+    def test_gives_up_without_workers(self):
+        started = time.monotonic()
+        self.assertEqual(self.coordinator([0, 1]).run(idle_timeout=0.2), [])
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_gives_up_when_all_workers_dropped(self):
+        coordinator = self.coordinator([0, 1])
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(coordinator.run(0.5)))
+        thread.start()
+
+        def build(channel, options, request):
+            if request["id"] == 1:
+                channel.close()  # the worker dies mid-build
+                raise OSError("gone")
+            return {"id": request["id"]}
+
+        build_workers.work(self.address, 1, build)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([r["id"] for r in results], [0])
+
+
+class SnapshotEvalMissingFileTests(TempDirTestCase):
+    def test_missing_snapshot_diffs_as_empty(self):
+        log = self.tmp / "events.log"
+        log.write_bytes(b"pressed\n")
+        diff = snapshot_eval.unified_diff(self.tmp / "events.snapshot", log)
+        self.assertIn("@@ -0,0 +1 @@\n+pressed\n", diff)
+
+    def test_missing_snapshot_of_empty_log_passes(self):
+        log = self.tmp / "events.log"
+        log.write_bytes(b"")
+        self.assertEqual(snapshot_eval.unified_diff(self.tmp / "events.snapshot", log), "")
+
+    def test_missing_patterns_raises_os_error(self):
+        with self.assertRaises(OSError):
+            snapshot_eval.sed_filter(self.tmp / "events.patterns", b"line\n")
+
+
+def _bsim_line(device: int, rng: random.Random, text: str) -> str:
+    stamp = f"@{rng.randrange(24):02d}:00:{rng.randrange(60):02d}.{rng.randrange(10**6):06d}"
+    # The 19 columns the patterns skip: the log level and module tag.
+    return f"d_{device:02d}: {stamp}  {'<dbg> ble_central: '[:19]}{text}"
+
+
+def sample_log(patterns: Path, rng: random.Random) -> bytes:
+    """A firmware log for the case of `patterns`: its snapshot lines in the
+    log formats the patterns expect, between noise lines."""
+    snapshot = next(patterns.parent.glob("*.snapshot"))
+    noise = [
+        "*** Booting Zephyr OS build v3.5.0 ***",
+        "[00:00:00.000,000] <inf> zmk: Welcome to ZMK!",
+        "[00:00:00.010,000] <dbg> zmk: kscan_process_msgq: Row: 0, col: 0, position: 0",
+        "d_02: @00:00:01.000000  short",
+        "d_02:",
+        "",
+        "   trailing whitespace   ",
+        "on_keymap_binding_",
+    ]
+    lines = []
+    for line in snapshot.read_text().splitlines():
+        lines.append(rng.choice(noise))
+        lines.append(f"[00:00:00.020,000] <dbg> zmk: zmk_keymap_apply: on_keymap_binding_{line}")
+        for device, prefix in ((2, "host "), (3, "peripheral ")):
+            if line.startswith(prefix):
+                lines.append(_bsim_line(device, rng, line[len(prefix) :]))
+        lines.append(_bsim_line(rng.choice((0, 2, 3)), rng, "Welcome to ZMK! " + line))
+    rng.shuffle(lines)
+    return "".join(line + "\n" for line in lines).encode()
+
+
+def run_tool(command: list[str], data: bytes) -> bytes:
+    return subprocess.run(command, input=data, stdout=subprocess.PIPE, check=False).stdout
+
+
+@unittest.skipUnless(shutil.which("sed") and shutil.which("sort"), "needs sed and sort")
+class SnapshotEvalRepoPatternsTests(TempDirTestCase):
+    """The repo's own test cases through the in-process and the real tools."""
+
+    def patterns(self) -> list[Path]:
+        found = sorted(REPO_ROOT.glob("tests*/**/events.patterns"))
+        self.assertTrue(found)
+        return found
+
+    def test_patterns_are_evaluated_in_process(self):
+        for patterns in self.patterns():
+            with self.subTest(patterns=str(patterns.relative_to(REPO_ROOT))):
+                extended = "ble" in patterns.parts
+                snapshot_eval.SedScript(patterns.read_text(), extended)
+
+    def test_filtered_logs_match_the_tools(self):
+        rng = random.Random(0)
+        for patterns in self.patterns():
+            extended = "ble" in patterns.parts
+            for _ in range(5):
+                log = sample_log(patterns, rng)
+                with self.subTest(patterns=str(patterns.relative_to(REPO_ROOT))):
+                    if extended:
+                        expected = run_tool(
+                            ["sed", "-E", "-n", "-f", str(patterns)],
+                            run_tool(["sort", "-s", "-t", ":", "-k", "1,1"], log),
+                        )
+                        actual = snapshot_eval.sed_filter(
+                            patterns, snapshot_eval.sort_first_field(log), extended=True
+                        )
+                    else:
+                        expected = run_tool(["sed", "-n", "-f", str(patterns)], log)
+                        actual = snapshot_eval.sed_filter(patterns, log)
+                    self.assertEqual(actual, expected)
+                    self.assertTrue(actual)
+
+    def test_matching_snapshots_pass(self):
+        for patterns in self.patterns():
+            snapshot = next(patterns.parent.glob("*.snapshot"))
+            filtered = self.tmp / "filtered.log"
+            # Trailing whitespace and a missing final newline don't count.
+            lines = snapshot.read_text().splitlines()
+            filtered.write_text(" \t\r\n".join(lines))
+            self.assertEqual(snapshot_eval.unified_diff(snapshot, filtered), "")
+
+
+def random_regex(rng: random.Random, extended: bool) -> str:
+    atoms = ["a", "b", ".", "[ab]", "[^a]", "[[:digit:]]", "\\w", "x", "\\.", "[]a]", "[\\t]"]
+    quantifiers = ["", "", "", "*", "\\{1,2\\}", "\\+", "\\?"]
+    if extended:
+        quantifiers = ["", "", "", "*", "{1,2}", "+", "?", "{0,2}", "*?"]
+    group = ("(", ")") if extended else ("\\(", "\\)")
+    bar = "|" if extended else "\\|"
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        piece = "".join(
+            rng.choice(atoms) + rng.choice(quantifiers) for _ in range(rng.randint(1, 3))
+        )
+        roll = rng.random()
+        if roll < 0.3:
+            piece = group[0] + piece + group[1]
+            if rng.random() < 0.2:
+                piece += rng.choice(quantifiers[3:])
+        elif roll < 0.35:
+            piece = group[0] + piece + bar + rng.choice(atoms) + group[1]
+        parts.append(piece)
+    regex = "".join(parts)
+    if rng.random() < 0.2:
+        regex = "^" + regex
+    if rng.random() < 0.2:
+        regex += "$"
+    return regex
+
+
+def random_script(rng: random.Random, extended: bool) -> str:
+    commands = []
+    for _ in range(rng.randint(1, 3)):
+        address = ""
+        if rng.random() < 0.4:
+            address = f"/{random_regex(rng, extended)}/" + rng.choice(["", "I", "!", "I!"])
+        regex = random_regex(rng, extended)
+        groups = regex.count("(") if extended else regex.count("\\(")
+        replacement = rng.choice(["<&>", "", "[\\n]", "-\\t-", "\\&"])
+        if groups:
+            replacement += f"\\{rng.randint(1, groups)}"
+        flags = rng.choice(["", "p", "g", "gp", "2", "2p", "Ip"])
+        command = rng.choice([f"s/{regex}/{replacement}/{flags}", "p", "d", "{p;p}"])
+        commands.append(address + command)
+    return "\n".join(commands) + "\n"
+
+
+@unittest.skipUnless(shutil.which("sed"), "needs sed")
+class SedFilterDifferentialTests(TempDirTestCase):
+    """Random scripts and inputs through sed_filter and sed; scripts outside
+    the in-process subset must fall back to sed, so all of them agree."""
+
+    def check(self, extended: bool):
+        rng = random.Random(1 if extended else 2)
+        patterns = self.tmp / "events.patterns"
+        in_process = 0
+        for _ in range(300):
+            script = random_script(rng, extended)
+            patterns.write_text(script)
+            lines = [
+                "".join(rng.choice("abx.1\t ]") for _ in range(rng.randint(0, 8)))
+                for _ in range(6)
+            ]
+            data = "\n".join(lines).encode() + rng.choice([b"", b"\n"])
+            command = ["sed", *(["-E"] if extended else []), "-n", "-f", str(patterns)]
+            with self.subTest(script=script, data=data):
+                self.assertEqual(
+                    snapshot_eval.sed_filter(patterns, data, extended), run_tool(command, data)
+                )
+            try:
+                snapshot_eval.SedScript(script, extended)
+                in_process += 1
+            except snapshot_eval.UnsupportedSed:
+                pass
+        # Most scripts are in the subset, so this isn't only testing sed.
+        self.assertGreater(in_process, 75)
+
+    def test_basic_regex(self):
+        self.check(extended=False)
+
+    def test_extended_regex(self):
+        self.check(extended=True)
+
+    def test_leftmost_longest_falls_back(self):
+        patterns = self.tmp / "events.patterns"
+        patterns.write_text("s/(ab)?(abcd)?/[\\1|\\2]/p\n")
+        with self.assertRaises(snapshot_eval.UnsupportedSed):
+            snapshot_eval.SedScript(patterns.read_text(), extended=True)
+        self.assertEqual(
+            snapshot_eval.sed_filter(patterns, b"abcd\n", extended=True), b"[|abcd]\n"
+        )
+
+    def test_non_ascii_input_falls_back(self):
+        patterns = self.tmp / "events.patterns"
+        patterns.write_text("s/[[:alpha:]]/X/gp\n")
+        data = "caf\u00e9\n".encode()
+        self.assertEqual(
+            snapshot_eval.sed_filter(patterns, data),
+            run_tool(["sed", "-n", "-f", str(patterns)], data),
+        )
+
+
+def _locale_available(name: str) -> bool:
+    env = {**os.environ, "LC_ALL": name}
+    proc = subprocess.run(["locale"], env=env, capture_output=True, text=True, check=False)
+    return proc.returncode == 0 and not proc.stderr
+
+
+@unittest.skipUnless(shutil.which("sort"), "needs sort")
+class SortFirstFieldDifferentialTests(unittest.TestCase):
+    def check(self, locale_name: str, keys: list[str]):
+        rng = random.Random(3)
+        with mock.patch.dict(os.environ, {"LC_ALL": locale_name}):
+            for _ in range(50):
+                lines = [f"{rng.choice(keys)}:{rng.randrange(100)} x" for _ in range(20)]
+                data = "\n".join(lines).encode() + rng.choice([b"", b"\n"])
+                with self.subTest(data=data):
+                    self.assertEqual(
+                        snapshot_eval.sort_first_field(data),
+                        run_tool(["sort", "-s", "-t", ":", "-k", "1,1"], data),
+                    )
+
+    def test_c_locale(self):
+        self.check("C", ["d_00", "d_02", "B", "a", "_x", "d_10", "", "A b"])
+
+    def test_utf8_locale(self):
+        for name in ("C.UTF-8", "en_US.UTF-8"):
+            if _locale_available(name):
+                with self.subTest(locale=name):
+                    self.check(name, ["d_00", "d_02", "d_03", "d_10"])
+                    self.check(name, ["d_00", "d_2", "B", "a", "_x", "", "A b"])
+
+
+@unittest.skipUnless(shutil.which("diff"), "needs diff")
+class UnifiedDiffDifferentialTests(TempDirTestCase):
+    def test_matches_diff(self):
+        rng = random.Random(4)
+        a = self.tmp / "a"
+        b = self.tmp / "b"
+        endings = ["", " ", "\t", "\r", "\v", "\f", " \t ", "\u00a0"]
+        for _ in range(200):
+            lines = [rng.choice(["x", "y", "z", ""]) for _ in range(rng.randint(0, 6))]
+            a.write_bytes("".join(line + rng.choice(endings) + "\n" for line in lines).encode())
+            lines = [line for line in lines if rng.random() < 0.9]
+            lines.insert(rng.randint(0, len(lines)), rng.choice(["x", "w", "", "x"]))
+            text = "".join(line + rng.choice(endings) + "\n" for line in lines)
+            b.write_bytes(text[: -1 if rng.random() < 0.3 else None].encode())
+            expected = subprocess.run(["diff", "-auZN", str(a), str(b)], stdout=subprocess.PIPE)
+            with self.subTest(a=a.read_bytes(), b=b.read_bytes()):
+                self.assertEqual(snapshot_eval.unified_diff(a, b) == "", expected.returncode == 0)
+                self.assertEqual(snapshot_eval.unified_diff(a, b), expected.stdout.decode())
+
+
+def python(code: str) -> list[str]:
+    return [sys.executable, "-c", code]
+
+
+@unittest.skipIf(tee_popen._multiplexer is None, "no output multiplexer on this platform")
+class OutputMultiplexerTests(unittest.TestCase):
+    def test_error_in_one_pipe_closes_only_it(self):
+        broken = tee_popen.TeePopen(python("print('x' * 100)"), stdout=None, stderr=None)
+        broken._capture.add = mock.Mock(side_effect=RuntimeError("broken capture"))
+        broken.start()
+        healthy = tee_popen.TeePopen(python("print('ok')"), stdout=None, stderr=None).start()
+        broken.wait()
+        self.assertEqual(healthy.wait(), 0)
+        self.assertEqual(healthy.stdout, "ok\n")
+        self.assertTrue(tee_popen._multiplexer._thread.is_alive())
+
+    def test_dead_thread_is_restarted(self):
+        mux = tee_popen._multiplexer
+        mux.ensure_running()
+        with (
+            mock.patch.object(
+                mux._selector, "select", side_effect=[RuntimeError("select failed")]
+            ),
+            mock.patch.object(threading, "excepthook"),
+        ):
+            thread = mux._thread
+            mux.add([])
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+        proc = tee_popen.TeePopen(python("print('ok')"), stdout=None, stderr=None)
+        self.assertEqual(proc.run(), 0)
+        self.assertEqual(proc.stdout, "ok\n")
+        self.assertIsNot(mux._thread, thread)
+
+    def test_unusable_console_does_not_stop_the_thread(self):
+        console = mock.Mock()
+        console.write.side_effect = TypeError("not a stream")
+        proc = tee_popen.TeePopen(python("print('ok')"), stdout=console, stderr=None)
+        self.assertEqual(proc.run(), 0)
+        self.assertEqual(proc.stdout, "ok\n")
+        self.assertTrue(tee_popen._multiplexer._thread.is_alive())
+
+
+class TeePopenCaptureTests(TempDirTestCase):
+    CODE = "import sys\nfor i in range(3):\n print(f'out {i}', flush=True)\n print(f'err {i}', file=sys.stderr, flush=True)"
+
+    def run_child(self, text=True, **kwargs):
+        proc = tee_popen.TeePopen(python(self.CODE), stdout=None, stderr=None, text=text, **kwargs)
+        self.assertEqual(proc.run(), 0)
+        return proc
+
+    def test_full_with_renamed_and_deleted_log(self):
+        for text in (True, False):
+            with self.subTest(text=text):
+                log_path = self.tmp / "build.log"
+                with open(log_path, "w" if text else "wb") as log_file:
+                    log_file.write("header\n" if text else b"header\n")
+                    proc = tee_popen.TeePopen(
+                        python(self.CODE), stdout=None, stderr=None, text=text, log_file=log_file
+                    ).start()
+                    log_path.rename(self.tmp / "moved.log")
+                    proc.wait()
+                (self.tmp / "moved.log").unlink()
+                out = "out 0\nout 1\nout 2\n"
+                err = "err 0\nerr 1\nerr 2\n"
+                self.assertEqual(proc.stdout, out if text else out.encode())
+                self.assertEqual(proc.stderr, err if text else err.encode())
+
+    def test_full_without_log(self):
+        proc = self.run_child()
+        self.assertEqual(proc.stdout, "out 0\nout 1\nout 2\n")
+        self.assertEqual(proc.stderr, "err 0\nerr 1\nerr 2\n")
+
+    def test_tail(self):
+        proc = self.run_child(text=False, capture="tail", capture_lines=2)
+        self.assertEqual(proc.stdout, b"out 1\nout 2\n")
+        self.assertEqual(proc.stderr, b"err 1\nerr 2\n")
+
+    def test_none(self):
+        log_path = self.tmp / "build.log"
+        with open(log_path, "w") as log_file:
+            proc = self.run_child(capture="none", log_file=log_file)
+        self.assertEqual(proc.stdout, "")
+        self.assertEqual(proc.stderr, "")
+        self.assertIn("out 2\n", log_path.read_text())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            tee_popen.TeePopen(python(""), capture="all")
+
+
+class TeePopenBinaryTests(TempDirTestCase):
+    def test_binary_output_is_teed_unchanged(self):
+        # Larger than one read, not UTF-8, and without a final newline
+        output = b"\xff\xfe not utf-8\r\n" + b"x" * 200_000 + b"\nlast line"
+        (self.tmp / "output").write_bytes(output)
+        code = (
+            f"import sys; sys.stdout.buffer.write(open({str(self.tmp / 'output')!r}, 'rb').read())"
+        )
+        with (
+            open(self.tmp / "build.log", "wb") as log_file,
+            open(self.tmp / "console", "wb") as console,
+        ):
+            log_file.write(b"header\n")
+            proc = tee_popen.TeePopen(
+                python(code),
+                stdout=console,
+                stderr=None,
+                text=False,
+                output_prefix="[case] ",
+                log_file=log_file,
+            )
+            self.assertEqual(proc.run(), 0)
+        self.assertEqual((self.tmp / "build.log").read_bytes(), b"header\n" + output)
+        self.assertEqual(proc.stdout, output)
+        self.assertEqual(proc.stderr, b"")
+        expected_console = b"".join(b"[case] " + line for line in output.splitlines(True))
+        self.assertEqual((self.tmp / "console").read_bytes(), expected_console)
+
+    @unittest.skipUnless(hasattr(os, "wait4"), "needs os.wait4")
+    def test_peak_rss_of_the_child(self):
+        size = 64 << 20
+        code = f"data = bytearray({size}); data[::4096] = b'x' * len(data[::4096])"
+        proc = tee_popen.TeePopen(python(code), stdout=None, stderr=None, text=False)
+        self.assertIsNone(proc.peak_rss)
+        self.assertEqual(proc.run(), 0)
+        self.assertGreaterEqual(proc.peak_rss, size)
+        # The child's, not this process's.
+        self.assertLess(proc.peak_rss, size + (256 << 20))
+
+
+class AffectedEntriesTests(unittest.TestCase):
+    ENTRIES = [
+        {"board": "nice_nano_v2", "shield": "corne_left nice_view_adapter nice_view"},
+        {"board": "nice_nano_v2", "shield": "corne_right nice_view_adapter nice_view"},
+        {"board": "xiao_ble//zmk", "shield": "mykbd"},
+        {"board": "mykbd_board"},
+    ]
+    SNIPPETS = [["studio-rpc-usb-uart"], [], [], []]
+    ROOT = Path("/work/zmk-config")
+    MODULE = Path("/work/module")
+
+    def affected(self, *files: str) -> set[int]:
+        return changed_targets.affected_entries(
+            self.ENTRIES,
+            self.SNIPPETS,
+            [Path(f) for f in files],
+            self.ROOT / "config",
+            [self.ROOT, self.MODULE],
+        )
+
+    def test_config_files(self):
+        self.assertEqual(self.affected("/work/zmk-config/config/corne.keymap"), {0, 1})
+        self.assertEqual(self.affected("/work/zmk-config/config/corne_left.conf"), {0})
+        self.assertEqual(self.affected("/work/zmk-config/config/xiao_ble.conf"), {2})
+        self.assertEqual(self.affected("/work/zmk-config/config/other.keymap"), {0, 1, 2, 3})
+
+    def test_shield_files(self):
+        self.assertEqual(self.affected("/work/module/boards/shields/corne/corne.dtsi"), {0, 1})
+        self.assertEqual(self.affected("/work/module/boards/shields/nice_view/x.overlay"), {0, 1})
+        self.assertEqual(
+            self.affected("/work/module/boards/shields/common/shared.dtsi"), {0, 1, 2, 3}
+        )
+
+    def test_board_files(self):
+        self.assertEqual(
+            self.affected("/work/zmk-config/boards/arm/mykbd_board/mykbd_board.dts"), {3}
+        )
+        self.assertEqual(self.affected("/work/module/boards/arm/unknown/x.dts"), {0, 1, 2, 3})
+
+    def test_snippets(self):
+        self.assertEqual(self.affected("/work/module/snippets/studio-rpc-usb-uart/s.conf"), {0})
+        self.assertEqual(self.affected("/work/module/snippets/unused/s.conf"), set())
+
+    def test_ignored_and_unknown_files(self):
+        self.assertEqual(self.affected("/work/zmk-config/README.md"), set())
+        self.assertEqual(self.affected("/work/module/.github/workflows/ci.yml"), set())
+        self.assertEqual(self.affected("/elsewhere/file.c"), set())
+        self.assertEqual(self.affected("/work/module/src/behavior.c"), {0, 1, 2, 3})
+        self.assertEqual(self.affected("/work/zmk-config/build.yaml"), {0, 1, 2, 3})
+
+
+class FileWatchTests(TempDirTestCase):
+    def watcher(self) -> file_watch.Watcher:
+        (self.tmp / "src").mkdir()
+        (self.tmp / ".git").mkdir()
+        watcher = file_watch.Watcher([self.tmp], debounce=0.1)
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def test_reports_changed_files(self):
+        watcher = self.watcher()
+        (self.tmp / "src" / "a.c").write_text("int a;\n")
+        (self.tmp / ".git" / "index").write_text("")
+        changed = watcher.wait()
+        self.assertIn(self.tmp / "src" / "a.c", changed)
+        self.assertNotIn(self.tmp / ".git" / "index", changed)
+        self.assertFalse(watcher.lost_events(changed))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+    def test_queue_overflow_means_everything_changed(self):
+        watcher = self.watcher()
+        self.assertFalse(watcher.polling)
+        # Replace the inotify descriptor with a pipe carrying an overflow event.
+        read_fd, write_fd = os.pipe()
+        os.close(watcher.backend.fd)
+        watcher.backend.fd = read_fd
+        os.write(write_fd, file_watch.EVENT_HEADER.pack(-1, file_watch.IN_Q_OVERFLOW, 0, 0))
+        os.close(write_fd)
+        changed = watcher.wait()
+        self.assertEqual(changed, {self.tmp})
+        self.assertTrue(watcher.lost_events(changed))
+
+
+def git(cwd: Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+@unittest.skipUnless(shutil.which("git"), "needs git")
+class WorkspaceIndexTests(TempDirTestCase):
+    """A workspace whose manifest imports zmk's app/west.yml, like a zmk-config."""
+
+    def setUp(self):
+        super().setUp()
+        try:
+            import west.manifest  # noqa: F401
+        except ImportError:
+            self.skipTest("needs west")
+        (self.tmp / ".west").mkdir()
+        (self.tmp / ".west" / "config").write_text("[manifest]\npath = config\nfile = west.yml\n")
+        (self.tmp / "config" / "submanifests").mkdir(parents=True)
+        (self.tmp / "config" / "west.yml").write_text(
+            "manifest:\n"
+            "  remotes: [{name: r, url-base: https://example.com}]\n"
+            "  projects:\n"
+            "    - {name: zmk, remote: r, revision: main, import: app/west.yml}\n"
+            "  self: {path: config, import: submanifests}\n"
+        )
+        self.write_submanifest("extra.yml", "module")
+        (self.tmp / "zmk" / "app").mkdir(parents=True)
+        self.commit_zmk_manifest(["zephyr"])
+
+    def write_submanifest(self, name: str, project: str) -> None:
+        (self.tmp / "config" / "submanifests" / name).write_text(
+            f"manifest:\n  projects: [{{name: {project}, url: https://example.com/{project}}}]\n"
+        )
+
+    def commit_zmk_manifest(self, projects: list[str]) -> None:
+        zmk = self.tmp / "zmk"
+        (zmk / "app" / "west.yml").write_text(
+            "manifest:\n  projects:\n"
+            + "".join(f"    - {{name: {p}, url: https://example.com/{p}}}\n" for p in projects)
+        )
+        if not (zmk / ".git").exists():
+            git(zmk, "init", "-q")
+        git(zmk, "add", "-A")
+        git(zmk, "commit", "-qm", "manifest")
+        git(zmk, "update-ref", workspace_index.MANIFEST_REV, "HEAD")
+
+    def load(self, rebuilt: bool) -> workspace_index.WorkspaceIndex:
+        index = workspace_index.load(self.tmp)
+        # A rebuilt index comes with the Manifest it parsed.
+        self.assertEqual(index._manifest is not None, rebuilt)
+        return index
+
+    def test_cached_until_an_imported_manifest_changes(self):
+        index = self.load(rebuilt=True)
+        self.assertEqual(index.project("zmk").abspath, str(self.tmp / "zmk"))
+        self.assertIsNotNone(index.project("zephyr"))
+        self.assertIsNotNone(index.project("module"))
+        self.load(rebuilt=False)
+
+        # west imports from manifest-rev: an uncommitted edit changes nothing
+        (self.tmp / "zmk" / "app" / "west.yml").write_text("manifest: {}\n")
+        self.load(rebuilt=False)
+
+        # ... until `west update` moves manifest-rev
+        self.commit_zmk_manifest(["zephyr", "hal_nordic"])
+        self.assertIsNotNone(self.load(rebuilt=True).project("hal_nordic"))
+        git(self.tmp / "zmk", "pack-refs", "--all")
+        self.load(rebuilt=False)
+
+    def test_self_imports_and_config_are_keys(self):
+        self.load(rebuilt=True)
+        self.write_submanifest("more.yml", "other")
+        self.assertIsNotNone(self.load(rebuilt=True).project("other"))
+        self.write_submanifest("more.yml", "renamed")
+        self.assertIsNotNone(self.load(rebuilt=True).project("renamed"))
+        with open(self.tmp / ".west" / "config", "a") as f:
+            f.write("[build]\nboard = nice_nano_v2\n")
+        self.load(rebuilt=True)
+        self.load(rebuilt=False)
+
+
+class ConfigureCacheTests(TempDirTestCase):
+    def key(self, *cmake_args: str, board: str = "nice_nano_v2", modules=("/m",)) -> str:
+        return configure_cache.group_key(board, list(modules), list(cmake_args))
+
+    def test_group_key(self):
+        base = self.key("-DZMK_CONFIG=/cfg", "-DSHIELD=corne_left")
+        # The shield and unrelated options don't split groups.
+        self.assertEqual(base, self.key("-DZMK_CONFIG=/cfg", "-DSHIELD=corne_right"))
+        self.assertEqual(base, self.key("-DZMK_CONFIG=/cfg", "-DCONFIG_ZMK_STUDIO=y"))
+        self.assertEqual(base, self.key("-DZMK_CONFIG=/cfg", "-DBOARD_DIRS=x"))
+        # Board, modules and anything changing the board or toolchain lookup do.
+        for other in (
+            self.key("-DZMK_CONFIG=/cfg", board="xiao_ble"),
+            self.key("-DZMK_CONFIG=/cfg", modules=("/other",)),
+            self.key("-DZMK_CONFIG=/other"),
+            self.key("-DZMK_CONFIG=/cfg", "-DBOARD_ROOT=/boards"),
+            self.key("-DZMK_CONFIG=/cfg", "-D", "BOARD_ROOT=/boards"),
+            self.key("-DZMK_CONFIG=/cfg", "-DZMK_EXTRA_MODULES:STRING=/x"),
+            self.key("-DZMK_CONFIG=/cfg", "-DZEPHYR_SDK_INSTALL_DIR=/sdk"),
+        ):
+            self.assertNotEqual(base, other)
+        with mock.patch.dict(os.environ, {"ZEPHYR_SDK_INSTALL_DIR": "/opt/sdk"}):
+            self.assertNotEqual(base, self.key("-DZMK_CONFIG=/cfg"))
+
+    def write_cmake_cache(self, build_dir: Path, values: dict) -> None:
+        build_dir.mkdir(parents=True, exist_ok=True)
+        (build_dir / "CMakeCache.txt").write_text(
+            "# This is the CMakeCache file.\n"
+            + "".join(f"{name}:PATH={value}\n" for name, value in values.items())
+        )
+
+    def test_leader_seeds_followers_and_later_runs(self):
+        sdk = self.tmp / "sdk"
+        board_dir = self.tmp / "boards" / "nice_nano"
+        sdk.mkdir()
+        board_dir.mkdir(parents=True)
+        path = self.tmp / "build" / "configure-cache.json"
+        cache = configure_cache.ConfigureCache(path)
+        self.assertEqual(cache.plan(["a", "a", "b", "a"]), [0, 2])
+
+        seeds = []
+        follower = threading.Thread(target=lambda: seeds.extend(cache.seeds("a")))
+        follower.start()
+        follower.join(0.1)
+        self.assertTrue(follower.is_alive(), "followers wait for their leader")
+        self.write_cmake_cache(
+            self.tmp / "build" / "a",
+            {
+                "ZEPHYR_TOOLCHAIN_VARIANT": "zephyr",
+                "ZEPHYR_SDK_INSTALL_DIR": sdk,
+                "BOARD_DIR": board_dir,
+                "CMAKE_C_COMPILER": "/sdk/bin/gcc",
+            },
+        )
+        cache.record("a", self.tmp / "build" / "a")
+        follower.join(5)
+        self.assertEqual(
+            sorted(seeds),
+            [
+                f"-DBOARD_DIR={board_dir}",
+                f"-DZEPHYR_SDK_INSTALL_DIR={sdk}",
+                "-DZEPHYR_TOOLCHAIN_VARIANT=zephyr",
+            ],
+        )
+
+        # A leader that failed before configuring leaves its group unseeded.
+        cache.record("b", self.tmp / "build" / "b")
+        self.assertEqual(cache.seeds("b"), [])
+
+        # Later runs start from the stored seeds, without a leader ...
+        self.assertEqual(configure_cache.ConfigureCache(path).plan(["a", "b"]), [1])
+        # ... unless they point at an SDK or board dir that is gone.
+        board_dir.rmdir()
+        self.assertEqual(configure_cache.ConfigureCache(path).plan(["a", "b"]), [0, 1])
+
+    @unittest.skipIf(
+        not (shutil.which("cmake") and shutil.which("cc") and shutil.which("c++")),
+        "needs cmake and a C/C++ compiler",
+    )
+    def test_followers_reuse_the_compiler_identification(self):
+        source = self.tmp / "src"
+        source.mkdir()
+        (source / "CMakeLists.txt").write_text(
+            "cmake_minimum_required(VERSION 3.20)\n"
+            "set(BOARD_DIR ${CMAKE_SOURCE_DIR} CACHE PATH board)\n"
+            "project(demo C CXX ASM)\n"
+            "add_executable(demo main.c)\n"
+        )
+        (source / "main.c").write_text("int main(void) { return 0; }\n")
+
+        def configure(build_dir: Path, *seeds: str) -> str:
+            proc = subprocess.run(
+                ["cmake", "-S", str(source), "-B", str(build_dir), *seeds],
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            return proc.stdout
+
+        cache = configure_cache.ConfigureCache(self.tmp / "build" / "configure-cache.json")
+        cache.plan(["a", "a"])
+        self.assertIn("compiler identification", configure(self.tmp / "build" / "leader"))
+        cache.record("a", self.tmp / "build" / "leader")
+
+        seeds = cache.seeds("a")
+        self.assertIn(
+            f"-DCMAKE_PROJECT_INCLUDE_BEFORE={configure_cache.REUSE_COMPILER_INFO}", seeds
+        )
+        follower = self.tmp / "build" / "follower"
+        self.assertNotIn("compiler identification", configure(follower, *seeds))
+        proc = subprocess.run(["cmake", "--build", str(follower)], capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+
+        # Without a stash for this CMake version the compilers are identified.
+        shutil.rmtree(cache.stash_dir)
+        self.assertIn("compiler identification", configure(self.tmp / "build" / "new", *seeds))
+
+
+@unittest.skipIf(zmk_test is None, "needs west")
+class WatchResultsTests(TempDirTestCase):
+    def test_rerun_results_are_merged(self):
+        runner = native_sim_tests.NativeSimRunner(
+            zmk_app=self.tmp / "zmk" / "app",
+            tests_path=self.tmp / "tests",
+            build_dir=self.tmp,
+            extra_modules=[],
+            auto_accept=False,
+            verbose=False,
+            log=mock.Mock(),
+        )
+        command = zmk_test.ZMKTest()
+        first = [
+            native_sim_tests.CaseResult("a", "PASS", "PASS: a"),
+            native_sim_tests.CaseResult("b", "PASS", "PASS: b"),
+        ]
+        rerun = [native_sim_tests.CaseResult("b", "FAILED", "FAILED: b", "--- diff\n")]
+        with mock.patch.object(runner, "run", side_effect=[first, rerun]):
+            latest = {r.rel: r for r in command._run_cases(runner, [], 1, self.tmp)}
+            batch = command._run_cases(runner, [], 1, self.tmp, latest)
+        self.assertEqual(batch, rerun)
+
+        tests_build = self.tmp / "tests"
+        self.assertEqual((tests_build / "pass-fail.log").read_text(), "\nPASS: a\nFAILED: b\n")
+        events = [
+            json.loads(line)
+            for line in (tests_build / test_results.JSON_RESULTS).read_text().splitlines()
+        ]
+        summaries = [e for e in events if e["event"] == "summary"]
+        self.assertEqual([(e["total"], e["failed"]) for e in summaries], [(2, 0), (2, 1)])
+        junit = (tests_build / test_results.JUNIT_XML).read_text()
+        self.assertIn('tests="2" failures="1"', junit)
+        self.assertIn("PASS: a", (self.tmp / "stdout_and_stderr.log").read_text())
+
+
+@unittest.skipIf(zmk_build is None, "needs west")
+class FlashPipelineTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.command = zmk_build.ZMKBuild()
+        self.args = argparse.Namespace(
+            build_dir=str(self.tmp),
+            parallelism=2,
+            flash=["+r", "nrfjprog"],
+            quiet=True,
+            shared_configure=False,
+            skip_build=False,
+        )
+        self.matrix = [
+            {"artifact": "left", "flash-args": "--dev-id 1"},
+            {"artifact": "right", "flash_args": "--dev-id 2"},
+            {"artifact": "dongle"},
+        ]
+
+    def run_local(self, build, flash) -> list[dict]:
+        with (
+            mock.patch.object(self.command, "_prepare_builds"),
+            mock.patch.object(self.command, "_run_single_build", side_effect=build),
+            mock.patch.object(self.command, "_flash", side_effect=flash),
+        ):
+            results = self.command._run_local(None, None, self.args, self.matrix, [0, 1, 2])
+        return sorted(results, key=lambda r: r["id"])
+
+    def test_flashes_while_other_targets_build(self):
+        flashed = threading.Event()
+        events = []
+
+        def build(id, zmk, workspace, args, build_setup):
+            if id == 1:
+                # Only finishes once the first target got flashed.
+                events.append(("waited", flashed.wait(5)))
+            elif id == 2:
+                return {"id": id, "artifact": "dongle", "success": False, "message": "Failed."}
+            return {"id": id, "artifact": build_setup["artifact"], "success": True, "message": ""}
+
+        def flash(id, args, build_setup):
+            events.append(("flash", id))
+            flashed.set()
+            return 0 if id == 0 else 1
+
+        results = self.run_local(build, flash)
+        self.assertEqual(events, [("flash", 0), ("waited", True), ("flash", 1)])
+        self.assertEqual(
+            [(r["success"], r["message"]) for r in results],
+            [(True, "Flashed."), (False, "Flashing failed."), (False, "Failed.")],
+        )
+
+    def test_flash_command(self):
+        (self.tmp / "left").mkdir()
+        proc = mock.Mock(returncode=0)
+        with mock.patch.object(zmk_build, "TeePopen") as tee_popen:
+            tee_popen.return_value.start.return_value = proc
+            self.assertEqual(self.command._flash(0, self.args, self.matrix[0]), 0)
+        self.assertEqual(
+            tee_popen.call_args.args[0],
+            [
+                "west",
+                "flash",
+                "-d",
+                str(self.tmp / "left"),
+                "--skip-rebuild",
+                "-r",
+                "nrfjprog",
+                "--dev-id",
+                "1",
+            ],
+        )
+        self.assertTrue((self.tmp / "left" / "flash.log").is_file())
+
+
+@unittest.skipIf(zmk_build is None, "needs west")
+class SmartPristineTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.command = zmk_build.ZMKBuild()
+        self.command._build_cache = build_cache.BuildCache(
+            self.tmp / "cache", FakeManifest(FakeProject("zmk", "main", head="1" * 40))
+        )
+        self.command._compiler_cache = None
+        self.command._configure_cache = None
+        self.command._job_budget = None
+        self.args = argparse.Namespace(
+            west_args=[], config_path=str(self.tmp / "config"), pristine="smart", quiet=True
+        )
+        (self.tmp / "config").mkdir()
+        self.zmk = mock.Mock(abspath=str(self.tmp / "zmk"))
+        self.setup = {"artifact": "left", "board": "nice_nano_v2", "shield": "corne_left"}
+        self.build_dir = self.tmp / "build" / "left"
+
+    def build(self) -> tuple[dict, list[str] | None]:
+        commands = []
+
+        def west_build(command, **kwargs):
+            commands.append(command)
+            (self.build_dir / "zephyr").mkdir(exist_ok=True)
+            (self.build_dir / "zephyr" / "zmk.uf2").write_bytes(b"uf2")
+            (self.build_dir / "CMakeCache.txt").write_text("")
+            kwargs["log_file"].write(b"built\n")
+            popen = mock.Mock()
+            popen.start.return_value = mock.Mock(returncode=0, peak_rss=None)
+            return popen
+
+        with (
+            mock.patch.object(self.command, "_cmake_args", return_value=[]),
+            mock.patch.object(self.command, "_extra_modules", return_value=[]),
+            mock.patch.object(self.command, "_snippets", return_value=[]),
+            mock.patch.object(zmk_build, "TeePopen", side_effect=west_build),
+        ):
+            result = self.command._build(0, self.zmk, self.args, self.setup, self.build_dir)
+        return result, commands[0] if commands else None
+
+    def test_cache_hit_keeps_the_fingerprint(self):
+        result, command = self.build()
+        self.assertEqual(command[command.index("-p") + 1], "always")
+        fingerprint = self.build_dir / zmk_build.ZMKBuild.FINGERPRINT_FILE
+        self.assertTrue(fingerprint.is_file())
+
+        result, command = self.build()
+        self.assertTrue(result["cached"])
+        self.assertIsNone(command)
+        self.assertTrue(fingerprint.is_file())
+
+        # A cache miss after the hit still builds incrementally.
+        self.command._build_cache = build_cache.BuildCache(
+            self.tmp / "other-cache", self.command._build_cache.manifest
+        )
+        result, command = self.build()
+        self.assertTrue(result["success"])
+        self.assertEqual(command[command.index("-p") + 1], "auto")
+
+
+@unittest.skipIf(zmk_build is None, "needs west")
+class JobBudgetTests(unittest.TestCase):
+    def test_shares_never_exceed_the_budget(self):
+        budget = zmk_build.JobBudget(total=8, pending=5, parallelism=3)
+        granted = [budget.acquire() for _ in range(3)]
+        # 8 jobs over 3 builds, then 5 over 2, then the remaining 2.
+        self.assertEqual(granted, [3, 3, 2])
+        self.assertEqual(budget.free, 0)
+        budget.release(granted.pop(0))
+        self.assertEqual(budget.free, 3)
+        # 2 builds pending, 1 slot free: the next build gets everything free.
+        granted.append(budget.acquire())
+        self.assertEqual(granted[-1], 3)
+        for jobs in granted:
+            budget.release(jobs)
+        self.assertEqual((budget.free, budget.running), (8, 0))
+
+    def test_waits_when_no_jobs_are_free(self):
+        budget = zmk_build.JobBudget(total=2, pending=4, parallelism=4)
+        granted = [budget.acquire(), budget.acquire()]
+        self.assertEqual(granted, [1, 1])
+        waiting = []
+        thread = threading.Thread(target=lambda: waiting.append(budget.acquire()))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive(), "acquire waits instead of overdrawing")
+        self.assertEqual(budget.free, 0)
+        budget.release(granted.pop())
+        thread.join(5)
+        self.assertEqual(waiting, [1])
+        self.assertEqual(budget.free, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()